@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compares the time needed for storing and loading data with different
+chunk sizes (`_DataProxy.put` with `chunk_size`).
+
+Two workloads are measured: many small data objects and a single large one.
+The profile name may be given as the first argument, so that the numbers
+for a SQLite and a PostgreSQL profile can be compared:
+
+    python benchmark_chunk_size.py demo
+    python benchmark_chunk_size.py postgres
+"""
+
+import os
+import sys
+import time
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from xdapy import Connection, Mapper, Entity
+
+profile = sys.argv[1] if len(sys.argv) > 1 else "demo"
+connection = Connection.profile(profile)
+connection.create_tables()
+
+m = Mapper(connection)
+
+SMALL_COUNT = 500
+SMALL_SIZE = 10 * 1000
+LARGE_SIZE_MB = 100
+CHUNK_SIZES = [64 * 1000, 1000 * 1000, 5 * 1000 * 1000, 20 * 1000 * 1000, "auto"]
+
+class Recording(Entity):
+    declared_params = {"name": "string"}
+
+m.register(Recording)
+
+def timed(fun):
+    start = time.time()
+    fun()
+    return time.time() - start
+
+rec = Recording(name="benchmark")
+m.save(rec)
+
+print "engine: %s" % connection.engine_name
+print "workload        chunk size  put [s]  get [s]"
+
+for chunk_size in CHUNK_SIZES:
+    small = [os.urandom(SMALL_SIZE) for _ in range(SMALL_COUNT)]
+
+    def put_small():
+        for i, data in enumerate(small):
+            rec.data["small-%d" % i].put(data, chunk_size=chunk_size)
+
+    def get_small():
+        for i, data in enumerate(small):
+            assert rec.data["small-%d" % i].get_string() == data
+
+    put_time = timed(put_small)
+    get_time = timed(get_small)
+    print "%d x %-8s  %10s  %7.2f  %7.2f" % (SMALL_COUNT, "%d kB" % (SMALL_SIZE / 1000),
+                                             chunk_size, put_time, get_time)
+
+    for i in range(SMALL_COUNT):
+        del rec.data["small-%d" % i]
+    m.collect_data_garbage(grace_period=0)
+
+for chunk_size in CHUNK_SIZES:
+    large = os.urandom(LARGE_SIZE_MB * 1000 * 1000)
+
+    put_time = timed(lambda: rec.data["large"].put(large, chunk_size=chunk_size))
+    out = StringIO()
+    get_time = timed(lambda: rec.data["large"].get(out))
+    assert out.getvalue() == large
+    print "1 x %-10s  %10s  %7.2f  %7.2f" % ("%d MB" % LARGE_SIZE_MB, chunk_size, put_time, get_time)
+
+    del rec.data["large"]
+    m.collect_data_garbage(grace_period=0)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures the read throughput with several threads and with several forked
+processes which share one `Connection`.
+
+Every thread reads with a session of its own; every child process calls
+`Connection.dispose_after_fork` first and then reads with `Connection.session`.
+The profile name may be given as the first argument. An in-memory SQLite
+profile does not work with processes, so the profile should point to a file
+or a PostgreSQL database, ideally with a pool, e.g.::
+
+    [bench]
+    url = postgresql://user@localhost/xdapy_bench
+    pool_size = 8
+    max_overflow = 0
+    pool_pre_ping = true
+
+    python benchmark_concurrent_reads.py bench
+"""
+
+import os
+import sys
+import threading
+import time
+
+from xdapy import Connection, Mapper, Entity
+
+profile = sys.argv[1] if len(sys.argv) > 1 else "demo"
+connection = Connection.profile(profile)
+connection.create_tables()
+
+m = Mapper(connection)
+
+TRIALS = 500
+READS = 5
+CONCURRENCY = [1, 2, 4, 8]
+
+class Trial(Entity):
+    declared_params = {
+        "rt": "integer",
+        "valid": "boolean"
+    }
+
+m.register(Trial)
+
+if len(m.find_all(Trial)) != TRIALS:
+    m.delete(*m.find_all(Trial))
+    m.save(*[Trial(rt=i, valid=i % 2 == 0) for i in range(TRIALS)])
+
+def read(session):
+    for i in range(READS):
+        trials = session.query(Trial).all()
+        assert sum(1 for t in trials if t.params["valid"]) == TRIALS / 2
+        session.expunge_all()
+
+def read_in_thread():
+    session = connection.Session.session_factory(bind=connection.engine)
+    try:
+        read(session)
+    finally:
+        session.close()
+
+def with_threads(count):
+    threads = [threading.Thread(target=read_in_thread) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def with_processes(count):
+    # no connection must be checked out while forking
+    connection.session.close()
+    pids = []
+    for _ in range(count):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                connection.dispose_after_fork()
+                read(connection.session)
+                status = 0
+            finally:
+                os._exit(status)
+        pids.append(pid)
+    for pid in pids:
+        _, status = os.waitpid(pid, 0)
+        assert status == 0
+
+def timed(fun, *args):
+    start = time.time()
+    fun(*args)
+    return time.time() - start
+
+print "engine: %s, pool: %s" % (connection.engine_name, connection.engine.pool.__class__.__name__)
+print "concurrency  threads [reads/s]  processes [reads/s]"
+for count in CONCURRENCY:
+    thread_time = timed(with_threads, count)
+    process_time = timed(with_processes, count)
+    print "%11d  %17.1f  %19.1f" % (count, count * READS / thread_time, count * READS / process_time)
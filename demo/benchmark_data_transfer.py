@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compares the throughput of the serial and the parallel data transfer
+(`_DataProxy.put` and `_DataProxy.get` with `workers`).
+
+The parallel transfer is only used on PostgreSQL, so the profile should
+point to a PostgreSQL database. Otherwise, both columns show the serial path.
+"""
+
+import os
+import time
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from xdapy import Connection, Mapper, Entity
+
+connection = Connection.profile("demo") # use standard profile
+connection.create_tables()
+
+m = Mapper(connection)
+
+SIZE_MB = 200
+WORKERS = [1, 2, 4, 8]
+COMPRESSION = ["none", "zlib"]
+
+class Recording(Entity):
+    declared_params = {"name": "string"}
+
+m.register(Recording)
+
+def timed(fun):
+    start = time.time()
+    fun()
+    return time.time() - start
+
+def payload():
+    # half random (incompressible), half zeros; no two chunks are equal,
+    # so that deduplication does not distort the numbers
+    return "".join(os.urandom(500 * 1000) + "\0" * 500 * 1000 for _ in range(SIZE_MB))
+
+rec = Recording(name="benchmark")
+m.save(rec)
+
+print "engine: %s, %d MB" % (connection.engine_name, SIZE_MB)
+print "compression  workers  put [MB/s]  get [MB/s]"
+for compression in COMPRESSION:
+    for workers in WORKERS:
+        key = "%s-%d" % (compression, workers)
+        data = payload()
+
+        put_time = timed(lambda: rec.data[key].put(data, compression=compression, workers=workers))
+        out = StringIO()
+        get_time = timed(lambda: rec.data[key].get(out, workers=workers))
+        assert out.getvalue() == data
+
+        print "%11s  %7d  %10.1f  %10.1f" % (compression, workers, SIZE_MB / put_time, SIZE_MB / get_time)
+
+        del rec.data[key]
+        m.collect_data_garbage(grace_period=0)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compares the two ways of restricting a query by parameter values:
+
+ * `Mapper.param_filter` which creates one EXISTS sub-query per key
+ * `Mapper.filter_query` (used by `Mapper.find`) which creates one join per key
+
+for filters with 1 to 10 keys.
+"""
+
+import random
+import time
+
+from xdapy import Connection, Mapper, Entity
+from xdapy.operators import ge
+
+connection = Connection.profile("demo") # use standard profile
+connection.create_tables()
+
+m = Mapper(connection)
+
+N_ENTITIES = 5000
+N_KEYS = 10
+REPEAT = 5
+
+class Measurement(Entity):
+    declared_params = dict(("p%d" % i, "integer") for i in range(N_KEYS))
+
+m.register(Measurement)
+
+if m.find(Measurement).count() < N_ENTITIES:
+    m.save_bulk(Measurement(**dict(("p%d" % i, random.randint(0, 100)) for i in range(N_KEYS)))
+                for _ in range(N_ENTITIES))
+
+def timed(query):
+    # count() keeps the ORM out of the measurement
+    start = time.time()
+    for _ in range(REPEAT):
+        count = query.count()
+    return (time.time() - start) / REPEAT, count
+
+print "keys  exists [s]  join [s]  speedup  rows"
+for num_keys in range(1, N_KEYS + 1):
+    # every key keeps roughly 90 % of the entities
+    the_filter = dict(("p%d" % i, ge(10)) for i in range(num_keys))
+
+    exists_query = m.session.query(Measurement).filter(m.param_filter(Measurement, the_filter))
+    join_query = m.find(Measurement, the_filter)
+
+    exists_time, exists_count = timed(exists_query)
+    join_time, join_count = timed(join_query)
+    assert exists_count == join_count
+
+    print "%4d  %10.4f  %8.4f  %7.2f  %4d" % (num_keys, exists_time, join_time,
+                                              exists_time / join_time, join_count)
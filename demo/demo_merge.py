@@ -78,61 +78,17 @@ m.save(e3, e2)
 
 mapping = {Experiment_nodate: Experiment}
 
-from sqlalchemy.orm import exc
-
-def migrate_obj(obj, old_mapper, new_mapper, mapping):
-    klass = obj.__class__
-    mapto = klass
-    if klass in mapping:
-        mapto = mapping[klass]
-    
-    # check, if unique_id is already present
-    try:
-        new_obj = new_mapper.find_by_unique_id(obj.unique_id) # TODO Deal with closed sessions
-    except exc.NoResultFound:
-        new_obj = mapto(_unique_id = obj.unique_id)
-    except exc.MultipleResultsFound:
-        raise DataInconsistencyError("unique_id in mapper {0} is not unique".format(new_mapper))
-
-    # copy params
-    for k,v in obj.params.iteritems():
-        new_obj.params[k] = v
-
-    new_mapper.save(new_obj)
-
-    # copy data
-    new_obj.data.copy(obj.data)
-
-def migrate(old_mapper, new_mapper, mapping):
-    for obj in old_mapper.find_roots():
-        migrate_obj(obj, old_mapper, new_mapper, mapping)
-
-from xdapy.structures import Context
-from sqlalchemy.orm.exc import NoResultFound
-def migrate_connections(m1, m2):
-    conn1 = m1.find(Context)
-    for c1 in conn1:
-        from_unique_id = c1.holder.unique_id
-        to_unique_id = c1.attachment.unique_id
-        name = c1.connection_type
-
-        print from_unique_id, to_unique_id
-
-        try:
-            m2_from = m2.find_by_unique_id(from_unique_id)
-            m2_to = m2.find_by_unique_id(to_unique_id)
-            m2_from.attach(name, m2_to)
-        except NoResultFound:
-            pass
-
-migrate(m, m_2, mapping)
-migrate(m_2, m, mapping)
-
-migrate_connections(m, m_2)
+from xdapy.merge import merge
+
+# entities are identified by their unique_id; merging twice does no harm
+print merge(connection, connection_2, type_map=mapping)
+print merge(connection_2, connection)
+
+m.session.expire_all()
+m_2.session.expire_all()
 
 print m.find_roots()
 print m_2.find_roots()
 
 
 assert len(m.find_roots()) == len(m_2.find_roots())
-
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+"""
+Maintains the closure table `xdapy.structures.EntityClosure` of the
+parent–child relation between entities.
+
+For every entity, the table holds one row ``(ancestor_id, descendant_id,
+depth)`` for each of its ancestors and one row ``(id, id, 0)`` for the
+entity itself. Looking up all descendants or all ancestors of an entity is
+then a single indexed query instead of a recursive one.
+
+The table is kept up to date by a listener on the ``after_flush`` event
+of the session (see `maintain`): New entities get their rows, entities
+whose ``parent_id`` has changed are moved together with their subtree
+and the rows of deleted entities are removed. Databases which have been
+written to without the listener may be brought up to date with `rebuild`
+and checked with `check`.
+"""
+
+__docformat__ = "restructuredtext"
+
+__authors__ = ['"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
+
+import weakref
+
+from sqlalchemy import event
+from sqlalchemy.orm import attributes
+from sqlalchemy.sql import select, and_, or_, not_, literal_column
+
+from xdapy.structures import BaseEntity, EntityClosure, MAX_HIERARCHY_DEPTH
+from xdapy.errors import DataInconsistencyError
+from xdapy.utils.sql import InsertFromSelect
+
+closure = EntityClosure.__table__
+entities = BaseEntity.__table__
+
+_CLOSURE_COLUMNS = ["ancestor_id", "descendant_id", "depth"]
+
+# the sessions which already have a listener
+_maintained_sessions = weakref.WeakKeyDictionary()
+
+
+def _subtree(entity_id):
+    return select([closure.c.descendant_id]).where(closure.c.ancestor_id == entity_id)
+
+def _cut(connection, entity_id):
+    """ Removes all paths which lead from outside into the subtree of `entity_id`.
+    Afterwards, the entity is a root as far as the closure table is concerned.
+    """
+    connection.execute(closure.delete().where(and_(
+        closure.c.descendant_id.in_(_subtree(entity_id)),
+        not_(closure.c.ancestor_id.in_(_subtree(entity_id))))))
+
+def _link(connection, entity_id, parent_id):
+    """ Adds the paths from all ancestors of `parent_id` (including itself)
+    into the subtree of `entity_id`.
+    """
+    above = closure.alias("above")
+    below = closure.alias("below")
+    paths = select([above.c.ancestor_id, below.c.descendant_id, above.c.depth + below.c.depth + 1],
+                   and_(above.c.descendant_id == parent_id, below.c.ancestor_id == entity_id))
+    connection.execute(InsertFromSelect(closure, _CLOSURE_COLUMNS, paths))
+
+def _parent_changed(entity):
+    return (attributes.get_history(entity, "parent_id").has_changes() or
+            attributes.get_history(entity, "parent").has_changes())
+
+def _after_flush(session, flush_context):
+    new = [obj for obj in session.new if isinstance(obj, BaseEntity)]
+    moved = [obj for obj in session.dirty if isinstance(obj, BaseEntity) and _parent_changed(obj)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, BaseEntity)]
+
+    if not (new or moved or deleted):
+        return
+
+    connection = session.connection()
+
+    # All moved subtrees are cut before any of them is linked again.
+    # Otherwise, swapping parent and child would create a cycle in between.
+    for entity in moved + deleted:
+        _cut(connection, entity.id)
+
+    if deleted:
+        ids = [entity.id for entity in deleted]
+        connection.execute(closure.delete().where(or_(
+            closure.c.ancestor_id.in_(ids),
+            closure.c.descendant_id.in_(ids))))
+
+    if new:
+        connection.execute(closure.insert(), [
+            {"ancestor_id": entity.id, "descendant_id": entity.id, "depth": 0} for entity in new])
+
+    for entity in new + moved:
+        if entity.parent_id is not None:
+            _link(connection, entity.id, entity.parent_id)
+
+def maintain(session):
+    """ Keeps the closure table up to date with all changes flushed by `session`.
+
+    Calling this function more than once for the same session has no effect.
+    """
+    if session in _maintained_sessions:
+        return
+    event.listen(session, "after_flush", _after_flush)
+    _maintained_sessions[session] = True
+
+def is_maintained(session):
+    """ Returns true, if `maintain` has been called for `session`.
+    """
+    return session in _maintained_sessions
+
+def rebuild(connection):
+    """ Deletes and re-creates all rows of the closure table.
+
+    The closure is built one generation at a time, so that the number of
+    statements is proportional to the depth of the hierarchy.
+
+    Parameters
+    ----------
+    connection
+        A SQLAlchemy connection (or session) to execute the statements with.
+
+    Returns
+    -------
+    rows: int
+        The number of rows in the closure table.
+
+    Raises
+    ------
+    DataInconsistencyError
+        If the hierarchy is deeper than `MAX_HIERARCHY_DEPTH`, which
+        indicates a circular reference.
+    """
+    connection.execute(closure.delete())
+    rows = connection.execute(InsertFromSelect(closure, _CLOSURE_COLUMNS,
+        select([entities.c.id.label("ancestor_id"), entities.c.id.label("descendant_id"),
+                literal_column("0")]))).rowcount
+
+    for depth in range(MAX_HIERARCHY_DEPTH):
+        # extend all paths of the current length by one generation
+        paths = select([closure.c.ancestor_id, entities.c.id, closure.c.depth + 1],
+                       and_(entities.c.parent_id == closure.c.descendant_id, closure.c.depth == depth))
+        inserted = connection.execute(InsertFromSelect(closure, _CLOSURE_COLUMNS, paths)).rowcount
+        if not inserted:
+            return rows
+        rows += inserted
+
+    raise DataInconsistencyError("Circular reference")
+
+def expected_rows(connection):
+    """ Computes the rows which the closure table should have from the
+    ``parent_id`` column of all entities.
+
+    Returns
+    -------
+    rows: set
+        A set of ``(ancestor_id, descendant_id, depth)`` tuples.
+
+    Raises
+    ------
+    DataInconsistencyError
+        If there is a circular reference.
+    """
+    parents = dict(connection.execute(select([entities.c.id, entities.c.parent_id])).fetchall())
+
+    rows = set()
+    for entity_id in parents:
+        ancestor_id = entity_id
+        depth = 0
+        while ancestor_id is not None:
+            rows.add((ancestor_id, entity_id, depth))
+            ancestor_id = parents.get(ancestor_id)
+            depth += 1
+            if depth > len(parents):
+                raise DataInconsistencyError("Circular reference")
+    return rows
+
+def check(connection):
+    """ Compares the closure table with the hierarchy of the entities.
+
+    Returns
+    -------
+    (missing, superfluous): tuple of sets
+        The ``(ancestor_id, descendant_id, depth)`` rows which should be in
+        the closure table but are not, and those which should not be in
+        the closure table but are. Both sets are empty, if the closure
+        table is consistent.
+    """
+    expected = expected_rows(connection)
+    stored = set(tuple(row) for row in connection.execute(
+        select([closure.c.ancestor_id, closure.c.descendant_id, closure.c.depth])))
+    return expected - stored, stored - expected
+
@@ -11,20 +11,29 @@ __authors__ = ['"Hannah Dold" <hannah.dold@mailbox.tu-berlin.de>',
                '"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
 
 
+import os
+import re
+import threading
 from os import path
 from contextlib import contextmanager
 import ConfigParser
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm import sessionmaker, scoped_session, Query
+from sqlalchemy.orm.session import Session
+from sqlalchemy.sql.expression import Selectable
 
-from xdapy import Base
+from xdapy import Base, closure
+from xdapy.data import upgrade_chunks
 from xdapy.errors import ConfigurationError, DatabaseError
 
 ALLOWED_ENGINES = ["sqlite", "postgresql"]
 
 MIN_PSYCOPG2_VERSION = (2, 4, 1)
 
+#: The strategies which select the replica for a read.
+REPLICA_SELECTIONS = ["round_robin", "least_loaded"]
+
 def _check_engine(engine):
     """ psycopg2 driver < 2.4.1 has a bug when connected to PostgreSQL 9.0:
     The transmitted data for bytea columns is different which messes up everything.
@@ -66,13 +75,199 @@ def _options_from_config(filename, section):
     except ConfigParser.NoOptionError:
         pass
 
+    pool_options = [("pool_size", config.getint),
+                    ("max_overflow", config.getint),
+                    ("pool_recycle", config.getint),
+                    ("pool_timeout", config.getfloat)]
+    for option, getter in pool_options:
+        try:
+            options.setdefault("engine_opts", {})[option] = getter(section, option)
+        except ConfigParser.NoOptionError:
+            pass
+    if not options.get("engine_opts"):
+        options.pop("engine_opts", None)
+
+    try:
+        options["pool_pre_ping"] = config.getboolean(section, "pool_pre_ping")
+    except ConfigParser.NoOptionError:
+        pass
+
+    try:
+        # separated by commas or whitespace (including new lines)
+        options["replicas"] = [url for url in re.split(r"[\s,]+", config.get(section, "replicas")) if url]
+    except ConfigParser.NoOptionError:
+        pass
+
+    try:
+        options["replica_selection"] = config.get(section, "replica_selection")
+    except ConfigParser.NoOptionError:
+        pass
+
     return options
 
+def _guard_pool(engine, pre_ping):
+    """ Adds listeners to the pool of `engine` which discard connections that
+    were opened in another process and, if `pre_ping` is true, connections
+    which the database has closed.
+    """
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        connection_record.info["pid"] = os.getpid()
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info.get("pid", os.getpid()) != os.getpid():
+            # the connection belongs to the parent process; it must be
+            # neither used nor closed here
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError("Connection belongs to process %d." % connection_record.info["pid"])
+
+        if pre_ping:
+            try:
+                cursor = dbapi_connection.cursor()
+                try:
+                    cursor.execute("SELECT 1")
+                finally:
+                    cursor.close()
+            except engine.dialect.dbapi.Error:
+                # the pool retries with a new connection
+                raise exc.DisconnectionError()
+
+class ReplicaSet(object):
+    """ The engines of the read replicas of a database.
+
+    Parameters
+    ----------
+    engines: list of engines
+        The replica engines.
+    selection: string, optional
+        How `select` chooses a replica: ``"round_robin"`` (the default) takes
+        one after the other, ``"least_loaded"`` takes the replica with the
+        fewest connections in use (and one after the other, if there is
+        a tie).
+    """
+    def __init__(self, engines, selection="round_robin"):
+        if not engines:
+            raise ConfigurationError("At least one replica is needed.")
+        if selection not in REPLICA_SELECTIONS:
+            raise ConfigurationError("%r is no replica selection. Supported selections are %s." %
+                                     (selection, ", ".join(REPLICA_SELECTIONS)))
+        self.engines = list(engines)
+        self.selection = selection
+
+        self._lock = threading.Lock()
+        self._next = 0
+        self._in_use = [0] * len(self.engines)
+        for i, engine in enumerate(self.engines):
+            self._count_connections(engine, i)
+
+    def _count_connections(self, engine, i):
+        @event.listens_for(engine, "checkout")
+        def checkout(dbapi_connection, connection_record, connection_proxy):
+            with self._lock:
+                self._in_use[i] += 1
+
+        @event.listens_for(engine, "checkin")
+        def checkin(dbapi_connection, connection_record):
+            with self._lock:
+                self._in_use[i] -= 1
+
+    def in_use(self):
+        """ Returns the number of connections in use for each replica."""
+        with self._lock:
+            return list(self._in_use)
+
+    def select(self):
+        """ Returns the engine of the replica for the next read."""
+        with self._lock:
+            count = len(self.engines)
+            start = self._next % count
+            self._next += 1
+            if self.selection == "round_robin":
+                return self.engines[start]
+            order = [(start + i) % count for i in range(count)]
+            return self.engines[min(order, key=lambda i: self._in_use[i])]
+
+
+class RoutingQuery(Query):
+    """ The query class of a `RoutingSession`.
+
+    Queries which load the state of an instance in the identity map (the
+    refresh of expired or deferred attributes and the lazy load of a
+    relationship) go to the primary. The instance may just have been
+    written by the session, and a replica which lags behind would not
+    know it yet.
+    """
+    def _execute_and_instances(self, querycontext):
+        # only the lazy loader turns off `_invoke_all_eagers`
+        if self._refresh_state is not None or not self._invoke_all_eagers:
+            with self.session.use_primary():
+                return Query._execute_and_instances(self, querycontext)
+        return Query._execute_and_instances(self, querycontext)
+
+
+class RoutingSession(Session):
+    """ A session which sends reads to a read replica and everything
+    else to the primary database (the session’s bind).
+
+    A ``SELECT`` goes to a replica, if the session is neither flushing nor
+    inside a transaction. Thus, everything inside an ``auto_session`` goes
+    to the primary and sees the writes of the session. Loading the
+    attributes and relationships of instances which are already in the
+    session also goes to the primary (see `RoutingQuery`), so that, e.g.,
+    ``entity.params`` works right after ``Mapper.save(entity)``. `use_primary`
+    sends all statements to the primary outside of transactions as well.
+    Without replicas, this is a plain `Session`.
+
+    Parameters
+    ----------
+    replicas: ReplicaSet, optional
+        The read replicas.
+    **kwargs
+        Passed to `Session`.
+    """
+    def __init__(self, replicas=None, **kwargs):
+        kwargs.setdefault("query_cls", RoutingQuery)
+        Session.__init__(self, **kwargs)
+        self.replicas = replicas
+        self._primary_depth = 0
+
+    @contextmanager
+    def use_primary(self):
+        """ For use in a ``with`` context: all statements go to the primary."""
+        self._primary_depth += 1
+        try:
+            yield self
+        finally:
+            self._primary_depth -= 1
+
+    def get_bind(self, mapper=None, clause=None):
+        if (self.replicas is None or self._primary_depth or self._flushing
+                or self.transaction is not None or not isinstance(clause, Selectable)):
+            return Session.get_bind(self, mapper, clause)
+        return self.replicas.select()
+
+
 class Connection(object):
     """Initialises a Connection object which holds all parameters to create engines and sessions.
 
     Additional options for the `sessionmaker` or `create_engine` functions may be passed as a dict
-    in `session_opts` and `engine_opts`.
+    in `session_opts` and `engine_opts`. The size of the connection pool is configured with the
+    `create_engine` options ``pool_size``, ``max_overflow``, ``pool_recycle`` and ``pool_timeout``.
+    (The SQLite pools do not accept all of them.)
+
+    ``Connection.session`` is a single session which the `Mapper` uses and which must not be
+    shared between threads. A thread (or process) of its own should use a session of its own, e.g.
+    from ``connection.Session.session_factory(bind=connection.engine)``. The engine and its
+    connection pool are thread-safe. After a fork, the child process must call
+    `dispose_after_fork` before it uses the connection.
+
+    With `replicas`, the sessions send reads outside of transactions to a
+    read replica (see `RoutingSession`), e.g. the queries of ``Mapper.find_all``
+    or of reading data. Everything inside an `auto_session` (and thus
+    ``Mapper.save``, ``Mapper.delete`` and storing data) goes to the
+    primary database, as do the loads of attributes and relationships of
+    the entities in the session.
 
     Parameters
     ----------
@@ -86,6 +281,14 @@ class Connection(object):
         Key–value options to pass to the `sessionmaker()` function.
     engine_opts: dict, optional
         Key–value options to pass to the `create_engine()` function.
+    pool_pre_ping: bool, optional
+        Test every connection with a ``SELECT 1`` when it is taken from the
+        pool and replace it, if the database has closed it. (Defaults to ``False``.)
+    replicas: list of strings, optional
+        The URLs of read replicas of the database.
+    replica_selection: string, optional
+        How a replica is chosen for a read: ``"round_robin"`` (the default)
+        or ``"least_loaded"``. (See `ReplicaSet`.)
 
     Attributes
     ----------
@@ -93,10 +296,13 @@ class Connection(object):
         The constructed database URL.
     Session
         The SQLAlchemy session.
+    replicas
+        The `ReplicaSet` or None.
 
     """
 
-    def __init__(self, url=None, echo=False, check_empty=False, session_opts=None, engine_opts=None):
+    def __init__(self, url=None, echo=False, check_empty=False, session_opts=None, engine_opts=None,
+                 pool_pre_ping=False, replicas=None, replica_selection="round_robin"):
         self.url = url
 
         if session_opts is None:
@@ -109,11 +315,29 @@ class Connection(object):
 
         self._engine_opts = engine_opts
         self._engine_opts["echo"] = echo
-
-        self.Session = scoped_session(sessionmaker(autocommit=True, **session_opts))
+        self.pool_pre_ping = pool_pre_ping
+
+        if replicas:
+            engines = []
+            for replica_url in replicas:
+                engine = create_engine(replica_url, **self._engine_opts)
+                _check_engine(engine)
+                _guard_pool(engine, pool_pre_ping)
+                engines.append(engine)
+            self.replicas = ReplicaSet(engines, replica_selection)
+        else:
+            self.replicas = None
+
+        self.Session = scoped_session(sessionmaker(autocommit=True, class_=RoutingSession,
+                                                   replicas=self.replicas, **session_opts))
 
         self._session = None
         self._engine = None
+        # pools which have been replaced after a fork
+        self._parent_pools = []
+        # counts the calls of `drop_tables`, so that mappers can
+        # forget what they know about the contents of the tables
+        self.table_generation = 0
 
         if self.engine_name not in ALLOWED_ENGINES:
             raise ConfigurationError("%r is no supported engine. Supported engines are %s." %
@@ -148,6 +372,18 @@ class Connection(object):
             [demo]
             # url syntax for sqlite in-memory db
             url = sqlite://
+            [server]
+            url = postgresql://hannah@localhost/xdapy
+            # connection pool settings
+            pool_size = 10
+            max_overflow = 20
+            pool_recycle = 3600
+            pool_timeout = 30
+            pool_pre_ping = true
+            # read replicas
+            replicas = postgresql://hannah@replica1/xdapy
+                       postgresql://hannah@replica2/xdapy
+            replica_selection = least_loaded
 
         The test section may be left blank, in which case a sqlite in-memory database
         will be used.
@@ -200,6 +436,8 @@ class Connection(object):
                 if options["url"] == main_options["url"]:
                     raise ConfigurationError("Please use a different test db for testing.")
 
+        if "engine_opts" in kwargs and "engine_opts" in options:
+            options["engine_opts"].update(kwargs.pop("engine_opts"))
         options.update(**kwargs)
 
         return cls(**options)
@@ -256,6 +494,20 @@ class Connection(object):
         if self.session.is_active:
             self.session.commit()
 
+    @property
+    def use_primary(self):
+        """
+        For use in a ``with`` context. Sends all statements of the session
+        to the primary database, even reads outside of a transaction. (This
+        only matters, if there are `replicas`.)
+
+        Usage::
+
+            with connection.use_primary:
+                entity = mapper.find_by_unique_id(unique_id)
+        """
+        return self.session.use_primary()
+
     @property
     def session(self):
         """
@@ -269,8 +521,40 @@ class Connection(object):
     def engine(self):
         if not self._engine:
             self._engine = create_engine(self.url, **self._engine_opts)
+            _guard_pool(self._engine, self.pool_pre_ping)
         return self._engine
 
+    def dispose_after_fork(self):
+        """
+        Prepares the connection for the use in a forked child process.
+
+        The connections in the pool are shared with the parent process.
+        They are put aside (without being closed, which would also close
+        them for the parent) and the session is discarded, so that the
+        child opens connections of its own. Call this first thing in the child::
+
+            pid = os.fork()
+            if pid == 0:
+                connection.dispose_after_fork()
+
+        (Connections of the parent which are still checked out are never
+        reused in the child.)
+
+        Note that an in-memory SQLite database does not survive this.
+        The new session maintains the closure table if the old one did.
+        """
+        maintained = self._session is not None and closure.is_maintained(self._session)
+        self._session = None
+        self.Session.registry.clear()
+        engines = [self._engine] if self._engine is not None else []
+        if self.replicas is not None:
+            engines.extend(self.replicas.engines)
+        for engine in engines:
+            self._parent_pools.append(engine.pool)
+            engine.pool = engine.pool.recreate()
+        if maintained:
+            closure.maintain(self.session)
+
     @property
     def engine_name(self):
         return self.engine.name
@@ -303,6 +587,27 @@ class Connection(object):
         Drops all xdapy tables.
         """
         Base.metadata.drop_all(bind=self.engine)
+        self.table_generation += 1
+
+    def upgrade_tables(self):
+        """
+        Upgrades the tables of a database which has been created by an
+        older version of xdapy, so that its data can be read.
+
+        Databases from before the deduplication of data chunks keep
+        the content of a chunk in the chunk row. It is moved to the
+        ``data_blobs`` table. (See `xdapy.data.upgrade_chunks`.)
+        Missing tables are created. Up-to-date tables are not changed.
+
+        Returns
+        -------
+        chunks: int
+            The number of converted chunks.
+        """
+        with self.engine.begin() as connection:
+            chunks = upgrade_chunks(connection)
+        self.create_tables(check_empty=False)
+        return chunks
 
     def __repr__(self):
         return "Connection(url=%r)" % self.url
@@ -9,8 +9,19 @@ __docformat__ = "restructuredtext"
 __authors__ = ['"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
 
 
+import bisect
+import bz2
 import collections
+import ast
+import functools
+import hashlib
+import mmap
+import os
 import tempfile
+import time
+import zlib
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 
 try:
     # check, if the faster version of StringIO is available
@@ -18,35 +29,212 @@ try:
 except ImportError:
     from StringIO import StringIO
 
-from sqlalchemy import Column, ForeignKey, String, Integer
+try:
+    import lzma
+except ImportError:
+    try:
+        # the backport for Python 2
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sqlalchemy import Column, ForeignKey, String, Integer, BigInteger, Float, event
 from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.schema import UniqueConstraint
-from sqlalchemy.orm import relationship, validates, synonym
+from sqlalchemy.sql import select, and_, or_, literal_column, bindparam
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.orm import relationship, validates, deferred
 from sqlalchemy.ext.declarative import synonym_for
 
 from sqlalchemy.types import LargeBinary
 
 from xdapy import Base
 from xdapy.errors import DataInconsistencyError
+from xdapy.utils.sql import InsertFromSelect
 
 
-#: The size in Byte of a data chunk.
+#: The default size in Byte of a data chunk.
 DATA_CHUNK_SIZE = 5 * 1000 * 1000 # Byte
 
+#: The largest chunk size which may be used.
+MAX_DATA_CHUNK_SIZE = 50 * 1000 * 1000 # Byte
+
+#: With ``chunk_size="auto"``, larger data is split into at most
+#: this many chunks (unless the chunks would exceed `MAX_DATA_CHUNK_SIZE`).
+ADAPTIVE_CHUNK_COUNT = 1000
+
+#: The database engines which can compute the SHA-256 checksums of the
+#: stored chunks themselves (``sha256()`` exists from PostgreSQL 11 on),
+#: so that `_DataProxy.verify` does not need to fetch the chunks.
+SERVER_HASH_ENGINES = set(["postgresql"])
+
+#: The mimetype of data which has been stored with `_DataProxy.put_array`.
+ARRAY_MIMETYPE = "application/x-numpy-array"
+
 #: The size of the database column which stores a chunk.
-#: This must be greater or equal than `DATA_CHUNK_SIZE`.
-DATA_COLUMN_LENGTH = DATA_CHUNK_SIZE
+#: This must be greater or equal than `MAX_DATA_CHUNK_SIZE`.
+DATA_COLUMN_LENGTH = MAX_DATA_CHUNK_SIZE
+
+#: The number of chunks which `_DataProxy.put_file` looks up and flushes at once.
+DATA_FLUSH_INTERVAL = 10
+
+#: The time in seconds for which `collect_garbage` keeps an unreferenced
+#: blob after its creation. Blobs are inserted (and, when uploaded in
+#: parallel, committed) before the chunks which reference them; a blob
+#: which is younger than this may belong to an upload in progress.
+BLOB_GRACE_PERIOD = 24 * 60 * 60 # seconds
+
+#: The number of decoded chunks which a `_DataReader` keeps in memory.
+DATA_CACHE_SIZE = 4
+
+#: The database engines for which `_DataProxy.put_file` and `_DataProxy.get`
+#: may use several connections in parallel.
+PARALLEL_ENGINES = set(["postgresql"])
+
+def _identity(chunk):
+    return chunk
+
+#: The available compression codecs as ``(compress, decompress)`` functions.
+#: Every chunk is compressed on its own.
+CODECS = {
+    "none": (_identity, _identity),
+    "zlib": (zlib.compress, zlib.decompress),
+    "bz2": (bz2.compress, bz2.decompress),
+}
+if lzma is not None:
+    CODECS["lzma"] = (lzma.compress, lzma.decompress)
+
+def _codec(compression):
+    """ Returns the ``(compress, decompress)`` functions for `compression`.
+
+    Raises
+    ------
+    ValueError
+        If the codec is unknown or (in case of lzma) not installed.
+    """
+    if compression is None:
+        compression = "none"
+    try:
+        return CODECS[compression]
+    except KeyError:
+        if compression == "lzma":
+            raise ValueError("Compression 'lzma' needs the lzma module (backports.lzma on Python 2).")
+        raise ValueError("Unknown compression '{0}'. Must be one of {1}."
+                         .format(compression, ", ".join(sorted(CODECS))))
+
+def adaptive_chunk_size(size):
+    """ Returns a chunk size for data of `size` bytes.
+
+    Data up to `DATA_CHUNK_SIZE` is stored in a single chunk of its own
+    size. Larger data uses chunks of `DATA_CHUNK_SIZE` as long as there are
+    no more than `ADAPTIVE_CHUNK_COUNT` of them, and bigger chunks (up to
+    `MAX_DATA_CHUNK_SIZE`) otherwise.
+    """
+    if size <= DATA_CHUNK_SIZE:
+        return max(size, 1)
+    per_chunk = -(-size // ADAPTIVE_CHUNK_COUNT) # rounded up
+    return min(max(per_chunk, DATA_CHUNK_SIZE), MAX_DATA_CHUNK_SIZE)
+
+def _remaining_size(fileish):
+    """ Returns the number of bytes between the current position and the
+    end of a file, or None, if this cannot be determined.
+    """
+    try:
+        return os.fstat(fileish.fileno()).st_size - fileish.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    try:
+        position = fileish.tell()
+        fileish.seek(0, os.SEEK_END)
+        end = fileish.tell()
+        fileish.seek(position)
+        return end - position
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+def _chunk_size_for(chunk_size, fileish):
+    """ Resolves the `chunk_size` argument of `_DataProxy.put_file`."""
+    if chunk_size is None:
+        return DATA_CHUNK_SIZE
+    if chunk_size == "auto":
+        size = _remaining_size(fileish)
+        if size is None:
+            return DATA_CHUNK_SIZE
+        return adaptive_chunk_size(size)
+    if not isinstance(chunk_size, (int, long)) or not 0 < chunk_size <= MAX_DATA_CHUNK_SIZE:
+        raise ValueError("chunk_size must be 'auto' or an integer between 1 and {0}."
+                         .format(MAX_DATA_CHUNK_SIZE))
+    return chunk_size
+
+def chunk_hash(chunk):
+    """ Returns the content hash (SHA-256, hex) by which a stored chunk is identified."""
+    return hashlib.sha256(chunk).hexdigest()
+
+class DataBlob(Base):
+    """The content of a data chunk. Each distinct content is stored only once
+    and may be referenced by any number of `DataChunks`.
+
+    Parameters
+    ----------
+    blob: data
+        The (possibly compressed) bytes to be stored.
+    """
+
+    hash = Column('hash', String(64), primary_key=True,
+            doc="The content hash of the blob. (See `chunk_hash`.)")
+
+    # deferred, so that we can look up blobs without loading their content
+    _blob = deferred(Column('data', LargeBinary(DATA_COLUMN_LENGTH), nullable=False,
+            doc="The binary chunk data. Size is specified in `DATA_COLUMN_LENGTH`."))
+
+    length = Column('length', Integer,
+            doc="The length of the blob.")
+
+    refcount = Column('refcount', Integer, nullable=False, default=0,
+            doc="The number of `DataChunks` which reference the blob.")
+
+    created = Column('created', Float, default=time.time,
+            doc="The time (seconds since the epoch) at which the blob has been inserted. (See `BLOB_GRACE_PERIOD`.)")
+
+    __tablename__ = 'data_blobs'
+
+    def __init__(self, blob):
+        if not isinstance(blob, basestring): # TODO what about real binary?
+            raise ValueError("Data must be a string")
+        self.hash = chunk_hash(blob)
+        self._blob = blob
+        self.length = len(blob)
+        self.refcount = 0
+
+    @property
+    def blob(self):
+        """ Accessor property for the binary data."""
+        return self._blob
+
+    def __repr__(self):
+        return "<DataBlob {0}, length {1}, refcount {2}>".format(self.hash[:12], self.length, self.refcount)
 
 class DataChunks(Base):
-    """Data are divided into smaller chunks of size `DATA_CHUNK_SIZE` to avoid
+    """Data are divided into smaller chunks (of size `Data.chunk_size`) to avoid
     that everything is loaded all at once when accessing the data.
 
+    The content of the chunk lives in a `DataBlob`, which is shared between
+    all chunks with the same content.
+
     Parameters
     ----------
     index: integer
         The numeric index of this data chunk.
-    chunk: data
-        The data to be stored.
+    blob: DataBlob
+        The content of this chunk.
+    uncompressed_length: integer, optional
+        The length of the content before compression.
     """
 
     id = Column('id', Integer, autoincrement=True, primary_key=True,
@@ -56,24 +244,14 @@ class DataChunks(Base):
     index = Column("index", Integer,
             doc="The index of the data chunk. Used to keep the correct order of chunks.")
 
-    # hide the raw value in order to allow for a specific setter method
-    _chunk = Column('data', LargeBinary(DATA_COLUMN_LENGTH), nullable=False,
-            doc="The binary chunk data. Size is specified in `DATA_COLUMN_LENGTH`.")
+    blob_hash = Column('blob_hash', String(64), ForeignKey('data_blobs.hash'), nullable=False, index=True,
+            doc="Foreign key reference to `DataBlob.hash`.")
+    blob = relationship(DataBlob)
 
     @property
     def chunk(self):
         """ Accessor property for the binary data chunk."""
-        return self._chunk
-
-    @chunk.setter
-    def chunk(self, chunk):
-        # we also set the _length here
-        if not isinstance(chunk, basestring): # TODO what about real binary?
-            raise ValueError("Data must be a string")
-        self._chunk = chunk
-        self._length = len(chunk)
-
-    chunk = synonym('_chunk', descriptor=chunk)
+        return self.blob.blob
 
     _length = Column('length', Integer,
             doc="The length of the data chunk.")
@@ -84,16 +262,187 @@ class DataChunks(Base):
         """ Getter property for the data chunk length."""
         return self._length
 
+    uncompressed_length = Column('uncompressed_length', Integer,
+            doc="The length of the data chunk before compression.")
+
     __tablename__ = 'data_chunks'
     __table_args__ = (UniqueConstraint(data_id, index), {})
 
-    def __init__(self, index, chunk):
+    def __init__(self, index, blob, uncompressed_length=None):
         self.index = index
-        self.chunk = chunk
+        self.blob = blob
+        self._length = blob.length
+        if uncompressed_length is None:
+            uncompressed_length = self.length
+        self.uncompressed_length = uncompressed_length
 
     def __repr__(self):
         return "<DataChunk #{0} for Data[{1}], length {2}>".format(self.index, self.data_id, self.length)
 
+
+def _update_refcount(connection, blob_hash, increment):
+    blobs = DataBlob.__table__
+    connection.execute(blobs.update()
+                            .where(blobs.c.hash == blob_hash)
+                            .values(refcount=blobs.c.refcount + increment))
+
+@event.listens_for(DataChunks, "after_insert")
+def _increase_refcount(mapper, connection, target):
+    _update_refcount(connection, target.blob_hash, 1)
+
+@event.listens_for(DataChunks, "after_delete")
+def _decrease_refcount(mapper, connection, target):
+    _update_refcount(connection, target.blob_hash, -1)
+
+
+def _change_references(connection, data_id, increment):
+    """ Adds `increment` times the number of chunks of the data `data_id`
+    which reference a blob to the reference count of that blob.
+    (For chunks which have been written or deleted without the ORM.)
+    """
+    blobs = DataBlob.__table__
+    chunks = DataChunks.__table__
+    # the id is inlined (cf. `xdapy.structures.BaseEntity._hierarchy`)
+    data_id = literal_column(str(int(data_id)))
+    references = (select([func.count(chunks.c.id)])
+                    .where(and_(chunks.c.data_id == data_id, chunks.c.blob_hash == blobs.c.hash))
+                    .as_scalar())
+    connection.execute(blobs.update()
+                            .where(blobs.c.hash.in_(select([chunks.c.blob_hash], chunks.c.data_id == data_id)))
+                            .values(refcount=blobs.c.refcount + increment * references))
+
+def _find_blobs(session, hashes):
+    """ Returns a dict with the `DataBlob`\s (without their content) for
+    those of `hashes` which exist. Pending objects are not flushed.
+    """
+    hashes = list(hashes)
+    found = {}
+    with session.no_autoflush:
+        for start in range(0, len(hashes), 500):
+            for blob in session.query(DataBlob).filter(DataBlob.hash.in_(hashes[start:start + 500])):
+                found[blob.hash] = blob
+    return found
+
+def _insert_blobs(session, stored):
+    """ Inserts blobs for the contents `stored` (a dict which maps the
+    hashes to the contents) with a single executemany.
+
+    Another writer may insert the same content concurrently. Such a blob
+    is skipped. (On PostgreSQL, each insert then gets a savepoint, so that
+    a surrounding transaction survives the failed one.)
+    """
+    blobs = DataBlob.__table__
+    created = time.time()
+    rows = [{"hash": blob_hash, "data": content, "length": len(content), "refcount": 0, "created": created}
+            for blob_hash, content in sorted(stored.iteritems())]
+
+    def insert(rows):
+        if session.transaction is not None and session.bind.name == "postgresql":
+            nested = session.begin_nested()
+            try:
+                session.execute(blobs.insert(), rows)
+            except IntegrityError:
+                nested.rollback()
+                raise
+            nested.commit()
+        else:
+            session.execute(blobs.insert(), rows)
+
+    try:
+        insert(rows)
+    except IntegrityError:
+        for row in rows:
+            try:
+                insert(row)
+            except IntegrityError:
+                # the blob has just been inserted by somebody else
+                pass
+
+def _same_database(session, other):
+    """ Returns true, if both sessions are bound to the same database.
+    (Different SQLite in-memory databases never are.)
+    """
+    if session is other:
+        return True
+    url, other_url = session.bind.url, other.bind.url
+    return url == other_url and url.database not in (None, "", ":memory:")
+
+def collect_garbage(session, grace_period=None):
+    """ Deletes all `DataBlob`\s which are not referenced by any chunk
+    and corrects the reference counts of the others.
+
+    Unreferenced blobs which have been created within the last
+    `grace_period` seconds are kept, because an upload which is still
+    in progress may not have stored the chunks for them yet.
+
+    Parameters
+    ----------
+    session
+        The session to use.
+    grace_period: number, optional
+        The minimal age in seconds of a blob to be deleted.
+        (Defaults to `BLOB_GRACE_PERIOD`.)
+
+    Returns
+    -------
+    stats: dict
+        The number of deleted ``blobs`` and the number of ``bytes`` freed.
+    """
+    blobs = DataBlob.__table__
+    chunks = DataChunks.__table__
+
+    session.flush()
+    references = (select([func.count(chunks.c.id)])
+                    .where(chunks.c.blob_hash == blobs.c.hash)
+                    .as_scalar())
+    session.execute(blobs.update().values(refcount=references))
+
+    if grace_period is None:
+        grace_period = BLOB_GRACE_PERIOD
+    # blobs from before the `created` column count as old
+    orphaned = and_(blobs.c.refcount == 0,
+                    or_(blobs.c.created == None, blobs.c.created <= time.time() - grace_period))
+    count, freed = session.execute(select([func.count(blobs.c.hash), func.sum(blobs.c.length)])
+                                     .where(orphaned)).first()
+    session.execute(blobs.delete().where(orphaned))
+    return {"blobs": count, "bytes": freed or 0}
+
+def dedup_stats(session):
+    """ Returns statistics about the deduplication of data chunks.
+
+    Parameters
+    ----------
+    session
+        The session to use.
+
+    Returns
+    -------
+    stats: dict
+        ``chunks`` and ``blobs``
+            The number of `DataChunks` and `DataBlob` rows.
+        ``referenced_bytes``
+            The size of all chunks, as it would be without deduplication.
+        ``stored_bytes``
+            The size of all blobs, as it is stored.
+        ``orphaned_blobs``
+            The number of blobs which wait for `collect_garbage`.
+        ``dedup_ratio``
+            ``referenced_bytes / stored_bytes`` (or 1.0, if nothing is stored).
+    """
+    session.flush()
+    chunks, referenced = session.query(func.count(DataChunks.id), func.sum(DataChunks.length)).one()
+    blobs, stored = session.query(func.count(DataBlob.hash), func.sum(DataBlob.length)).one()
+    orphaned = session.query(func.count(DataBlob.hash)).filter(DataBlob.refcount == 0).scalar()
+
+    referenced = referenced or 0
+    stored = stored or 0
+    return {"chunks": chunks,
+            "blobs": blobs,
+            "referenced_bytes": referenced,
+            "stored_bytes": stored,
+            "orphaned_blobs": orphaned,
+            "dedup_ratio": float(referenced) / stored if stored else 1.0}
+
 class Data(Base):
     """
     The class `Data` is mapped on the table 'data'. The name assigned to Data
@@ -105,6 +454,22 @@ class Data(Base):
     entity_id = Column(Integer, ForeignKey('entities.id'), nullable=False)
     key = Column('key', String(40))
     mimetype = Column('mimetype', String(40))
+    compression = Column('compression', String(20),
+            doc="The codec which the chunks are compressed with. (See `CODECS`.)")
+    chunk_size = Column('chunk_size', Integer,
+            doc="The (uncompressed) size of the chunks which the data has been written with.")
+    array_dtype = Column('array_dtype', String(500),
+            doc="The dtype of an array stored with `_DataProxy.put_array`.")
+    array_shape = Column('array_shape', String(200),
+            doc="The comma-separated shape of the stored array.")
+    array_order = Column('array_order', String(1),
+            doc="The memory layout (``'C'`` or ``'F'``) of the stored array.")
+    length = Column('length', BigInteger,
+            doc="The total (uncompressed) length of the chunks, updated when the data is written.")
+    stored_length = Column('stored_length', BigInteger,
+            doc="The total stored (compressed) length of the chunks.")
+    chunk_count = Column('chunk_count', Integer,
+            doc="The number of chunks.")
 
     _chunks = relationship(DataChunks, cascade="all, delete-orphan")
 
@@ -120,6 +485,277 @@ class Data(Base):
     def __repr__(self):
         return "<%s('%s', %r, %s)>" % (self.__class__.__name__, self.key, self.mimetype, self.entity_id)
 
+def upgrade_chunks(connection, batch_size=100):
+    """ Converts the data of a database which has been created before
+    chunks were stored as `DataBlob`\s (when the content was in the column
+    ``data_chunks.data``).
+
+    The ``data_blobs`` table and the missing columns of ``data`` and
+    ``data_chunks`` are created, the content of every chunk is moved to
+    a (deduplicated) blob, the old column is dropped and the reference
+    counts are set. The chunks are converted `batch_size` at a time.
+    An interrupted upgrade may be run again; an upgraded database is not
+    changed. (On SQLite, at least version 3.35 is needed to drop the column.)
+
+    Parameters
+    ----------
+    connection
+        A SQLAlchemy connection to execute the statements with.
+    batch_size: int, optional
+        The number of chunks which are converted at once.
+
+    Returns
+    -------
+    chunks: int
+        The number of converted chunks.
+    """
+    blobs = DataBlob.__table__
+    chunks = DataChunks.__table__
+    dialect = connection.dialect
+    quote = lambda name: dialect.identifier_preparer.quote(name, None)
+
+    inspector = Inspector.from_engine(connection)
+    if "data" not in [column["name"] for column in inspector.get_columns(chunks.name)]:
+        return 0
+
+    blobs.create(connection, checkfirst=True)
+    for table in (Data.__table__, chunks):
+        existing = set(column["name"] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            # added without NOT NULL, as the existing rows have no value yet
+            definition = "{0} {1}".format(quote(column.name), column.type.compile(dialect=dialect))
+            for foreign_key in column.foreign_keys:
+                definition += " REFERENCES {0} ({1})".format(quote(foreign_key.column.table.name),
+                                                            quote(foreign_key.column.name))
+            connection.execute("ALTER TABLE {0} ADD COLUMN {1}".format(quote(table.name), definition))
+            for index in table.indexes:
+                if column.name in index.columns:
+                    index.create(connection)
+
+    content = literal_column(quote("data"))
+    pending = (select([chunks.c.id, content], chunks.c.blob_hash == None)
+                 .order_by(chunks.c.id).limit(batch_size))
+    link = (chunks.update().where(chunks.c.id == bindparam("chunk_id"))
+                  .values(blob_hash=bindparam("hash"), uncompressed_length=chunks.c.length))
+    converted = 0
+    while True:
+        rows = connection.execute(pending).fetchall()
+        if not rows:
+            break
+        stored = dict((chunk_hash(row[1]), row[1]) for row in rows)
+        found = set(row[0] for row in connection.execute(
+                        select([blobs.c.hash], blobs.c.hash.in_(list(stored)))))
+        created = time.time()
+        missing = [{"hash": blob_hash, "data": chunk, "length": len(chunk), "refcount": 0, "created": created}
+                   for blob_hash, chunk in sorted(stored.iteritems()) if blob_hash not in found]
+        if missing:
+            connection.execute(blobs.insert(), missing)
+        connection.execute(link, [{"chunk_id": row[0], "hash": chunk_hash(row[1])} for row in rows])
+        converted += len(rows)
+
+    connection.execute("ALTER TABLE {0} DROP COLUMN {1}".format(quote(chunks.name), quote("data")))
+    if dialect.name == "postgresql":
+        connection.execute("ALTER TABLE {0} ALTER COLUMN {1} SET NOT NULL".format(quote(chunks.name), quote("blob_hash")))
+
+    references = (select([func.count(chunks.c.id)])
+                    .where(chunks.c.blob_hash == blobs.c.hash)
+                    .as_scalar())
+    connection.execute(blobs.update().values(refcount=references))
+    return converted
+
+def data_summary(session, entity_ids):
+    """ Returns the key, mimetype, size and number of chunks of all data
+    of the given entities.
+
+    The values are read from the data rows with a single query. (Only
+    data which has been written before the sizes were recorded needs one
+    additional aggregate query.)
+
+    Parameters
+    ----------
+    session
+        The session to query with.
+    entity_ids: list
+        The ids of the entities.
+
+    Returns
+    -------
+    summary: dict
+        For every entity id, a dict which maps each data key to a dict with
+        the items ``mimetype``, ``size``, ``stored_size`` and ``chunks``.
+    """
+    entity_ids = list(entity_ids)
+    summary = dict((entity_id, {}) for entity_id in entity_ids)
+    if not entity_ids:
+        return summary
+
+    unrecorded = {}
+    rows = (session.query(Data.id, Data.entity_id, Data.key, Data.mimetype,
+                          Data.length, Data.stored_length, Data.chunk_count)
+                   .filter(Data.entity_id.in_(entity_ids)))
+    for row in rows:
+        item = {"mimetype": row.mimetype, "size": row.length,
+                "stored_size": row.stored_length, "chunks": row.chunk_count}
+        summary[row.entity_id][row.key] = item
+        if row.chunk_count is None:
+            unrecorded[row.id] = item
+
+    if unrecorded:
+        totals = (session.query(DataChunks.data_id, func.count(DataChunks.id),
+                                func.sum(func.coalesce(DataChunks.uncompressed_length, DataChunks.length)),
+                                func.sum(DataChunks.length))
+                         .filter(DataChunks.data_id.in_(unrecorded.keys()))
+                         .group_by(DataChunks.data_id))
+        for item in unrecorded.values():
+            item.update(chunks=0, size=None, stored_size=None)
+        for data_id, chunks, size, stored_size in totals:
+            unrecorded[data_id].update(chunks=chunks, size=size, stored_size=stored_size)
+    return summary
+
+def _ordered_map(pool, func, iterable, window):
+    """ Like ``pool.imap(func, iterable)`` but with at most `window` pending
+    results, so that a slow consumer does not make the results pile up.
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def _upload_blob(engine, compression, raw):
+    """ Compresses `raw` and inserts it as a blob on a connection of its own,
+    unless a blob with the same content exists already.
+
+    Returns
+    -------
+    (hash, length): tuple
+        The hash of the blob and the uncompressed length.
+    """
+    compress, _ = _codec(compression)
+    stored = compress(raw)
+    blob_hash = chunk_hash(stored)
+    blobs = DataBlob.__table__
+
+    connection = engine.connect()
+    try:
+        exists = connection.execute(select([blobs.c.hash]).where(blobs.c.hash == blob_hash)).first()
+        if not exists:
+            try:
+                connection.execute(blobs.insert(), hash=blob_hash, data=stored, length=len(stored),
+                                   refcount=0, created=time.time())
+            except IntegrityError:
+                # another thread or process has just inserted the same content
+                pass
+    finally:
+        connection.close()
+    return blob_hash, len(raw)
+
+def _download_blob(engine, decompress, blob_hash):
+    """ Fetches and decompresses a blob on a connection of its own."""
+    blobs = DataBlob.__table__
+    connection = engine.connect()
+    try:
+        stored = connection.execute(select([blobs.c.data]).where(blobs.c.hash == blob_hash)).scalar()
+    finally:
+        connection.close()
+    return decompress(stored)
+
+
+def _chunk_layout(session, data_id):
+    """ Returns the indices of the chunks of a data object, the (uncompressed)
+    offsets at which they start and the total length.
+    """
+    indices = []
+    starts = []
+    position = 0
+    layout = (session.query(DataChunks.index, DataChunks.length, DataChunks.uncompressed_length)
+                     .filter(DataChunks.data_id == data_id)
+                     .order_by(DataChunks.index))
+    for chunk in layout:
+        indices.append(chunk.index)
+        starts.append(position)
+        if chunk.uncompressed_length is not None:
+            position += chunk.uncompressed_length
+        else:
+            position += chunk.length
+    return indices, starts, position
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("NumPy is needed for storing arrays.")
+
+def _dtype_to_string(dtype):
+    """ Returns a string from which `_dtype_from_string` re-creates `dtype`."""
+    if dtype.fields is None:
+        return dtype.str
+    return repr(dtype.descr)
+
+def _dtype_from_string(string):
+    if string.startswith("["):
+        # a structured dtype
+        return numpy.dtype(ast.literal_eval(string))
+    return numpy.dtype(string)
+
+def _copy_array_info(source, target):
+    """ Copies the array metadata from one `Data` object to another."""
+    target.array_dtype = source.array_dtype
+    target.array_shape = source.array_shape
+    target.array_order = source.array_order
+
+
+class _ArrayFile(object):
+    """ A read-only file-like object over the raw buffer of a contiguous array.
+
+    Each `read` copies only the requested bytes, so that an array may be
+    given to `_DataProxy.put_file` without creating a copy of the whole buffer.
+    """
+    def __init__(self, array, order):
+        # a flat byte view on the memory of the array (no copy)
+        self._bytes = array.reshape(-1, order=order).view(numpy.uint8)
+        self._position = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = len(self._bytes)
+        else:
+            end = self._position + size
+        piece = self._bytes[self._position:end].tostring()
+        self._position += len(piece)
+        return piece
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += len(self._bytes)
+        self._position = offset
+
+
+def _on_primary(method):
+    """ Sends all statements of a `_DataProxy` or `_DataAssoc` method to the
+    primary database, also the reads outside of transactions (see
+    `xdapy.connection.RoutingSession`), so that writes never depend on a
+    read replica which lags behind.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        owning = self.owning if isinstance(self, _DataAssoc) else self.assoc.owning
+        use_primary = getattr(owning._session(), "use_primary", None)
+        if use_primary is None:
+            return method(self, *args, **kwargs)
+        with use_primary():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class _DataProxy(object):
     """
     The `_DataProxy` class acts as a convenience wrapper to the more low-level `Data` class,
@@ -174,6 +810,17 @@ class _DataProxy(object):
     def mimetype(self):
         self.get_data().mimetype = None
 
+    @property
+    def compression(self):
+        """Return the compression codec of the related data object."""
+        return self.get_data().compression or "none"
+
+    @property
+    def chunk_size(self):
+        """Return the chunk size which the data has been written with.
+        (None for data written before the size was recorded.)"""
+        return self.get_data().chunk_size
+
     def has_data(self):
         """ Returns true if data is associated.
         """
@@ -209,6 +856,7 @@ class _DataProxy(object):
         """
         return [chunk.index for chunk in self._chunk_query(DataChunks.index)]
 
+    @_on_primary
     def delete(self):
         """ Deletes all referenced data for `self.key`.
         """
@@ -216,6 +864,7 @@ class _DataProxy(object):
         self.__session.delete(data)
         self.__session.flush()
 
+    @_on_primary
     def clear_data(self):
         """ Clears all data chunks for `self.key`. (But keeps the data reference intact.)
         """
@@ -223,8 +872,10 @@ class _DataProxy(object):
         for ch in data._chunks:
             self.__session.delete(ch)
             self.__session.flush()
+        data.length = data.stored_length = data.chunk_count = 0
 
-    def put(self, file_or_str, mimetype=None):
+    @_on_primary
+    def put(self, file_or_str, mimetype=None, compression=None, workers=None, chunk_size=None, resume=False):
         """ Store data from a file or a string object.
 
         Parameters
@@ -233,60 +884,264 @@ class _DataProxy(object):
             Either a file which can be read or
         mimetype: string, optional
             A mimetime to define the type of the data
+        compression: string, optional
+            The codec to compress the data with: One of ``"none"`` (the
+            default), ``"zlib"``, ``"bz2"`` or ``"lzma"``.
+        workers: int, optional
+            The number of threads which compress and upload chunks in
+            parallel. (See `put_file`.)
+        chunk_size: int or ``"auto"``, optional
+            The size of the chunks. (See `put_file`.)
+        resume: bool, optional
+            Continue an interrupted upload of a file. (See `put_file`.)
         """
         if isinstance(file_or_str, basestring):
-            self.put_string(file_or_str)
+            self.put_string(file_or_str, compression, workers, chunk_size)
         else:
-            self.put_file(file_or_str)
+            self.put_file(file_or_str, compression, workers, chunk_size, resume)
         if mimetype:
             self.mimetype = mimetype
 
-    def put_string(self, string):
+    @_on_primary
+    def put_string(self, string, compression=None, workers=None, chunk_size=None):
         """ Explicitly stores data from a string object.
 
         Parameters
         ----------
         string: string
             The data string to be stored.
+        compression: string, optional
+            The codec to compress the data with. (See `put`.)
+        workers: int, optional
+            The number of upload threads. (See `put_file`.)
+        chunk_size: int or ``"auto"``, optional
+            The size of the chunks. (See `put_file`.)
         """
         string = StringIO(string)
         try:
-            self.put_file(string)
+            self.put_file(string, compression, workers, chunk_size)
         finally:
             string.close()
 
-    def put_file(self, fileish):
+    @_on_primary
+    def put_file(self, fileish, compression=None, workers=None, chunk_size=None, resume=False):
         """ Explicitly stores data from a file-like object.
 
         Parameters
         ----------
         fileish: file-like object (must have `read` attribute)
             The file object which contains the data to be stored.
+        compression: string, optional
+            The codec to compress the data with. (See `put`.)
+        workers: int, optional
+            If greater than one and the database engine is in
+            `PARALLEL_ENGINES`, the chunks are compressed and their blobs
+            are inserted by that many threads, each with its own database
+            connection. The chunk rows, which make the data visible, are
+            still written in the session, so the data appears atomically
+            with the session’s commit. Blobs of a failed upload are left
+            behind unreferenced until `collect_garbage` (after
+            `BLOB_GRACE_PERIOD`).
+        chunk_size: int or ``"auto"``, optional
+            The number of (uncompressed) bytes per chunk. With ``"auto"``,
+            the size is chosen from the size of the file by
+            `adaptive_chunk_size`. (Defaults to `DATA_CHUNK_SIZE`.)
+            The size is stored with the data; readers handle data
+            of any chunk size.
+        resume: bool, optional
+            If true, an interrupted upload of the same file is continued
+            instead of starting from scratch: The chunks which have been
+            committed already are kept and the file is read from the end
+            of the last of them. The skipped part of the file is compared
+            with the checksums of these chunks. The compression and chunk
+            size of the stored data are used. (Defaults to ``False``.)
+
+        Raises
+        ------
+        DataInconsistencyError
+            When resuming, if the stored chunks have gaps or do not match the file.
         """
         if not hasattr(fileish, 'read'):
             # if there is no 'read' method, is is
             # probably the wrong type
             raise ValueError("Unassignable Type")
 
-        data = self.get_or_create_data()
-        self.clear_data()
+        compress, _ = _codec(compression)
 
-        buffer_size = DATA_CHUNK_SIZE
-        idx = 0
+        if resume and self.has_data():
+            data = self.get_data()
+            compression, buffer_size = self._resume_options(data, compression, chunk_size)
+            compress, _ = _codec(compression)
+            idx = self._skip_stored_chunks(fileish, data, compress)
+        else:
+            buffer_size = _chunk_size_for(chunk_size, fileish)
+
+            data = self.get_or_create_data()
+            self.clear_data()
+            data.compression = compression or "none"
+            data.chunk_size = buffer_size
+            data.array_dtype = data.array_shape = data.array_order = None
+            idx = 0
+
+        if self._parallel(workers):
+            self._put_file_parallel(fileish, data, compression, workers, buffer_size, idx + 1)
+            return
+
+        batch = []
+        for chunk in iter(lambda: fileish.read(buffer_size), ""):
+            batch.append(chunk)
+            if len(batch) == DATA_FLUSH_INTERVAL:
+                idx = self._store_chunks(data, batch, compress, idx)
+                batch = []
+        if batch:
+            self._store_chunks(data, batch, compress, idx)
 
-        chunk = fileish.read(buffer_size)
+        self.__session.flush()
+        self._store_summary(data)
 
-        while chunk:
+    def _resume_options(self, data, compression, chunk_size):
+        """ Returns the compression and chunk size of the data which is
+        to be resumed and checks that they do not contradict the arguments.
+        """
+        stored_compression = data.compression or "none"
+        if compression is not None and compression != stored_compression:
+            raise ValueError("Cannot resume data compressed with '{0}' using '{1}'."
+                             .format(stored_compression, compression))
+
+        stored_size = data.chunk_size or DATA_CHUNK_SIZE
+        if chunk_size not in (None, "auto", stored_size):
+            raise ValueError("Cannot resume data with chunk size {0} using {1}."
+                             .format(stored_size, chunk_size))
+        return stored_compression, stored_size
+
+    def _skip_stored_chunks(self, fileish, data, compress):
+        """ Reads the part of `fileish` which is already stored in the chunks
+        of `data` and compares it with their checksums.
+
+        Returns
+        -------
+        index: int
+            The index of the last stored chunk (0, if there is none).
+        """
+        stored = (self.__session.query(DataChunks.index, DataChunks.length,
+                                       DataChunks.uncompressed_length, DataChunks.blob_hash)
+                                .filter(DataChunks.data_id == data.id)
+                                .order_by(DataChunks.index))
+        idx = 0
+        for chunk in stored:
             idx += 1
-            chunk = DataChunks(idx, chunk)
-            data._chunks.append(chunk)
+            if chunk.index != idx:
+                raise DataInconsistencyError("Cannot resume: chunk {0} is missing.".format(idx))
+
+            if chunk.uncompressed_length is not None:
+                raw = fileish.read(chunk.uncompressed_length)
+            else:
+                raw = fileish.read(chunk.length)
+            if chunk_hash(compress(raw)) != chunk.blob_hash:
+                raise DataInconsistencyError("Cannot resume: chunk {0} does not match the file.".format(idx))
+        return idx
+
+    def _store_summary(self, data):
+        """ Stores the length and the number of the chunks of `data` on the
+        data row, so that `size` and `chunks` need not aggregate the chunks.
+        """
+        summary = (self.__session.query(func.count(DataChunks.id),
+                                        func.sum(func.coalesce(DataChunks.uncompressed_length, DataChunks.length)),
+                                        func.sum(DataChunks.length))
+                                 .filter(DataChunks.data_id == data.id).one())
+        data.chunk_count = summary[0]
+        data.length = summary[1] or 0
+        data.stored_length = summary[2] or 0
+        self.__session.flush()
+
+    def _parallel(self, workers):
+        """ Returns true, if a transfer with `workers` threads should be parallel."""
+        return workers is not None and workers > 1 and self.__session.bind.name in PARALLEL_ENGINES
+
+    def _put_file_parallel(self, fileish, data, compression, workers, buffer_size, first_index=1):
+        engine = self.__session.bind
+        # (hash, uncompressed length) for each chunk
+        uploaded = []
+
+        pool = ThreadPool(workers)
+        try:
+            raw_chunks = iter(lambda: fileish.read(buffer_size), "")
+            for result in _ordered_map(pool, lambda raw: _upload_blob(engine, compression, raw),
+                                       raw_chunks, window=2 * workers):
+                uploaded.append(result)
+        finally:
+            pool.close()
+            pool.join()
 
-            chunk = fileish.read(buffer_size)
-            if idx % 10 == 0:
-                # we flush every now and then
-                self.__session.flush()
+        blobs = _find_blobs(self.__session, set(blob_hash for blob_hash, _ in uploaded))
 
+        chunks = [DataChunks(idx, blobs[blob_hash], length)
+                  for idx, (blob_hash, length) in enumerate(uploaded, first_index)]
+        data._chunks.extend(chunks)
         self.__session.flush()
+        self._store_summary(data)
+
+    def _store_chunks(self, data, raw_chunks, compress, idx):
+        """ Appends the chunks `raw_chunks` to `data` after the chunk `idx`
+        and flushes them. The blobs of the whole batch are looked up with
+        one query and the missing ones are inserted with one executemany.
+
+        Returns
+        -------
+        idx: int
+            The index of the last chunk.
+        """
+        session = self.__session
+        stored = [compress(raw) for raw in raw_chunks]
+        hashes = [chunk_hash(content) for content in stored]
+
+        blobs = _find_blobs(session, set(hashes))
+        missing = dict((blob_hash, content) for blob_hash, content in izip(hashes, stored)
+                       if blob_hash not in blobs)
+        if missing:
+            _insert_blobs(session, missing)
+            blobs.update(_find_blobs(session, missing))
+
+        for blob_hash, raw in izip(hashes, raw_chunks):
+            idx += 1
+            data._chunks.append(DataChunks(idx, blobs[blob_hash], len(raw)))
+        session.flush()
+        return idx
+
+    def _link_chunks(self, other):
+        """ Makes this data share the chunks of `other`, which must be stored
+        in the same database. The chunk rows are copied with an
+        ``INSERT ... SELECT`` and the reference counts of their blobs are
+        updated with a single ``UPDATE``, so that no chunk content leaves
+        the database.
+
+        If both are the same data row (e.g. seen from two sessions),
+        nothing is done, as clearing this data would delete the source.
+        """
+        source = other.get_data()
+        source_id = source.id
+        if self.has_data() and self.get_data().id == source_id:
+            return
+        data = self.get_or_create_data()
+        self.clear_data()
+        data.compression = source.compression
+        data.chunk_size = source.chunk_size
+        _copy_array_info(source, data)
+        self.__session.flush()
+
+        chunks = DataChunks.__table__
+        # the ids are inlined (cf. `xdapy.structures.BaseEntity._hierarchy`)
+        copied = select([literal_column(str(int(data.id))), chunks.c.index, chunks.c.blob_hash,
+                         chunks.c.length, chunks.c.uncompressed_length],
+                        chunks.c.data_id == literal_column(str(int(source_id))))
+
+        connection = self.__session.connection()
+        connection.execute(InsertFromSelect(chunks, ["data_id", "index", "blob_hash", "length", "uncompressed_length"], copied))
+        _change_references(connection, data.id, 1)
+
+        # the chunks have been inserted behind the back of the ORM
+        self.__session.expire(data, ["_chunks"])
+        self._store_summary(data)
 
     def _chunk_query(self, *entities, **kwargs):
         """ Returns a query which is restricted to data chunks with the
@@ -307,16 +1162,256 @@ class _DataProxy(object):
         # Version which uses a join each time
         # return self.__session.query(*entities, **kwargs).join(Data).filter(Data.entity_id==self.assoc.owning.id).filter(Data.key==self.key)
 
-    def get(self, fileish):
+    def get(self, fileish, workers=None):
         """ Stores the data content in a file.
 
         Parameters
         ----------
         fileish: file-like object
             The file to hold the data.
+        workers: int, optional
+            If greater than one and the database engine is in
+            `PARALLEL_ENGINES`, the chunks are fetched and decompressed by
+            that many threads, each with its own database connection.
+            As those connections cannot see uncommitted changes, this is
+            only done when the session is not inside a transaction.
+        """
+        _, decompress = _codec(self.get_data().compression)
+
+        if self._parallel(workers) and self.__session.transaction is None:
+            engine = self.__session.bind
+            hashes = [chunk.blob_hash for chunk in self._chunk_query(DataChunks.blob_hash).order_by(DataChunks.index)]
+            pool = ThreadPool(workers)
+            try:
+                for chunk in _ordered_map(pool, lambda blob_hash: _download_blob(engine, decompress, blob_hash),
+                                          hashes, window=2 * workers):
+                    fileish.write(chunk)
+            finally:
+                pool.close()
+                pool.join()
+            return
+        chunks = (self._chunk_query(DataBlob._blob)
+                      .filter(DataBlob.hash == DataChunks.blob_hash)
+                      .order_by(DataChunks.index))
+        for chunk in chunks:
+            fileish.write(decompress(chunk._blob))
+
+    def get_to_path(self, path, workers=None, dtype=None):
+        """ Stores the data content in the file at `path` and returns a
+        memory-mapped, read-only view of it.
+
+        The file is preallocated to the size of the data and every chunk
+        is written directly to its offset in the mapping, so that the data
+        is never assembled in a Python string.
+
+        Parameters
+        ----------
+        path: str
+            The file to write to. An existing file is overwritten.
+        workers: int, optional
+            The number of threads which fetch and decompress the chunks.
+            (See `get`.)
+        dtype: optional
+            If given, a read-only `numpy.memmap` with this dtype is
+            returned instead of an `mmap.mmap`.
+
+        Returns
+        -------
+        view: mmap.mmap or numpy.memmap
+            The content of the file. For empty data, an empty string or array.
+
+        Raises
+        ------
+        ImportError
+            If `dtype` is given but NumPy is not installed.
+        """
+        if dtype is not None and numpy is None:
+            raise ImportError("NumPy is needed for get_to_path with dtype.")
+
+        data = self.get_data()
+        _, decompress = _codec(data.compression)
+        indices, starts, size = _chunk_layout(self.__session, data.id)
+
+        with open(path, "w+b") as f:
+            f.truncate(size)
+            if not size:
+                if dtype is not None:
+                    return numpy.empty(0, dtype=dtype)
+                return ""
+
+            view = mmap.mmap(f.fileno(), size)
+            try:
+                if self._parallel(workers) and self.__session.transaction is None:
+                    engine = self.__session.bind
+                    hashes = [chunk.blob_hash for chunk in
+                              self._chunk_query(DataChunks.blob_hash).order_by(DataChunks.index)]
+                    pool = ThreadPool(workers)
+                    try:
+                        chunks = _ordered_map(pool, lambda blob_hash: _download_blob(engine, decompress, blob_hash),
+                                              hashes, window=2 * workers)
+                        for start, chunk in izip(starts, chunks):
+                            view[start:start + len(chunk)] = chunk
+                    finally:
+                        pool.close()
+                        pool.join()
+                else:
+                    chunks = (self._chunk_query(DataBlob._blob)
+                                  .filter(DataBlob.hash == DataChunks.blob_hash)
+                                  .order_by(DataChunks.index))
+                    for start, chunk in izip(starts, chunks):
+                        stored = decompress(chunk._blob)
+                        view[start:start + len(stored)] = stored
+                view.flush()
+            finally:
+                view.close()
+
+        if dtype is not None:
+            return numpy.memmap(path, dtype=dtype, mode="r")
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+    @_on_primary
+    def put_array(self, array, mimetype=None, compression=None, workers=None, chunk_size=None):
+        """ Stores a NumPy array.
+
+        The raw memory of the array is written chunk by chunk; its dtype,
+        shape and memory layout are stored with the data, so that
+        `get_array` can restore the array (or a range of its rows).
+        Arrays which are neither C- nor Fortran-contiguous are copied to a
+        C-contiguous array first.
+
+        Parameters
+        ----------
+        array: numpy.ndarray
+            The array to store. Arrays of Python objects cannot be stored.
+        mimetype: string, optional
+            The mimetype of the data. (Defaults to `ARRAY_MIMETYPE`.)
+        compression: string, optional
+            The codec to compress the data with. (See `put`.)
+        workers: int, optional
+            The number of upload threads. (See `put_file`.)
+        chunk_size: int or ``"auto"``, optional
+            The size of the chunks. (See `put_file`.)
+
+        Raises
+        ------
+        ImportError
+            If NumPy is not installed.
+        ValueError
+            If the array holds Python objects.
+        """
+        _require_numpy()
+        array = numpy.asarray(array)
+        if array.dtype.hasobject:
+            raise ValueError("Arrays of Python objects cannot be stored.")
+
+        if array.flags.f_contiguous and not array.flags.c_contiguous:
+            order = "F"
+        else:
+            order = "C"
+            if not array.flags.c_contiguous:
+                array = numpy.ascontiguousarray(array)
+
+        self.put_file(_ArrayFile(array, order), compression, workers, chunk_size)
+
+        data = self.get_data()
+        data.array_dtype = _dtype_to_string(array.dtype)
+        data.array_shape = ",".join(str(dim) for dim in array.shape)
+        data.array_order = order
+        data.mimetype = mimetype or ARRAY_MIMETYPE
+        self.__session.flush()
+
+    def array_info(self):
+        """ Returns the dtype, the shape and the memory layout (``"C"`` or
+        ``"F"``) of an array stored with `put_array`.
+
+        Raises
+        ------
+        ValueError
+            If the data has not been stored with `put_array`.
+        """
+        _require_numpy()
+        data = self.get_data()
+        if data.array_dtype is None:
+            raise ValueError("The data for key '{0}' is not an array.".format(self.key))
+        shape = tuple(int(dim) for dim in data.array_shape.split(",") if dim)
+        return _dtype_from_string(data.array_dtype), shape, data.array_order
+
+    def get_array(self, start=None, stop=None, mmap=False, path=None):
+        """ Returns an array stored with `put_array`.
+
+        Parameters
+        ----------
+        start, stop: int, optional
+            Only return the rows ``array[start:stop]`` (along the first axis).
+            For C-ordered arrays, only the chunks which hold these rows are
+            fetched from the database.
+        mmap: bool, optional
+            If true, the data is written to a file (see `get_to_path`) and
+            a read-only `numpy.memmap` on it is returned. This cannot be
+            combined with `start` and `stop`.
+        path: str, optional
+            The file for `mmap`. If not given, a temporary file is used,
+            which (on POSIX systems) is unlinked as soon as it is mapped.
+
+        Raises
+        ------
+        ImportError
+            If NumPy is not installed.
+        ValueError
+            If the data is not an array or if `start` or `stop` are given for a
+            zero-dimensional array or together with `mmap`.
         """
-        for chunk in self._chunk_query(DataChunks.chunk).order_by(DataChunks.index):
-            fileish.write(chunk.chunk) # self._data[gen_key].data)
+        dtype, shape, order = self.array_info()
+        sliced = start is not None or stop is not None
+
+        if mmap:
+            if sliced:
+                raise ValueError("Slicing is not supported for memory-mapped arrays.")
+            return self._get_array_mmap(dtype, shape, order, path)
+
+        if sliced and not shape:
+            raise ValueError("A zero-dimensional array cannot be sliced.")
+
+        if not sliced or order == "F":
+            # Fortran-ordered rows are not contiguous: read everything
+            result = numpy.empty(shape, dtype=dtype, order=order)
+            offset = 0
+        else:
+            start, stop, _ = slice(start, stop).indices(shape[0])
+            shape = (max(stop - start, 0),) + shape[1:]
+            result = numpy.empty(shape, dtype=dtype, order=order)
+            row_size = result[0:1].nbytes if shape[0] else 0
+            offset = start * row_size
+
+        if result.nbytes:
+            with self.open() as reader:
+                reader.seek(offset)
+                reader.readinto(result.reshape(-1, order=order).view(numpy.uint8))
+
+        if sliced and order == "F":
+            return result[start:stop].copy(order="F")
+        return result
+
+    def _get_array_mmap(self, dtype, shape, order, path):
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix=".array")
+            os.close(fd)
+            temporary = True
+        else:
+            temporary = False
+
+        view = self.get_to_path(path)
+        if not len(view):
+            if temporary:
+                os.remove(path)
+            return numpy.empty(shape, dtype=dtype, order=order)
+        view.close()
+
+        array = numpy.memmap(path, dtype=dtype, mode="r", shape=shape, order=order)
+        if temporary and os.name == "posix":
+            os.remove(path)
+        return array
 
     def get_string(self):
         """ Explicitly return the data as a string.
@@ -333,14 +1428,65 @@ class _DataProxy(object):
         finally:
             string_io.close()
 
-    def size(self):
+    def open(self):
+        """ Returns a read-only, seekable file-like object for the data.
+
+        Only the chunks which cover the requested ranges are fetched from
+        the database. (See `_DataReader`.)
+        """
+        return _DataReader(self.__session, self.get_data())
+
+    def read(self, offset=0, length=None):
+        """ Returns `length` bytes of the data, starting at `offset`.
+
+        Only the chunks which cover the range are fetched from the database.
+        For many reads on the same data, use `open` instead, which caches
+        the most recently used chunks.
+
+        Parameters
+        ----------
+        offset: int, optional
+            The position of the first byte to read. (Defaults to 0.)
+        length: int, optional
+            The number of bytes to read. If not given, everything after
+            `offset` is read. Fewer bytes are returned at the end of the data.
+        """
+        with self.open() as reader:
+            reader.seek(offset)
+            if length is None:
+                return reader.read()
+            return reader.read(length)
+
+    def size(self, stored=False):
         """ Returns the size of all data chunks.
+
+        The size is read from the data row. Only for data which has been
+        written before the size was recorded, the chunks are summed up.
+
+        Parameters
+        ----------
+        stored: bool, optional
+            If true, the number of bytes which are stored in the database
+            (after compression) is returned. Otherwise, the length of the
+            uncompressed data. (Defaults to ``False``.)
         """
-        return self._chunk_query(func.sum(DataChunks.length)).scalar()
+        data = self.get_data()
+        recorded = data.stored_length if stored else data.length
+        if recorded is not None:
+            return recorded
+
+        if stored:
+            length = DataChunks.length
+        else:
+            length = func.coalesce(DataChunks.uncompressed_length, DataChunks.length)
+        return self._chunk_query(func.sum(length)).scalar()
 
     def chunks(self):
         """ Returns the number of data chunks.
         """
+        recorded = self.get_data().chunk_count
+        if recorded is not None:
+            return recorded
         return self._chunk_query(DataChunks.id).count()
 
     def check_consistency(self):
@@ -352,8 +1498,223 @@ class _DataProxy(object):
             check += 1
         return True
 
+    def verify(self):
+        """ Checks the stored data thoroughly.
+
+        In addition to `check_consistency`, the recorded size and number
+        of chunks must match the chunks (otherwise, an upload has been
+        interrupted and may be resumed, see `put_file`) and the content
+        of every chunk must match its checksum and stored length.
+
+        The lengths are compared in the database. On engines in
+        `SERVER_HASH_ENGINES`, the checksums are as well; otherwise, the
+        chunks are fetched one after another and hashed locally.
+
+        Raises
+        ------
+        DataInconsistencyError
+            If any of the checks fails.
+        """
+        self.check_consistency()
+        data = self.get_data()
+
+        if data.chunk_count is not None:
+            summary = (self._chunk_query(func.count(DataChunks.id),
+                                         func.sum(func.coalesce(DataChunks.uncompressed_length, DataChunks.length)))
+                           .one())
+            if (summary[0], summary[1] or 0) != (data.chunk_count, data.length):
+                raise DataInconsistencyError("The data for key '{0}' is incomplete.".format(self.key))
+
+        chunks = (self._chunk_query(DataChunks.index)
+                      .filter(DataBlob.hash == DataChunks.blob_hash))
+        wrong_length = chunks.filter(func.length(DataBlob._blob) != DataChunks.length).order_by(DataChunks.index)
+        bad = [chunk.index for chunk in wrong_length]
+
+        if self.__session.bind.name in SERVER_HASH_ENGINES:
+            wrong_hash = chunks.filter(func.encode(func.sha256(DataBlob._blob), "hex") != DataBlob.hash)
+            bad.extend(chunk.index for chunk in wrong_hash)
+        else:
+            blobs = (self._chunk_query(DataChunks.index, DataBlob.hash, DataBlob._blob)
+                         .filter(DataBlob.hash == DataChunks.blob_hash)
+                         .yield_per(1))
+            bad.extend(chunk.index for chunk in blobs if chunk_hash(chunk._blob) != chunk.hash)
+
+        if bad:
+            raise DataInconsistencyError("The checksums of chunks {0} of key '{1}' do not match."
+                                         .format(sorted(set(bad)), self.key))
+        return True
+
+    def __repr__(self):
+        data = self.get_data()
+        if data.chunk_count is None:
+            return "DataProxy(mimetype={0}, chunks={1}, size={2}, stored_size={3})".format(
+                data.mimetype, self.chunks(), self.size(), self.size(stored=True))
+        return "DataProxy(mimetype={0}, chunks={1}, size={2}, stored_size={3})".format(
+            data.mimetype, data.chunk_count, data.length, data.stored_length)
+
+
+class _DataReader(object):
+    """ A read-only, seekable file-like object for the content of a `Data` object.
+
+    When it is created, only the layout of the chunks (their indices and
+    lengths) is loaded. A `read` then fetches just the chunks which cover
+    the requested range. The last `DATA_CACHE_SIZE` decoded chunks are
+    kept, so that consecutive small reads do not hit the database again.
+
+    Usually, this class is not instantiated directly but through `_DataProxy.open`.
+
+    Parameters
+    ----------
+    session
+        The session to query the chunks with.
+    data: Data
+        The data to read.
+    cache_size: int, optional
+        The number of decoded chunks to keep. (Defaults to `DATA_CACHE_SIZE`.)
+    """
+
+    def __init__(self, session, data, cache_size=None):
+        self._session = session
+        self._data_id = data.id
+        _, self._decompress = _codec(data.compression)
+
+        if cache_size is None:
+            cache_size = DATA_CACHE_SIZE
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+        # the chunk indices and the offsets at which the chunks start
+        self._indices, self._starts, self._size = _chunk_layout(session, self._data_id)
+
+        self._position = 0
+        self.closed = False
+
+    @property
+    def size(self):
+        """ The length of the (uncompressed) data."""
+        return self._size
+
+    def _check_open(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+    def tell(self):
+        """ Returns the current position."""
+        self._check_open()
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """ Changes the current position, like `file.seek`."""
+        self._check_open()
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self._position + offset
+        elif whence == os.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError("Invalid whence ({0}, should be 0, 1 or 2)".format(whence))
+        if position < 0:
+            raise IOError("Negative seek position {0}".format(position))
+        self._position = position
+
+    def read(self, size=-1):
+        """ Reads at most `size` bytes (or everything up to the end, if
+        `size` is negative) from the current position.
+        """
+        self._check_open()
+        start = self._position
+        if size is None or size < 0:
+            end = self._size
+        else:
+            end = min(self._size, start + size)
+        if start >= end:
+            return ""
+
+        first = bisect.bisect_right(self._starts, start) - 1
+        last = bisect.bisect_right(self._starts, end - 1) - 1
+        chunks = self._decoded_chunks(range(first, last + 1))
+
+        # cut the requested range from the first and last chunk
+        chunks[-1] = chunks[-1][:end - self._starts[last]]
+        chunks[0] = chunks[0][start - self._starts[first]:]
+
+        self._position = end
+        return "".join(chunks)
+
+    def readinto(self, buffer):
+        """ Reads up to ``len(buffer)`` bytes from the current position
+        directly into the writable `buffer` (e.g. a `bytearray` or a
+        one-dimensional ``uint8`` array) and returns the number of bytes read.
+
+        Unlike `read`, the chunks are decoded a few at a time, so that
+        large ranges do not have to be held in memory twice.
+        """
+        self._check_open()
+        target = memoryview(buffer)
+        start = self._position
+        end = min(self._size, start + len(target))
+        if start >= end:
+            return 0
+
+        first = bisect.bisect_right(self._starts, start) - 1
+        last = bisect.bisect_right(self._starts, end - 1) - 1
+        batch = max(self._cache_size, 1)
+        written = 0
+        for batch_start in range(first, last + 1, batch):
+            positions = range(batch_start, min(batch_start + batch, last + 1))
+            for pos, chunk in zip(positions, self._decoded_chunks(positions)):
+                piece = chunk[max(start - self._starts[pos], 0):end - self._starts[pos]]
+                target[written:written + len(piece)] = piece
+                written += len(piece)
+
+        self._position = end
+        return written
+
+    def _decoded_chunks(self, positions):
+        """ Returns the decoded chunks for the given positions in `self._indices`,
+        fetching all which are not cached with a single query.
+        """
+        fetched = {}
+        missing = [pos for pos in positions if pos not in self._cache]
+        if missing:
+            lowest = self._indices[missing[0]]
+            highest = self._indices[missing[-1]]
+            chunks = (self._session.query(DataChunks.index, DataBlob._blob)
+                                   .filter(DataChunks.data_id == self._data_id)
+                                   .filter(DataBlob.hash == DataChunks.blob_hash)
+                                   .filter(DataChunks.index.between(lowest, highest)))
+            position_of = dict((index, pos) for pos, index in enumerate(self._indices))
+            for chunk in chunks:
+                fetched[position_of[chunk.index]] = self._decompress(chunk._blob)
+
+        decoded = []
+        for pos in positions:
+            if pos in self._cache:
+                chunk = self._cache.pop(pos)
+            else:
+                chunk = fetched[pos]
+            # (re-)insert as the most recently used
+            self._cache[pos] = chunk
+            decoded.append(chunk)
+
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return decoded
+
+    def close(self):
+        """ Closes the reader and drops the cached chunks."""
+        self._cache.clear()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def __repr__(self):
-        return "DataProxy(mimetype={0}, chunks={1}, size={2})".format(self.mimetype, self.chunks(), self.size())
+        return "DataReader(data_id={0}, size={1}, position={2})".format(self._data_id, self._size, self._position)
 
 
 class _DataAssoc(collections.MutableMapping):
@@ -380,16 +1741,32 @@ class _DataAssoc(collections.MutableMapping):
     def __delitem__(self, key):
         del self.owning._data[key]
 
+    @_on_primary
     def __setitem__(self, key, value):
         if not isinstance(value, _DataProxy):
             raise ValueError("value needs to be instance of DataProxy")
         # """Note that this is only expected to work if value *really* has the same semantics."""
 
-        # We use a tempfile as long as chunk based copying is not established
-        with tempfile.TemporaryFile() as f:
-            value.get(f)
-            f.seek(0) # Reset the file pointer, otherwise we'll only see EOF
-            self[key].put(f)
+        session = self.owning._session()
+        source_session = value.assoc.owning._session()
+        if source_session is session and self[key].has_data() and value.has_data() \
+                and self[key].get_data() is value.get_data():
+            # assigned to itself; clearing the target would destroy the source
+            pass
+        elif source_session is session or (_same_database(session, source_session)
+                                         and source_session.transaction is None):
+            # Chunks are shared, so we only need to copy the references.
+            # (Another session must not be inside a transaction, as
+            # uncommitted chunks would not be visible.)
+            source_session.flush()
+            self[key]._link_chunks(value)
+        else:
+            # Different sessions (and maybe databases) need a real copy
+            with tempfile.TemporaryFile() as f:
+                value.get(f)
+                f.seek(0) # Reset the file pointer, otherwise we'll only see EOF
+                self[key].put(f, compression=value.compression, chunk_size=value.chunk_size)
+                _copy_array_info(value.get_data(), self[key].get_data())
 
         self[key].mimetype = value.mimetype
 
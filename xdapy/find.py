@@ -9,8 +9,13 @@ __docformat__ = "restructuredtext"
 
 __authors__ = ['"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
 
+from sqlalchemy.sql import and_, or_, exists
+from sqlalchemy.sql.expression import ClauseElement
+from sqlalchemy.orm import aliased
+
 from xdapy.errors import SearchError
-from xdapy.structures import Entity
+from xdapy.parameters import Parameter, parameter_for_type
+from xdapy.structures import BaseEntity, Entity, Context
 
 class SearchProxy(object):
     """ Builds a representation of a search tree.
@@ -28,6 +33,11 @@ class SearchProxy(object):
     {k1: v1, k2: v2} -> ("_all": [(k1, v1), (k2, v2)])
 
     [it1, it2, it3] -> [it1, it2, it3]
+
+    Where possible, the tree is translated into an SQL clause (see
+    `sql_clause`) so that the database does the filtering. Only nodes
+    which cannot be expressed in SQL (most notably ``_with``) are
+    checked in Python afterwards.
     """
     def __init__(self, inner, stack=None, parent=None):
         self.inner = inner
@@ -90,6 +100,30 @@ class SearchProxy(object):
         #print type(self)
         return self.inner.is_valid(item)
 
+    def sql_clause(self, mapper, entity, klasses):
+        """ Translates the search tree into an SQL clause.
+
+        Parameters
+        ----------
+        mapper: Mapper
+            The mapper which is searched.
+        entity: class or aliased class
+            The SQL representation of the item which is checked.
+        klasses: list or None
+            The entity classes the item may have. Needed to look up
+            the type of a parameter.
+
+        Returns
+        -------
+        (clause, exact): tuple
+            `clause` is a necessary condition for `is_valid` or ``None``
+            if there is no restriction. If `exact` is true, the clause is
+            also sufficient and `is_valid` need not be called.
+        """
+        if isinstance(self.inner, SearchProxy):
+            return self.inner.sql_clause(mapper, entity, klasses)
+        return None, False
+
     def all_parents(self):
         """ Traverses all parents
         """
@@ -115,16 +149,56 @@ class _any(BooleanProxy):
     def is_valid(self, item):
         return any(i.is_valid(item) for i in self.inner)
 
+    def sql_clause(self, mapper, entity, klasses):
+        if not self.inner:
+            return None, False
+
+        clauses = []
+        exact = True
+        for i in self.inner:
+            if not isinstance(i, SearchProxy):
+                return None, False
+            clause, i_exact = i.sql_clause(mapper, entity, klasses)
+            if clause is None:
+                if i_exact:
+                    # this item is always valid
+                    return None, True
+                # without a condition for every item, we cannot restrict at all
+                return None, False
+            clauses.append(clause)
+            exact = exact and i_exact
+        return or_(*clauses), exact
+
 class _all(BooleanProxy):
     """Returns True, if the search succeeds for all inner items."""
     def is_valid(self, item):
         return all(i.is_valid(item) for i in self.inner)
 
+    def sql_clause(self, mapper, entity, klasses):
+        clauses = []
+        exact = True
+        for i in self.inner:
+            if not isinstance(i, SearchProxy):
+                exact = False
+                continue
+            clause, i_exact = i.sql_clause(mapper, entity, klasses)
+            if clause is not None:
+                clauses.append(clause)
+            exact = exact and i_exact
+
+        if not clauses:
+            return None, exact
+        return and_(*clauses), exact
+
 class _with(SearchProxy):
     """Applies the inner value as function to an item."""
     def is_valid(self, item):
         return self.inner(item)
 
+    def sql_clause(self, mapper, entity, klasses):
+        # arbitrary Python functions must be checked in Python
+        return None, False
+
 class _param(SearchProxy):
     def __init__(self, key, value, stack, parent):
         super(_param, self).__init__(value, stack, parent)
@@ -141,6 +215,54 @@ class _param(SearchProxy):
             return param == test
         return test(param)
 
+    def value_clause(self, column):
+        """ Returns the SQL equivalent of `test_param` for `column`
+        or ``None``, if the test can only be done in Python.
+        """
+        test = self.inner
+        if isinstance(test, basestring):
+            return column == test
+        if not getattr(test, "is_operator", False):
+            # An arbitrary function may give a clause which means
+            # something else, e.g. ``lambda v: v == 3 or v == 4``
+            # gives ``v == 4``. It is evaluated in Python.
+            return None
+
+        # Like in `Mapper.find`, the operators from `xdapy.operators`
+        # are applied to the column to build the clause.
+        try:
+            clause = test(column)
+        except Exception:
+            return None
+        if isinstance(clause, ClauseElement):
+            return clause
+        return None
+
+    def sql_clause(self, mapper, entity, klasses):
+        if self.key == "_id":
+            clause = self.value_clause(entity.id)
+            return clause, clause is not None
+
+        if not klasses:
+            return None, False
+        types = set(klass.declared_params.get(self.key) for klass in klasses)
+        if len(types) != 1 or None in types:
+            # we do not know which table to look in
+            return None, False
+        parameter_class = parameter_for_type(types.pop())
+
+        param = Parameter.__table__.alias()
+        typed = parameter_class.__table__.alias()
+
+        clause = self.value_clause(typed.c.value)
+        if clause is None:
+            return None, False
+
+        return exists().where(and_(param.c.entity_id == entity.id,
+                                   param.c.name == self.key,
+                                   typed.c.id == param.c.id,
+                                   clause)), True
+
     @property
     def _type_repr(self):
         return "param:" + self.key
@@ -156,10 +278,36 @@ class _entity(SearchProxy):
         return (item == self.key or item.type == self.key) and self.inner.is_valid(item)
 
     def find(self, mapper):
-        # TODO: This retrieves everything. Should do some filtering before, if possible.
-        items = mapper.find_all(self.key)
-        #print items
-        return [item for item in items if self.is_valid(item)]
+        if isinstance(self.key, Entity):
+            items = mapper.find_all(self.key)
+            return [item for item in items if self.is_valid(item)]
+
+        klass = mapper.entity_by_name(self.key)
+        query = mapper.find(klass)
+
+        clause, exact = self.inner.sql_clause(mapper, klass, [klass])
+        if clause is not None:
+            query = query.filter(clause)
+        if exact:
+            return query.all()
+        return [item for item in query if self.inner.is_valid(item)]
+
+    def sql_clause(self, mapper, entity, klasses):
+        if isinstance(self.key, Entity):
+            if self.key.id is None:
+                return None, False
+            klasses = [self.key.__class__]
+            clause = entity.id == self.key.id
+        else:
+            klasses = mapper.entities_by_type(self.key)
+            if not klasses:
+                return None, False
+            clause = entity._type.in_([klass.__name__ for klass in klasses])
+
+        inner_clause, exact = self.inner.sql_clause(mapper, entity, klasses)
+        if inner_clause is not None:
+            clause = and_(clause, inner_clause)
+        return clause, exact
 
     @property
     def _type_repr(self):
@@ -169,12 +317,44 @@ class _parent(SearchProxy):
     def is_valid(self, item):
         return self.inner.is_valid(item.parent)
 
+    def sql_clause(self, mapper, entity, klasses):
+        parent = aliased(BaseEntity)
+        clause, exact = SearchProxy.sql_clause(self, mapper, parent, None)
+
+        if clause is None:
+            return entity.parent_id != None, exact
+        return exists().where(and_(parent.id == entity.parent_id, clause)), exact
+
 class _child(SearchProxy):
     def is_valid(self, item):
         return any(self.inner.is_valid(child) for child in item.children)
 
+    def sql_clause(self, mapper, entity, klasses):
+        child = aliased(BaseEntity)
+        clause, exact = SearchProxy.sql_clause(self, mapper, child, None)
+
+        condition = child.parent_id == entity.id
+        if clause is not None:
+            condition = and_(condition, clause)
+        return exists().where(condition), exact
+
 class _context(SearchProxy):
     def is_valid(self, item):
         key = self.stack[-1]
         connection_type = key[1]
         return any(self.inner.is_valid(connected) for connected in item.context[connection_type])
+
+    def sql_clause(self, mapper, entity, klasses):
+        key = self.stack[-1]
+        connection_type = key[1]
+
+        context = aliased(Context)
+        connected = aliased(BaseEntity)
+        clause, exact = SearchProxy.sql_clause(self, mapper, connected, None)
+
+        condition = and_(context.holder_id == entity.id,
+                         context.connection_type == connection_type,
+                         connected.id == context.attachment_id)
+        if clause is not None:
+            condition = and_(condition, clause)
+        return exists().where(condition), exact
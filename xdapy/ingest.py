@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+"""
+A queue which stores data in the background.
+
+Storing a large file with ``entity.data[key].put(f)`` blocks until every
+chunk has been written. An `IngestQueue` accepts such jobs instead and hands
+them to worker threads, each of which writes with a session of its own::
+
+    queue = mapper.ingest_queue(workers=2)
+    job = queue.submit(trial, "recording", "/data/trial-17.raw", mimetype="audio/x-wav")
+    # ... go on with the experiment
+    queue.wait() # all submitted jobs are done
+
+The queue holds at most `max_pending` waiting jobs. When it is full,
+`IngestQueue.submit` blocks until a worker has taken a job, so that a fast
+producer cannot fill up the memory with open files.
+"""
+
+__docformat__ = "restructuredtext"
+
+__authors__ = ['"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
+
+import Queue
+import sys
+import threading
+
+from sqlalchemy.orm.attributes import instance_state
+
+from xdapy.structures import BaseEntity
+from xdapy.data import _remaining_size
+
+import logging
+logger = logging.getLogger(__name__)
+
+#: The default number of jobs which may wait in an `IngestQueue`.
+MAX_PENDING_JOBS = 16
+
+# tells a worker thread to stop
+_STOP = object()
+
+
+class IngestJob(object):
+    """ A data upload which has been submitted to an `IngestQueue`.
+
+    A job is similar to a future: `result` waits until the data has been
+    stored and re-raises the error of a failed job.
+
+    Attributes
+    ----------
+    key: str
+        The data key.
+    bytes_done: int
+        The number of bytes which have been read from the file so far.
+    total: int
+        The size of the file, if it is known, or None.
+    """
+
+    def __init__(self, entity_id, key, path_or_file, mimetype=None, put_options=None, progress=None):
+        self.entity_id = entity_id
+        self.key = key
+        self.path_or_file = path_or_file
+        self.mimetype = mimetype
+        self.put_options = put_options or {}
+        self.progress = progress
+
+        self.bytes_done = 0
+        self.total = None
+
+        self._done = threading.Event()
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """ Returns true, if the job has finished (successfully or not)."""
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ Waits until the job has finished. Returns `done`."""
+        self._done.wait(timeout)
+        return self.done()
+
+    def result(self, timeout=None):
+        """ Waits until the job has finished and re-raises its error, if it failed.
+
+        Raises
+        ------
+        RuntimeError
+            If the job is not done after `timeout` seconds.
+        """
+        if not self.wait(timeout):
+            raise RuntimeError("Ingestion of '{0}' has not finished.".format(self.key))
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+    def exception(self, timeout=None):
+        """ Waits until the job has finished and returns its error (or None)."""
+        if not self.wait(timeout):
+            raise RuntimeError("Ingestion of '{0}' has not finished.".format(self.key))
+        if self._exc_info is not None:
+            return self._exc_info[1]
+
+    def add_done_callback(self, fn):
+        """ Calls ``fn(job)`` when the job has finished (or immediately, if
+        it has finished already). The callback runs in the worker thread.
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _report(self, size):
+        self.bytes_done += size
+        if self.progress is not None:
+            self.progress(self, self.bytes_done, self.total)
+
+    def _finish(self, exc_info=None):
+        self._exc_info = exc_info
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception("Callback of ingestion job '%s' failed.", self.key)
+
+    def __repr__(self):
+        if not self.done():
+            state = "pending"
+        elif self._exc_info is None:
+            state = "done"
+        else:
+            state = "failed"
+        return "IngestJob(entity_id={0}, key={1!r}, {2}, bytes_done={3})".format(
+            self.entity_id, self.key, state, self.bytes_done)
+
+
+class _ProgressFile(object):
+    """ Wraps a file and reports the number of bytes read to the job."""
+    def __init__(self, fileish, job):
+        self._file = fileish
+        self._job = job
+
+    def read(self, size=-1):
+        chunk = self._file.read(size)
+        self._job._report(len(chunk))
+        return chunk
+
+    def tell(self):
+        return self._file.tell()
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+
+class IngestQueue(object):
+    """ Stores data from files in background threads.
+
+    Parameters
+    ----------
+    connection: Connection
+        The connection whose database the data is written to. Every worker
+        opens a session of its own on it. (For SQLite, this means that the
+        database must be a file, not ``:memory:``.)
+    workers: int, optional
+        The number of worker threads. (Defaults to 1.)
+    max_pending: int, optional
+        The number of jobs which may wait for a worker before `submit`
+        blocks. (Defaults to `MAX_PENDING_JOBS`.)
+    """
+
+    def __init__(self, connection, workers=1, max_pending=None):
+        if workers < 1:
+            raise ValueError("workers must be positive.")
+        if max_pending is None:
+            max_pending = MAX_PENDING_JOBS
+
+        self.connection = connection
+        self._queue = Queue.Queue(max_pending)
+        self._closed = False
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name="xdapy-ingest-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, entity, key, path_or_file, mimetype=None, progress=None, block=True, timeout=None, **put_options):
+        """ Queues the data of a file to be stored in ``entity.data[key]``.
+
+        Parameters
+        ----------
+        entity: Entity
+            The entity to store the data on. It must have been saved already.
+        key: str
+            The data key.
+        path_or_file: str or file-like
+            A path or an open file. A path is opened (and closed) by the
+            worker. A file must not be used until the job is done.
+        mimetype: str, optional
+            The mimetype of the data.
+        progress: callable, optional
+            Is called as ``progress(job, bytes_done, total)`` from the
+            worker thread whenever a chunk has been read.
+        block: bool, optional
+            If false and the queue is full, `Queue.Full` is raised instead of
+            waiting. (Defaults to ``True``.)
+        timeout: float, optional
+            How long to wait for space in the queue before `Queue.Full` is raised.
+        **put_options
+            Passed to `xdapy.data._DataProxy.put_file` (e.g. `compression`
+            or `chunk_size`).
+
+        Returns
+        -------
+        job: IngestJob
+
+        Raises
+        ------
+        ValueError
+            If the queue has been closed or the entity has not been saved.
+        """
+        if self._closed:
+            raise ValueError("The ingest queue has been closed.")
+
+        identity = instance_state(entity).key
+        if identity is None:
+            raise ValueError("The entity must be saved before data can be ingested.")
+
+        job = IngestJob(identity[1][0], key, path_or_file, mimetype, put_options, progress)
+        self._queue.put(job, block, timeout)
+        return job
+
+    def pending(self):
+        """ Returns the (approximate) number of jobs which wait for a worker."""
+        return self._queue.qsize()
+
+    def wait(self):
+        """ Blocks until every submitted job has finished."""
+        self._queue.join()
+
+    flush = wait
+
+    def close(self, wait=True):
+        """ Stops accepting jobs and ends the worker threads after the
+        queued jobs have been done.
+
+        Parameters
+        ----------
+        wait: bool, optional
+            If true, blocks until the threads have ended. (Defaults to ``True``.)
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for thread in self._threads:
+            self._queue.put(_STOP)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _work(self):
+        session = self.connection.Session.session_factory(bind=self.connection.engine)
+        try:
+            while True:
+                job = self._queue.get()
+                try:
+                    if job is _STOP:
+                        return
+                    self._run(session, job)
+                finally:
+                    self._queue.task_done()
+        finally:
+            session.close()
+
+    def _run(self, session, job):
+        try:
+            if isinstance(job.path_or_file, basestring):
+                fileish = open(job.path_or_file, "rb")
+            else:
+                fileish = job.path_or_file
+            try:
+                job.total = _remaining_size(fileish)
+                entity = session.query(BaseEntity).get(job.entity_id)
+                if entity is None:
+                    raise ValueError("The entity with id {0} does not exist.".format(job.entity_id))
+                entity.data[job.key].put(_ProgressFile(fileish, job), mimetype=job.mimetype, **job.put_options)
+                session.flush()
+            finally:
+                if fileish is not job.path_or_file:
+                    fileish.close()
+        except Exception:
+            logger.exception("Ingestion of '%s' failed.", job.key)
+            session.rollback()
+            job._finish(sys.exc_info())
+        else:
+            job._finish()
+        finally:
+            session.expunge_all()
+
+    def __repr__(self):
+        return "IngestQueue(workers={0}, pending={1})".format(len(self._threads), self.pending())
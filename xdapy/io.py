@@ -95,7 +95,7 @@ class IO(object):
     @property
     def known_objects(self):
         if self._known_objects is None:
-            return dict((obj.__name__, obj) for obj in self.mapper.registered_entities)
+            return self.mapper.registered_entity_names
         return self._known_objects
 
 import json
@@ -416,7 +416,12 @@ class XmlIO(IO):
                 key, val = self.parse_parameter_type(sub)
                 params[key] = val
         polymorphic_name = calculate_polymorphic_name(type, params)
-        if polymorphic_name in self.known_objects:
+        if self._known_objects is None:
+            # includes the types which the mapper has deferred
+            known = self.mapper.is_registered(type, params)
+        else:
+            known = polymorphic_name in self._known_objects
+        if known:
             return type, params, polymorphic_name
         else:
             raise UnregisteredTypesError("Object not found", (type, params))
@@ -6,6 +6,8 @@ This module provides the code to access a database on an abstract level.
 Created on Jun 17, 2009
 """
 import itertools
+import time
+import weakref
 
 __docformat__ = "restructuredtext"
 
@@ -13,12 +15,18 @@ __authors__ = ['"Hannah Dold" <hannah.dold@mailbox.tu-berlin.de>',
                '"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
 
 from xdapy.connection import Connection
-from xdapy.structures import ParameterDeclaration, BaseEntity, Entity, calculate_polymorphic_name, create_entity
-from xdapy.parameters import StringParameter, DateParameter, parameter_for_type
+from xdapy.structures import ParameterDeclaration, BaseEntity, Entity, EntityClosure, calculate_polymorphic_name, create_entity, \
+                              defer_entity, deferred_entity_class
+from xdapy.parameters import Parameter, StringParameter, DateParameter, parameter_for_type
 from xdapy.errors import StringConversionError, FilterError
+from xdapy.data import collect_garbage, dedup_stats, data_summary
 from xdapy.find import SearchProxy
+from xdapy.ingest import IngestQueue
+from xdapy import closure
 
-from sqlalchemy.sql import or_, and_
+from sqlalchemy.sql import or_, and_, select
+from sqlalchemy.orm import object_mapper, joinedload, subqueryload, subqueryload_all
+from sqlalchemy.orm.attributes import instance_state
 
 import logging
 logger = logging.getLogger(__name__)
@@ -30,6 +38,37 @@ TODO: Save: what happens if similar object with more or less but otherwise the s
 TODO: Error if the committing fails
 """
 
+#: The relations which may be eagerly loaded with the `load` argument of
+#: `Mapper.find`. Each name maps to a list of loader options.
+EAGER_LOADS = {
+    "params": [(subqueryload, "_params")],
+    "data_keys": [(subqueryload, "_data")],
+    "context": [(subqueryload_all, "holds_context.attachment"),
+                (subqueryload_all, "attached_by.holder")],
+    "parent": [(joinedload, "parent")],
+}
+
+def check_compatible(old_params, new_params):
+    """ Checks that entities with the declared parameters `old_params` may
+    be turned into entities with `new_params`: No parameter which is
+    declared in both may change its type.
+
+    Raises
+    ------
+    ValueError
+        If the parameter lists are incompatible.
+    """
+    incompatibles = dict((key, (oldv, newv))
+        for key, oldv in old_params.iteritems()
+        for newv in (new_params.get(key),)
+        if newv and oldv != newv)
+
+    if incompatibles:
+        info = ""
+        for (key, (oldv, newv)) in incompatibles.iteritems():
+            info += "\n    Parameter %r changed from %r to %r." % (key, oldv, newv)
+        raise ValueError("Incompatible parameter lists:" + info)
+
 class Mapper(object):
     """ Handles database access and sessions
 
@@ -37,6 +76,12 @@ class Mapper(object):
     ----------
     connection
         A connection object to the database.
+    closure_table: bool, optional
+        If true, the closure table of the entity hierarchy is updated
+        whenever the session is flushed, which makes `descendants_of` and
+        `ancestors_of` single indexed lookups. (Defaults to ``False``.)
+        Existing databases must be brought up to date once with
+        `rebuild_closure`.
 
     Attributes
     ----------
@@ -47,13 +92,30 @@ class Mapper(object):
         The objects this mapper cares about
     """
 
-    def __init__(self, connection):
+    def __init__(self, connection, closure_table=False):
         if isinstance(connection, basestring):
             # We’ve been given a URL. Use it.
             connection = Connection(url=connection)
 
         self.connection = connection
         self.registered_entities = []
+        # indexes of the registered entities by their polymorphic name
+        # and by their type (the name without the hash)
+        self._entities_by_name = {}
+        self._entities_by_type = {}
+        self._registered_classes = set()
+        # the types from `load_types_from_db` whose classes have not been created
+        self._deferred_types = {}
+        self._deferred_by_type = {}
+        # the polymorphic names of the types whose parameters are
+        # known to be declared in the database (as long as the tables
+        # have not been dropped)
+        self._declared_types = set()
+        self._declared_generation = connection.table_generation
+        self._ingest_queue = None
+
+        if closure_table:
+            closure.maintain(self.session)
 
     @property
     def auto_session(self):
@@ -79,6 +141,16 @@ class Mapper(object):
         """
         return self.connection.auto_session
 
+    @property
+    def use_primary(self):
+        """ Convenience wrapper for `xdapy.connection.Connection.use_primary`.
+
+        If the connection has read replicas, queries outside of an
+        `auto_session` (e.g. from `find_all`) go to one of them. Inside a
+        ``with mapper.use_primary:`` block, they go to the primary database.
+        """
+        return self.connection.use_primary
+
     @property
     def session(self):
         """ Convenience wrapper for `xdapy.connection.Connection.session`.
@@ -111,6 +183,88 @@ class Mapper(object):
                 session.add(arg)
                 session.flush()
 
+    def save_bulk(self, entities, batch_size=1000):
+        """ Saves a large number of entities using as few round trips
+        as possible.
+
+        Unlike `save`, which flushes after every single object, the entities
+        are added in batches of `batch_size` and each batch is flushed once.
+        On PostgreSQL, the primary keys of all new entities and parameters
+        are drawn from their sequences in one query per batch, which allows
+        SQLAlchemy to write each table (``entities``, ``parameters``,
+        ``parameters_integer``, …, ``contexts``) with a single
+        ``executemany``. On other dialects the keys are left to the database.
+
+        Everything is saved inside one `auto_session`, so either all
+        entities are stored or none.
+
+        Parameters
+        ----------
+        entities: iterable
+            The `Entity` objects to save. Related objects (parameters,
+            children, contexts) are saved as well.
+        batch_size: int, optional
+            The number of entities to flush at once. (Defaults to 1000.)
+
+        Returns
+        -------
+        stats: dict
+            The number of ``entities`` and table ``rows`` written, the elapsed
+            ``seconds`` and the resulting ``rows_per_sec``.
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be a positive integer.")
+
+        entity_count = 0
+        row_count = 0
+        start = time.time()
+
+        with self.auto_session as session:
+            entities = iter(entities)
+            while True:
+                batch = list(itertools.islice(entities, batch_size))
+                if not batch:
+                    break
+
+                session.add_all(batch)
+                new_objs = list(session.new)
+                self._preassign_ids(session, new_objs)
+                session.flush()
+
+                entity_count += len(batch)
+                row_count += sum(len(object_mapper(obj).tables) for obj in new_objs)
+
+        seconds = time.time() - start
+        rows_per_sec = row_count / seconds if seconds > 0 else float(row_count)
+        logger.info("Bulk saved %d entities (%d rows) in %.2fs, %.0f rows/sec.",
+                    entity_count, row_count, seconds, rows_per_sec)
+
+        return {"entities": entity_count,
+                "rows": row_count,
+                "seconds": seconds,
+                "rows_per_sec": rows_per_sec}
+
+    def _preassign_ids(self, session, objs):
+        """ Fills in the primary keys of new `BaseEntity` and `Parameter`
+        objects from their database sequences.
+
+        Only PostgreSQL supports fetching many sequence values in a single
+        query. For other engines this is a no-op.
+        """
+        if self.connection.engine_name != "postgresql":
+            return
+
+        for cls, sequence in ((BaseEntity, "entities_id_seq"),
+                              (Parameter, "parameter_id_seq")):
+            missing = [obj for obj in objs if isinstance(obj, cls) and obj.id is None]
+            if not missing:
+                continue
+
+            ids = session.execute("SELECT nextval(:seq) FROM generate_series(1, :count)",
+                                  {"seq": sequence, "count": len(missing)})
+            for obj, (id,) in itertools.izip(missing, ids):
+                obj.id = id
+
     def delete(self, *args):
         """ Deletes the objects from the database.
 
@@ -143,7 +297,7 @@ class Mapper(object):
     def is_in_session(self, entity):
         return entity in self.session
 
-    def param_filter(self, entity, filter, options=None):
+    def _filter_options(self, options):
         default_options = {
             "convert_string": False,
             "strict": True
@@ -151,97 +305,157 @@ class Mapper(object):
 
         if options:
             default_options.update(options)
-        options = default_options
+        return default_options
 
-        and_clause = []
-        for key, value in filter.iteritems():
-        # create sql for each key and concatenate with AND
-            def makeParam(key, value):
-                """ Takes a value list as input and concatenates with OR.
-                This means that {age: [1, 12, 13]}  will yield a result if
-                age == 1 OR age == 12 OR age == 13.
-                """
-                if not (isinstance(value, list) or isinstance(value, tuple)):
-                    value = [value]
-
-                or_clause = []
-                # Ask for the type of the parameter according to the entity
-                parameter_class = parameter_for_type(entity.declared_params[key])
-                for val in value:
-                    if callable(val):
-                        # we’ve been given a function
-                        or_clause.append(val(parameter_class.value))
-                    elif parameter_class == StringParameter:
-                        # test string using ‘like’
-                        if not options["strict"]:
-                            val = "%" + val + "%"
-
-                        or_clause.append(parameter_class.value.like(val))
-                    else:
-                        if options["convert_string"]:
-                            try:
-                                val = parameter_class.from_string(val)
-                            except StringConversionError:
-                                if parameter_class == DateParameter:
-                                    # Here, we want to match a certain YEAR, a certain
-                                    # combination of YEAR-MONTH or a certain combination
-                                    # YEAR-MONTH-DAY from a date.
-                                    # Therefore, we need to extract YEAR, MONTH and DAY
-                                    # from a date and match those separately.
-                                    # Unfortunately, there is no common SQL function for
-                                    # this task, so we're left with ``date_part('year', date)``
-                                    # for Postgres and ``strftime('%Y', date)`` for Sqlite.
-                                    # We check the `engine_name` and generate the respective
-                                    # methods.
-
-                                    # get year month day
-                                    ymd = val.split('-')
-
-                                    clauses = []
-
-                                    from sqlalchemy.sql.expression import func
-                                    if self.connection.engine_name == "postgresql":
-                                        year_part = lambda value: func.date_part('year', value)
-                                        month_part = lambda value: func.date_part('month', value)
-                                        day_part = lambda value: func.date_part('day', value)
-                                    elif self.connection.engine_name == "sqlite":
-                                        year_part = lambda value: func.strftime('%Y', value)
-                                        month_part = lambda value: func.strftime('%m', value)
-                                        day_part = lambda value: func.strftime('%d', value)
-                                    else:
-                                        raise ValueError("Unsupported operation: Unknown engine name %r." %
-                                                          self.connection.engine_name)
-
-                                    if len(ymd) > 0:
-                                         clauses.append(year_part(parameter_class.value) ==  ymd[0])
-                                    if len(ymd) > 1:
-                                         clauses.append(month_part(parameter_class.value) ==  ymd[1])
-                                    if len(ymd) > 2:
-                                         clauses.append(day_part(parameter_class.value) ==  ymd[2])
-
-                                    clause = (and_(*clauses))
-                                    or_clause.append(clause)
-                                else:
-                                    raise
+    def _param_clause(self, parameter_class, column, value, options):
+        """ Takes a value list as input and concatenates with OR.
+        This means that {age: [1, 12, 13]}  will yield a result if
+        age == 1 OR age == 12 OR age == 13.
+
+        The comparisons are made against `column`, which must be the value
+        column of (an alias of) the table of `parameter_class`.
+        """
+        if not (isinstance(value, list) or isinstance(value, tuple)):
+            value = [value]
+
+        or_clause = []
+        for val in value:
+            if callable(val):
+                # we’ve been given a function
+                or_clause.append(val(column))
+            elif parameter_class == StringParameter:
+                # test string using ‘like’
+                if not options["strict"]:
+                    val = "%" + val + "%"
+
+                or_clause.append(column.like(val))
+            else:
+                if options["convert_string"]:
+                    try:
+                        val = parameter_class.from_string(val)
+                    except StringConversionError:
+                        if parameter_class == DateParameter:
+                            # Here, we want to match a certain YEAR, a certain
+                            # combination of YEAR-MONTH or a certain combination
+                            # YEAR-MONTH-DAY from a date.
+                            # Therefore, we need to extract YEAR, MONTH and DAY
+                            # from a date and match those separately.
+                            # Unfortunately, there is no common SQL function for
+                            # this task, so we're left with ``date_part('year', date)``
+                            # for Postgres and ``strftime('%Y', date)`` for Sqlite.
+                            # We check the `engine_name` and generate the respective
+                            # methods.
+
+                            # get year month day
+                            ymd = val.split('-')
+
+                            clauses = []
+
+                            from sqlalchemy.sql.expression import func
+                            if self.connection.engine_name == "postgresql":
+                                year_part = lambda value: func.date_part('year', value)
+                                month_part = lambda value: func.date_part('month', value)
+                                day_part = lambda value: func.date_part('day', value)
+                            elif self.connection.engine_name == "sqlite":
+                                year_part = lambda value: func.strftime('%Y', value)
+                                month_part = lambda value: func.strftime('%m', value)
+                                day_part = lambda value: func.strftime('%d', value)
+                            else:
+                                raise ValueError("Unsupported operation: Unknown engine name %r." %
+                                                  self.connection.engine_name)
+
+                            if len(ymd) > 0:
+                                 clauses.append(year_part(column) ==  ymd[0])
+                            if len(ymd) > 1:
+                                 clauses.append(month_part(column) ==  ymd[1])
+                            if len(ymd) > 2:
+                                 clauses.append(day_part(column) ==  ymd[2])
+
+                            clause = (and_(*clauses))
+                            or_clause.append(clause)
+                            continue
                         else:
-                            or_clause.append(parameter_class.value == val)
-                # FIXME
-                return entity._params.of_type(parameter_class).any(or_(*or_clause))
+                            raise
+                # convert_string may have changed val
+                or_clause.append(column == val)
+        return or_(*or_clause)
+
+    def _attr_clause(self, entity, key, value):
+        """ Returns the clause for a direct attribute `key` of `entity`."""
+        if callable(value):
+            test = value
+        else:
+            test = lambda v: v == value
+        return test(getattr(entity, key))
 
-            def makeAttr(key, value):
-                if not callable(value):
-                    value = lambda v: v == value
-                return value(getattr(entity, key))
+    def param_filter(self, entity, filter, options=None):
+        """ Returns a filter clause which restricts `entity` to the
+        given parameter values.
+
+        Every parameter key results in a correlated ``EXISTS`` sub-query.
+        `filter_query`, which is used by `find`, produces joins instead and
+        should be preferred when a query object is available.
+        """
+        options = self._filter_options(options)
 
+        and_clause = []
+        for key, value in filter.iteritems():
+        # create sql for each key and concatenate with AND
             if key.startswith("_"):
                 # the key is a direct attribute
-                k = key[1::]
-                and_clause.append(makeAttr(k, value))
+                and_clause.append(self._attr_clause(entity, key[1:], value))
             else:
                 # the key is a parameter
-                and_clause.append(makeParam(key, value))
+                # Ask for the type of the parameter according to the entity
+                parameter_class = parameter_for_type(entity.declared_params[key])
+                clause = self._param_clause(parameter_class, parameter_class.value, value, options)
+                and_clause.append(entity._params.of_type(parameter_class).any(
+                    and_(parameter_class.name == key, clause)))
         return and_(*and_clause)
 
+    def filter_query(self, query, entity, filter, options=None):
+        """ Restricts `query` to entities with the given parameter values.
+
+        For every parameter key, the query is joined with an alias of the
+        ``parameters`` table and an alias of the respective typed table
+        (``parameters_integer``, ``parameters_string``, …). The value
+        predicate is part of the join condition, so the database can
+        resolve each key with a single index lookup on
+        ``parameters (name, entity_id)`` instead of evaluating one ``EXISTS``
+        sub-query per key and entity. Because an entity has at most one
+        parameter of each name, the joins never duplicate result rows.
+
+        Keys starting with an underscore (e.g. ``_id``) are treated as
+        direct attributes of the entity and added as plain filters.
+
+        Parameters
+        ----------
+        query: `sqlalchemy.orm.query.Query`
+            The query to restrict.
+        entity: class
+            The entity class which is queried.
+        filter: dict
+            The parameter filter.
+        options: dict, optional
+            ``convert_string`` and ``strict`` options, see `find`.
+        """
+        options = self._filter_options(options)
+
+        for key, value in filter.iteritems():
+            if key.startswith("_"):
+                query = query.filter(self._attr_clause(entity, key[1:], value))
+                continue
+
+            parameter_class = parameter_for_type(entity.declared_params[key])
+            param = Parameter.__table__.alias()
+            typed = parameter_class.__table__.alias()
+
+            clause = self._param_clause(parameter_class, typed.c.value, value, options)
+            query = query.join(param, and_(param.c.entity_id == entity.id,
+                                           param.c.name == key))
+            query = query.join(typed, and_(typed.c.id == param.c.id, clause))
+        return query
+
     def _mk_entity_filter(self, entity, filter=None):
         """ Returns the appropriate entity class, and a filter dict."""
         # TODO Rename this function
@@ -271,7 +485,42 @@ class Mapper(object):
 
         return entity, filter
 
-    def find(self, entity, filter=None, options=None):
+    def eager_load(self, query, load):
+        """ Adds loader options to `query` so that the given relations
+        of all results are fetched with a constant number of queries,
+        instead of one lazy load per result.
+
+        Parameters
+        ----------
+        query : `sqlalchemy.orm.query.Query`
+            A query for entities.
+        load : list of strings
+            The relations to load. Any of the keys of `EAGER_LOADS`:
+
+            ``"params"``
+                The parameters (including their values).
+            ``"data_keys"``
+                The `xdapy.data.Data` rows (but not their chunks).
+            ``"context"``
+                The context in both directions together with the related entities.
+            ``"parent"``
+                The parent entity.
+
+        Raises
+        ------
+        ValueError
+            If an unknown relation is given.
+        """
+        for name in load:
+            try:
+                loaders = EAGER_LOADS[name]
+            except KeyError:
+                raise ValueError("Unknown relation '{0}' to load. Must be one of {1}."
+                                 .format(name, ", ".join(sorted(EAGER_LOADS))))
+            query = query.options(*[loader(path) for loader, path in loaders])
+        return query
+
+    def find(self, entity, filter=None, options=None, load=None):
         """ Finds entities in the mapper.
 
         This method prepares the query (via SQLAlchemy).
@@ -288,6 +537,9 @@ class Mapper(object):
         filter : dict
             a filter
         options
+        load : list of strings, optional
+            Relations of the results which are loaded eagerly
+            (see `eager_load`), e.g. ``load=["params", "parent"]``.
 
         Returns
         -------
@@ -299,20 +551,88 @@ class Mapper(object):
             query = session.query(entity)
 
             if filter:
-                f = self.param_filter(entity, filter, options)
-                return query.filter(f)
-            else:
-                return query
+                query = self.filter_query(query, entity, filter, options)
+            if load:
+                query = self.eager_load(query, load)
+            return query
 
-    def find_first(self, entity, filter=None, options=None):
+    def find_first(self, entity, filter=None, options=None, load=None):
         """ Convenience method for ``find(...).first()``.
         """
-        return self.find(entity, filter, options).first()
+        return self.find(entity, filter, options, load).first()
 
-    def find_all(self, entity, filter=None, options=None):
+    def find_all(self, entity, filter=None, options=None, load=None):
         """ Convenience method for ``find(...).all()``.
         """
-        return self.find(entity, filter, options).all()
+        return self.find(entity, filter, options, load).all()
+
+    def iter_find(self, entity, filter=None, options=None, load=None, chunk_size=1000):
+        """ Iterates over the results of ``find(...)`` without keeping
+        all of them in memory.
+
+        The results are fetched in chunks of `chunk_size` entities. Once
+        all entities of a chunk have been processed, the session is flushed
+        and the entities are expunged from it, so that memory use does
+        not grow with the size of the result. (Which also means that a
+        processed entity must not be used after the loop has moved on.)
+
+        On PostgreSQL, the results are streamed from a server-side cursor
+        (``yield_per``), unless eager loading is requested with `load`.
+        Otherwise, the results are paged by their id (keyset pagination),
+        which needs one query per chunk but stays fast for late pages.
+
+        Parameters
+        ----------
+        entity : string or class
+            The entity to search for
+        filter : dict
+            a filter
+        options
+        load : list of strings, optional
+            Relations to load eagerly (see `eager_load`).
+        chunk_size : int, optional
+            The number of entities per chunk. (Defaults to 1000.)
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive.")
+
+        query = self.find(entity, filter, options, load).order_by(BaseEntity.id)
+
+        if self.connection.engine_name == "postgresql" and not load:
+            # yield_per does not go along with eagerly loaded collections
+            chunks = self._stream_chunks(query, chunk_size)
+        else:
+            chunks = self._keyset_chunks(query, chunk_size)
+
+        for chunk in chunks:
+            for obj in chunk:
+                yield obj
+            self.session.flush()
+            for obj in chunk:
+                if obj in self.session:
+                    self.session.expunge(obj)
+
+    def _stream_chunks(self, query, chunk_size):
+        query = query.execution_options(stream_results=True).yield_per(chunk_size)
+        results = iter(query)
+        while True:
+            chunk = list(itertools.islice(results, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def _keyset_chunks(self, query, chunk_size):
+        last_id = None
+        while True:
+            page = query
+            if last_id is not None:
+                page = page.filter(BaseEntity.id > last_id)
+            chunk = page.limit(chunk_size).all()
+            if not chunk:
+                return
+            # must be read before the chunk is expunged
+            last_id = chunk[-1].id
+            yield chunk
 
     def find_roots(self, entity=None):
         if not entity:
@@ -344,6 +664,156 @@ class Mapper(object):
                     the_set.add(rel)
         return list(the_set)
 
+    def descendants_of(self, entity, type=None):
+        """ Returns all descendants of `entity`, ordered by their distance.
+
+        If the closure table is maintained (see `Mapper`), this is a single
+        lookup in the closure table. Otherwise, `Entity.siblings` is used.
+
+        Parameters
+        ----------
+        entity: Entity
+            The entity whose children, grandchildren, … are returned.
+        type: string or class, optional
+            Only return descendants of this entity type.
+        """
+        if type is None:
+            klass = Entity
+        else:
+            klass = self.entity_by_name(type)
+
+        if not closure.is_maintained(self.session):
+            return [e for e in entity._hierarchy(upwards=False) if isinstance(e, klass)]
+
+        return (self.find(klass)
+                    .join(EntityClosure, EntityClosure.descendant_id == BaseEntity.id)
+                    .filter(EntityClosure.ancestor_id == entity.id)
+                    .filter(EntityClosure.depth > 0)
+                    .order_by(EntityClosure.depth, BaseEntity.id)
+                    .all())
+
+    def ancestors_of(self, entity):
+        """ Returns all ancestors of `entity`, starting with its parent.
+
+        If the closure table is maintained (see `Mapper`), this is a single
+        lookup in the closure table. Otherwise, `Entity.ancestors` is used.
+        """
+        if not closure.is_maintained(self.session):
+            return entity.ancestors()
+
+        return (self.find(Entity)
+                    .join(EntityClosure, EntityClosure.ancestor_id == BaseEntity.id)
+                    .filter(EntityClosure.descendant_id == entity.id)
+                    .filter(EntityClosure.depth > 0)
+                    .order_by(EntityClosure.depth)
+                    .all())
+
+    def rebuild_closure(self):
+        """ Re-creates the closure table of the entity hierarchy from scratch.
+
+        This is needed once for databases which have been written to
+        without ``closure_table=True``.
+
+        Returns
+        -------
+        rows: int
+            The number of rows in the closure table.
+        """
+        with self.auto_session as session:
+            session.flush()
+            return closure.rebuild(session.connection())
+
+    def check_closure(self):
+        """ Checks the closure table of the entity hierarchy for consistency.
+
+        Returns
+        -------
+        (missing, superfluous): tuple of sets
+            The ``(ancestor_id, descendant_id, depth)`` rows which are
+            missing from or wrongly in the closure table. Both are empty,
+            if the table is consistent.
+        """
+        with self.auto_session as session:
+            session.flush()
+            return closure.check(session.connection())
+
+    def data_stats(self):
+        """ Returns statistics about the storage of data chunks.
+        (See `xdapy.data.dedup_stats`.)
+        """
+        with self.auto_session as session:
+            return dedup_stats(session)
+
+    def data_summary(self, entities):
+        """ Returns the key, mimetype, size and number of chunks of the data
+        of many entities with a single query, without loading the data
+        objects. (See `xdapy.data.data_summary`.)
+
+        Parameters
+        ----------
+        entities: list
+            The entities to summarise.
+
+        Returns
+        -------
+        summary: dict
+            For every entity, a dict which maps each data key to a dict with
+            the items ``mimetype``, ``size``, ``stored_size`` and ``chunks``.
+        """
+        # The ids are taken from the identity keys, so that expired
+        # entities are not refreshed one by one.
+        ids = {}
+        for entity in entities:
+            key = instance_state(entity).key
+            ids[entity] = key[1][0] if key is not None else None
+        with self.auto_session as session:
+            by_id = data_summary(session, [id for id in ids.values() if id is not None])
+        return dict((entity, by_id.get(id, {})) for entity, id in ids.items())
+
+    def ingest_queue(self, workers=1, max_pending=None):
+        """ Returns the queue which stores data in the background
+        (see `xdapy.ingest.IngestQueue`), starting it on the first call.
+
+        The arguments only have an effect when the queue is started.
+        """
+        if self._ingest_queue is None:
+            self._ingest_queue = IngestQueue(self.connection, workers, max_pending)
+        return self._ingest_queue
+
+    def ingest(self, entity, key, path_or_file, mimetype=None, **kwargs):
+        """ Stores the data from a file in ``entity.data[key]`` in the
+        background and returns an `xdapy.ingest.IngestJob`.
+
+        An unsaved entity is saved first. The keyword arguments are passed
+        to `xdapy.ingest.IngestQueue.submit`.
+        """
+        if instance_state(entity).key is None:
+            self.save(entity)
+        return self.ingest_queue().submit(entity, key, path_or_file, mimetype, **kwargs)
+
+    def wait_for_ingestion(self):
+        """ Blocks until all data submitted with `ingest` has been stored."""
+        if self._ingest_queue is not None:
+            self._ingest_queue.wait()
+
+    def collect_data_garbage(self, grace_period=None):
+        """ Deletes the stored data blobs which are no longer referenced by
+        any data. (See `xdapy.data.collect_garbage`.)
+
+        Parameters
+        ----------
+        grace_period: number, optional
+            The minimal age in seconds of a blob to be deleted.
+            (Defaults to `xdapy.data.BLOB_GRACE_PERIOD`.)
+
+        Returns
+        -------
+        stats: dict
+            The number of deleted ``blobs`` and the number of ``bytes`` freed.
+        """
+        with self.auto_session as session:
+            return collect_garbage(session, grace_period)
+
     def find_by_id(self, entity, id):
         with self.auto_session as session:
             return session.query(entity).filter(BaseEntity.id==id).one()
@@ -474,6 +944,12 @@ class Mapper(object):
         """
         find_complex is able to search for structured data, including sub-queries
         where either one or all sub-items are being checked for a certain property.
+
+        The search tree is translated into SQL (joins and ``EXISTS`` clauses for
+        ``_parent``, ``_child`` and ``_context`` relations) as far as possible.
+        Parameter values are translated if they are strings or operators from
+        `xdapy.operators`. ``_with`` functions and other parameter functions
+        are evaluated in Python on the pre-filtered result.
         """
         proxy = SearchProxy((entity, the_filter))
         return proxy.find(self)
@@ -486,13 +962,10 @@ class Mapper(object):
         parameter_name --  The name describing the parameter.
         parameter_type -- The type the parameter is required to match
 
-        Raises:
-        TypeError -- If the parameters are not correctly specified
-        Some SQL error -- If the same entry already exists
+        An existing declaration of the parameter gets the new type.
+        (See `_write_declarations`.)
         """
-        with self.auto_session as session:
-            parameter_declaration = ParameterDeclaration(entity_name, parameter_name, parameter_type)
-            session.merge(parameter_declaration)
+        self._write_declarations({(entity_name, parameter_name): parameter_type})
 
     def is_consistent(self, entity_name, parameter_defaults):
         """Checks if an entity definition would be consistent with the current state
@@ -506,20 +979,179 @@ class Mapper(object):
             return parameter_defaults == db_defaults
 
     def register(self, *klasses):
-        """Registers the class and the class’s parameters."""
+        """Registers the class and the class’s parameters.
+
+        The parameter declarations of all classes are compared with the
+        database at once and only the missing ones are written. Registering
+        a class a second time does not query the database.
+        """
         for klass in klasses:
             if not issubclass(klass, Entity):
                 raise ValueError("Class must be subclass of Entity.")
             if klass is Entity:
                 raise ValueError("Entity is no valid class.")
-            self.registered_entities.append(klass)
+            self._add_entity(klass)
+
+        self._declare_parameters(klasses)
+
+    def _declare_parameters(self, klasses):
+        """ Writes the parameter declarations of those `klasses` which are
+        not known to be declared already. (See `_write_declarations`.)
+        """
+        declared_types = self._known_declared_types()
+        wanted = {}
+        for klass in klasses:
+            if klass.__name__ not in declared_types:
+                for name, paramtype in klass.declared_params.iteritems():
+                    wanted[klass.__name__, name] = paramtype
+
+        self._write_declarations(wanted)
+        declared_types.update(klass.__name__ for klass in klasses)
+
+    def _write_declarations(self, wanted):
+        """ Writes the parameter declarations in `wanted` (a dict which maps
+        ``(entity_name, parameter_name)`` to the parameter type) which are
+        not in the database yet (with a single executemany) and corrects
+        declarations with a different parameter type.
+        """
+        if wanted:
+            declarations = ParameterDeclaration.__table__
+            entity_names = sorted(set(entity_name for entity_name, _ in wanted))
+            with self.auto_session as session:
+                session.flush()
+                existing = {}
+                # keep the number of bound parameters low for SQLite
+                for start in range(0, len(entity_names), 500):
+                    rows = session.execute(select([declarations.c.entity_name,
+                                                   declarations.c.parameter_name,
+                                                   declarations.c.parameter_type],
+                        declarations.c.entity_name.in_(entity_names[start:start + 500])))
+                    existing.update(((row[0], row[1]), row[2]) for row in rows)
+
+                missing = [{"entity_name": entity_name, "parameter_name": name, "parameter_type": paramtype}
+                           for (entity_name, name), paramtype in sorted(wanted.iteritems())
+                           if (entity_name, name) not in existing]
+                if missing:
+                    session.execute(declarations.insert(), missing)
+
+                for (entity_name, name), paramtype in wanted.iteritems():
+                    if existing.get((entity_name, name), paramtype) != paramtype:
+                        session.execute(declarations.update()
+                                        .where(and_(declarations.c.entity_name == entity_name,
+                                                    declarations.c.parameter_name == name))
+                                        .values(parameter_type=paramtype))
+
+    def _known_declared_types(self):
+        """ Returns the set of the types whose parameters are known to
+        be declared. It is emptied when the tables have been dropped
+        with `Connection.drop_tables`.
+        """
+        if self._declared_generation != self.connection.table_generation:
+            self._declared_types.clear()
+            self._declared_generation = self.connection.table_generation
+        return self._declared_types
+
+    def _add_entity(self, klass):
+        """ Registers `klass` without declaring its parameters."""
+        self.registered_entities.append(klass)
+        self._index_entity(klass)
+
+    def _index_entity(self, klass):
+        """ Adds `klass` to the indexes which `entity_by_name` uses.
+        A class with the same polymorphic name replaces the old one.
+        """
+        self._registered_classes.add(klass)
+        previous = self._entities_by_name.get(klass.__name__)
+        self._entities_by_name[klass.__name__] = klass
+
+        # the type of a class which was created from its polymorphic name
+        # (e.g. by `register_type`) is the part before the hash
+        type = klass.__name__.split('_')[0]
+        candidates = self._entities_by_type.setdefault(type, [])
+        if previous in candidates:
+            candidates[candidates.index(previous)] = klass
+        else:
+            candidates.append(klass)
+
+        if self._deferred_types.pop(klass.__name__, None) is not None:
+            self._deferred_by_type[type].remove(klass.__name__)
+
+    def _create_deferred(self, polymorphic_name):
+        """ Creates the class of a deferred type and returns it."""
+        klass = deferred_entity_class(polymorphic_name)
+        if polymorphic_name in self._deferred_types:
+            self._add_entity(klass)
+        return klass
+
+    def load_types_from_db(self, lazy=True):
+        """ Registers all entity types which are declared in the database.
+
+        This has the same effect as::
+
+            for entity_name, declared_params in mapper.entities_from_db():
+                mapper.register_type(entity_name, declared_params)
+
+        but the declarations are read with a single query and not written
+        back to the database. Types which are registered already are skipped.
+
+        Parameters
+        ----------
+        lazy: bool, optional
+            If true, the class of a type is only created (and mapped by
+            SQLAlchemy) when it is first used: when it is looked up by
+            name (e.g. by `entity_by_name`, `find_all` or the importers) or
+            when an entity of this type is loaded from the database.
+            (Defaults to ``True``.)
+
+        Returns
+        -------
+        list of str
+            The polymorphic names of the newly registered types.
+        """
+        ref = weakref.ref(self)
+        def created(klass):
+            mapper = ref()
+            if mapper is not None and klass.__name__ in mapper._deferred_types:
+                mapper._add_entity(klass)
+
+        loaded = []
+        for polymorphic_name, declared_params in self.entities_from_db():
+            if polymorphic_name in self._entities_by_name or polymorphic_name in self._deferred_types:
+                continue
+            loaded.append(polymorphic_name)
+            self._known_declared_types().add(polymorphic_name)
+
+            klass = defer_entity(polymorphic_name, declared_params, created if lazy else None)
+            if klass is not None or not lazy:
+                # the class may have been created already for another mapper
+                self._add_entity(klass or deferred_entity_class(polymorphic_name))
+                continue
+            self._deferred_types[polymorphic_name] = declared_params
+            type = polymorphic_name.split('_')[0]
+            self._deferred_by_type.setdefault(type, []).append(polymorphic_name)
+        return loaded
 
-            for name, paramtype in klass.declared_params.iteritems():
-                self._register_parameter(klass.__name__, name, paramtype)
+    @property
+    def registered_entity_names(self):
+        """ A dict which maps the polymorphic names of all registered
+        entities to their classes. (It must not be modified.)
+
+        Types which have been deferred by `load_types_from_db` are only
+        included after their classes have been created.
+        """
+        return self._entities_by_name
+
+    def entities_by_type(self, type):
+        """ Returns the registered entity classes of the given type, i.e. whose
+        name without the hash of the declared parameters is `type`.
+        """
+        for polymorphic_name in list(self._deferred_by_type.get(type, [])):
+            self._create_deferred(polymorphic_name)
+        return list(self._entities_by_type.get(type, []))
 
     def is_registered(self, name, declared_params):
         polymorphic_name = calculate_polymorphic_name(name, declared_params)
-        return polymorphic_name in (t.__name__ for t in self.registered_entities)
+        return polymorphic_name in self._entities_by_name or polymorphic_name in self._deferred_types
 
     def register_type(self, name, declared_params):
         new_type = create_entity(name, declared_params=declared_params)
@@ -535,16 +1167,21 @@ class Mapper(object):
         name: string or subclass of Entity
             The name of the entity object to find.
         """
-        # maybe name was a class already, then we're done
-        if name in self.registered_entities:
-            return name
-
-        klasses = dict((sub.__name__, sub) for sub in self.registered_entities)
-        if name in klasses:
-            return klasses[name]
-        klasses_guessed = [cls for cls in klasses if cls.startswith(name + "_") or cls == name]
+        if not isinstance(name, basestring):
+            # maybe name was a class already, then we're done
+            if name in self._registered_classes:
+                return name
+            raise TypeError("""Entity "{0}" is not registered.""".format(name))
+
+        if name in self._entities_by_name:
+            return self._entities_by_name[name]
+        if name in self._deferred_types:
+            return self._create_deferred(name)
+        klasses_guessed = self._entities_by_type.get(name, []) + self._deferred_by_type.get(name, [])
         if len(klasses_guessed) == 1:
-            return klasses[klasses_guessed[0]]
+            if isinstance(klasses_guessed[0], basestring):
+                return self._create_deferred(klasses_guessed[0])
+            return klasses_guessed[0]
         if len(klasses_guessed) > 1:
             raise ValueError("""More than one entity with name "{0}" registered.""".format(name))
 
@@ -571,7 +1208,7 @@ class Mapper(object):
         entities_params = []
 
         with self.auto_session as session:
-            all_entity_params = session.query(ParameterDeclaration)
+            all_entity_params = session.query(ParameterDeclaration).order_by(ParameterDeclaration.entity_name)
             for entity_name, param_decl in itertools.groupby(all_entity_params, lambda e: e.entity_name):
                 entities_params.append((entity_name, dict((e.parameter_name, e.parameter_type) for e in param_decl)))
 
@@ -593,38 +1230,31 @@ class Mapper(object):
         """
         # check that the entities are compatible:
         # ie. no parameter changes its type
-        incompatibles = dict((key, (oldv, newv))
-            for key, oldv in old_entity_type.declared_params.iteritems()
-            for newv in (new_entity_type.declared_params.get(key),)
-            if newv and oldv != newv)
-
-        if incompatibles:
-            info = ""
-            for (key, (oldv, newv)) in incompatibles.iteritems():
-                info += "\n    Parameter %r changed from %r to %r." % (key, oldv, newv)
-            raise ValueError("Incompatible parameter lists:" + info)
-
-        if before:
-            for obj in self.find(old_entity_type):
-                obj.params = before(obj, obj.params)
-
-        objs = []
-        entity_ids = []
-        with self.auto_session as session:
-            for old_obj in self.find(old_entity_type):
-                objs.append(old_obj)
-                entity_ids.append(old_obj.id)
-                logger.debug("Changing type of %r from %r to %r." % (old_obj, old_obj._type, new_entity_type))
-                old_obj._type = new_entity_type #.__mapper_args__['polymorphic_identity']
-
-        self.session.identity_map.prune()
-
-        for obj in objs:
-            self.session.expunge(obj)
-
-        if after:
-            for obj in self.find(new_entity_type).filter(BaseEntity.id.in_(entity_ids)):
-                obj.params = after(obj, obj.params)
+        check_compatible(old_entity_type.declared_params, new_entity_type.declared_params)
+
+        # the replicas might not know all entities of the old type
+        with self.use_primary:
+            if before:
+                for obj in self.find(old_entity_type):
+                    obj.params = before(obj, obj.params)
+
+            objs = []
+            entity_ids = []
+            with self.auto_session as session:
+                for old_obj in self.find(old_entity_type):
+                    objs.append(old_obj)
+                    entity_ids.append(old_obj.id)
+                    logger.debug("Changing type of %r from %r to %r." % (old_obj, old_obj._type, new_entity_type))
+                    old_obj._type = new_entity_type #.__mapper_args__['polymorphic_identity']
+
+            self.session.identity_map.prune()
+
+            for obj in objs:
+                self.session.expunge(obj)
+
+            if after:
+                for obj in self.find(new_entity_type).filter(BaseEntity.id.in_(entity_ids)):
+                    obj.params = after(obj, obj.params)
 
 
     def __repr__(self):
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+
+"""
+Merges the content of one database into another.
+
+Entities are identified across databases by their ``unique_id``: An entity
+of the source is created in the target only if no entity with the same
+``unique_id`` exists there. Otherwise, its parameters and data are written
+over those of the existing entity (parameters and data keys which only
+the target has are kept).
+
+Everything is copied with plain SQL in batches of entities, so that neither
+database is ever loaded completely and only the data chunks which the
+target does not have yet (see `xdapy.data.DataBlob`) are transferred::
+
+    from xdapy.merge import merge
+    stats = merge(Connection.profile("lab"), Connection.profile("archive"),
+                  type_map={OldExperiment: Experiment})
+
+The merge runs in three stages: First, the entities with their parameters
+and data; then the parent–child relations; and finally the contexts. Each
+batch is committed on its own. A merge which has been interrupted may
+simply be started again, as every step skips what already is in the
+target. To also skip the batches which have been done, a `state` dict may
+be passed, which is updated after every batch and may be stored (e.g. as
+JSON) in between.
+
+.. note::
+    The merge writes to the target database without going through its
+    sessions. Objects which have been loaded from the target before should
+    be expired afterwards (``mapper.session.expire_all()``).
+"""
+
+__docformat__ = "restructuredtext"
+
+__authors__ = ['"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
+
+from sqlalchemy.sql import select, and_, bindparam
+
+from xdapy import closure
+from xdapy.data import Data, DataChunks, DataBlob, _change_references
+from xdapy.mapper import check_compatible
+from xdapy.parameters import Parameter, parameter_ids, parameter_for_type
+from xdapy.structures import BaseEntity, Context, Entity, ParameterDeclaration
+
+import logging
+logger = logging.getLogger(__name__)
+
+#: The stages of a merge, in order.
+STAGES = ["entities", "parents", "contexts"]
+
+# The number of values which are put into a single ``IN (...)`` clause.
+# (SQLite allows no more than 999 variables per statement.)
+_IN_SIZE = 500
+
+entities = BaseEntity.__table__
+parameters = Parameter.__table__
+declarations = ParameterDeclaration.__table__
+contexts = Context.__table__
+data_table = Data.__table__
+chunks = DataChunks.__table__
+blobs = DataBlob.__table__
+
+_DATA_COLUMNS = ["mimetype", "compression", "chunk_size", "array_dtype", "array_shape", "array_order",
+                 "length", "stored_length", "chunk_count"]
+
+
+def _chunked(values, size=_IN_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def _select_in(connection, columns, column, values, *whereclauses):
+    """ Yields the rows of ``SELECT columns WHERE column IN values`` using
+    as many statements as needed.
+    """
+    for part in _chunked(values):
+        for row in connection.execute(select(columns, and_(column.in_(part), *whereclauses))):
+            yield row
+
+def _ids_by_unique_id(connection, unique_ids):
+    return dict(_select_in(connection, [entities.c.uniqueid, entities.c.id],
+                           entities.c.uniqueid, set(unique_ids)))
+
+def _declared_types(connection):
+    """ Returns the declared parameters of all entity types in the database."""
+    types = {}
+    for row in connection.execute(select([declarations])):
+        types.setdefault(row.entity_name, {})[row.parameter_name] = row.parameter_type
+    return types
+
+def _type_info(entity_type, declared):
+    """ Returns the polymorphic name and the declared parameters of `entity_type`,
+    which is either an `Entity` class or the name of a type in `declared`.
+    """
+    if isinstance(entity_type, type) and issubclass(entity_type, Entity):
+        return entity_type.__name__, entity_type.declared_params
+    if entity_type in declared:
+        return entity_type, declared[entity_type]
+
+    guessed = [name for name in declared if name.split("_")[0] == entity_type]
+    if len(guessed) == 1:
+        return guessed[0], declared[guessed[0]]
+    if len(guessed) > 1:
+        raise ValueError("""More than one entity with name "{0}" declared.""".format(entity_type))
+    raise ValueError("""No entity with name "{0}" declared.""".format(entity_type))
+
+def resolve_type_map(source, target, type_map):
+    """ Returns the polymorphic names for all types in `type_map` and checks
+    that the types are compatible (as `xdapy.mapper.Mapper.rebrand` does).
+
+    Parameters
+    ----------
+    source, target
+        SQLAlchemy connections to the source and target database.
+    type_map: dict
+        Maps the entity types of the source to the types they should have
+        in the target. The types may be given as `Entity` classes or names.
+
+    Returns
+    -------
+    (types, declared): tuple
+        A dict which maps the old to the new polymorphic names and a dict
+        with the declared parameters of every new type.
+
+    Raises
+    ------
+    ValueError
+        If a type is unknown or the parameter lists are incompatible.
+    """
+    declared = _declared_types(target)
+    declared.update(_declared_types(source))
+
+    types = {}
+    new_declared = {}
+    for old, new in (type_map or {}).iteritems():
+        old_name, old_params = _type_info(old, declared)
+        new_name, new_params = _type_info(new, declared)
+        check_compatible(old_params, new_params)
+        types[old_name] = new_name
+        new_declared[new_name] = new_params
+    return types, new_declared
+
+def _merge_declarations(source, target, new_declared):
+    """ Adds the parameter declarations of the source and those of the
+    new types to the target, unless they exist already.
+    """
+    wanted = {}
+    for row in source.execute(select([declarations])):
+        wanted[(row.entity_name, row.parameter_name)] = row.parameter_type
+    for entity_name, params in new_declared.iteritems():
+        for parameter_name, parameter_type in params.iteritems():
+            wanted[(entity_name, parameter_name)] = parameter_type
+
+    existing = set((row.entity_name, row.parameter_name)
+                   for row in target.execute(select([declarations.c.entity_name, declarations.c.parameter_name])))
+    missing = [{"entity_name": entity_name, "parameter_name": parameter_name, "parameter_type": parameter_type}
+               for (entity_name, parameter_name), parameter_type in wanted.iteritems()
+               if (entity_name, parameter_name) not in existing]
+    if missing:
+        target.execute(declarations.insert(), missing)
+
+def _source_batches(source, batch_size, after):
+    """ Yields the entities of the source in batches, ordered by id.
+    Each row has the ``id``, ``type`` and ``uniqueid`` of the entity and
+    the ``parent_uniqueid``.
+    """
+    parent = entities.alias("parent")
+    query = select([entities.c.id, entities.c.type, entities.c.uniqueid, parent.c.uniqueid.label("parent_uniqueid")],
+                   from_obj=[entities.outerjoin(parent, entities.c.parent_id == parent.c.id)])
+    last_id = after
+    while True:
+        batch_query = query.order_by(entities.c.id).limit(batch_size)
+        if last_id is not None:
+            batch_query = batch_query.where(entities.c.id > last_id)
+        rows = source.execute(batch_query).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        # entities without a unique_id cannot be identified in the target
+        yield [row for row in rows if row.uniqueid is not None], last_id
+
+def _merge_entities(source, target, batch, types, stats):
+    """ Creates the entities of `batch` which the target does not have
+    and returns a dict which maps their source ids to the target ids.
+    """
+    existing = _ids_by_unique_id(target, [row.uniqueid for row in batch])
+    new = [{"type": types.get(row.type, row.type), "uniqueid": row.uniqueid}
+           for row in batch if row.uniqueid not in existing]
+    if new:
+        target.execute(entities.insert(), new)
+        existing = _ids_by_unique_id(target, [row.uniqueid for row in batch])
+    stats["entities"] += len(new)
+    stats["existing_entities"] += len(batch) - len(new)
+    return dict((row.id, existing[row.uniqueid]) for row in batch)
+
+def _merge_parameters(source, target, id_map, stats):
+    """ Copies the parameters of the source entities in `id_map`, replacing
+    parameters of the same name in the target.
+    """
+    values = {}
+    for type_name in parameter_ids:
+        values_table = parameter_for_type(type_name).__table__
+        for row in _select_in(source, [parameters.c.entity_id, parameters.c.name, values_table.c.value],
+                              parameters.c.entity_id, id_map.keys(), parameters.c.id == values_table.c.id):
+            values[(id_map[row.entity_id], row.name)] = (type_name, row.value)
+    if not values:
+        return
+
+    replaced = [row.id for row in _select_in(target, [parameters.c.id, parameters.c.entity_id, parameters.c.name],
+                                              parameters.c.entity_id, id_map.values())
+                if (row.entity_id, row.name) in values]
+    for part in _chunked(replaced):
+        for type_name in parameter_ids:
+            values_table = parameter_for_type(type_name).__table__
+            target.execute(values_table.delete().where(values_table.c.id.in_(part)))
+        target.execute(parameters.delete().where(parameters.c.id.in_(part)))
+
+    target.execute(parameters.insert(), [{"entity_id": entity_id, "name": name, "type": type_name}
+                                         for (entity_id, name), (type_name, value) in values.iteritems()])
+    parameter_id = dict(((row.entity_id, row.name), row.id) for row in
+                        _select_in(target, [parameters.c.id, parameters.c.entity_id, parameters.c.name],
+                                   parameters.c.entity_id, id_map.values()))
+    for type_name in parameter_ids:
+        rows = [{"id": parameter_id[key], "value": value}
+                for key, (value_type, value) in values.iteritems() if value_type == type_name]
+        if rows:
+            target.execute(parameter_for_type(type_name).__table__.insert(), rows)
+    stats["parameters"] += len(values)
+
+def _chunk_list(connection, data_id):
+    return [tuple(row) for row in connection.execute(
+        select([chunks.c.index, chunks.c.blob_hash, chunks.c.length, chunks.c.uncompressed_length],
+               chunks.c.data_id == data_id).order_by(chunks.c.index))]
+
+def _copy_blobs(source, target, hashes, stats):
+    """ Copies the blobs with the given hashes which the target does not have,
+    one at a time.
+    """
+    present = set(row.hash for row in _select_in(target, [blobs.c.hash], blobs.c.hash, hashes))
+    for blob_hash in hashes:
+        if blob_hash in present:
+            continue
+        blob = source.execute(select([blobs.c.data, blobs.c.length], blobs.c.hash == blob_hash)).first()
+        target.execute(blobs.insert(), hash=blob_hash, data=blob.data, length=blob.length, refcount=0)
+        stats["blobs"] += 1
+        stats["bytes"] += blob.length or 0
+
+def _merge_data(source, target, id_map, stats):
+    """ Copies the data of the source entities in `id_map`. Data whose chunks
+    are equal in the target is left alone; other data of the same key is
+    replaced.
+    """
+    for row in _select_in(source, [data_table], data_table.c.entity_id, id_map.keys()):
+        entity_id = id_map[row.entity_id]
+        source_chunks = _chunk_list(source, row.id)
+        values = dict((column, row[column]) for column in _DATA_COLUMNS)
+
+        data_id = target.execute(select([data_table.c.id], and_(data_table.c.entity_id == entity_id,
+                                                                data_table.c.key == row["key"]))).scalar()
+        if data_id is None:
+            data_id = target.execute(data_table.insert(), entity_id=entity_id, key=row["key"],
+                                     **values).inserted_primary_key[0]
+        else:
+            target.execute(data_table.update().where(data_table.c.id == data_id).values(**values))
+            if _chunk_list(target, data_id) == source_chunks:
+                continue
+            _change_references(target, data_id, -1)
+            target.execute(chunks.delete().where(chunks.c.data_id == data_id))
+
+        if source_chunks:
+            _copy_blobs(source, target, set(chunk[1] for chunk in source_chunks), stats)
+            target.execute(chunks.insert(), [{"data_id": data_id, "index": index, "blob_hash": blob_hash,
+                                              "length": length, "uncompressed_length": uncompressed_length}
+                                             for index, blob_hash, length, uncompressed_length in source_chunks])
+            _change_references(target, data_id, 1)
+        stats["data"] += 1
+
+def _merge_parents(source, target, batch, stats):
+    """ Sets the parents of the entities in `batch`."""
+    children = [row for row in batch if row.parent_uniqueid is not None]
+    if not children:
+        return
+    ids = _ids_by_unique_id(target, [row.uniqueid for row in children] +
+                                    [row.parent_uniqueid for row in children])
+    target.execute(entities.update().where(entities.c.id == bindparam("child_id"))
+                                    .values(parent_id=bindparam("new_parent_id")),
+                   [{"child_id": ids[row.uniqueid], "new_parent_id": ids[row.parent_uniqueid]}
+                    for row in children])
+    stats["parents"] += len(children)
+
+def _merge_contexts(source, target, batch, stats):
+    """ Adds the contexts held by the entities in `batch`, unless the
+    target has them already.
+    """
+    unique_ids = dict((row.id, row.uniqueid) for row in batch)
+    attachment = entities.alias("attachment")
+    rows = list(_select_in(source, [contexts.c.entity_id, contexts.c.connection_type,
+                                    attachment.c.uniqueid.label("attachment_uniqueid")],
+                           contexts.c.entity_id, unique_ids.keys(),
+                           contexts.c.connected_id == attachment.c.id))
+    if not rows:
+        return
+
+    ids = _ids_by_unique_id(target, unique_ids.values() + [row.attachment_uniqueid for row in rows])
+    existing = set(tuple(row) for row in _select_in(
+        target, [contexts.c.entity_id, contexts.c.connected_id, contexts.c.connection_type],
+        contexts.c.entity_id, [ids[unique_id] for unique_id in unique_ids.values()]))
+    wanted = set((ids[unique_ids[row.entity_id]], ids[row.attachment_uniqueid], row.connection_type)
+                 for row in rows if row.attachment_uniqueid in ids)
+    missing = [{"entity_id": holder_id, "connected_id": attachment_id, "connection_type": connection_type}
+               for holder_id, attachment_id, connection_type in wanted - existing]
+    if missing:
+        target.execute(contexts.insert(), missing)
+    stats["contexts"] += len(missing)
+
+def merge(source, target, type_map=None, batch_size=500, data=True, state=None, closure_table=None):
+    """ Merges all entities, parameters, contexts and data of `source` into `target`.
+
+    Parameters
+    ----------
+    source, target: xdapy.connection.Connection
+        The databases to merge from and into.
+    type_map: dict, optional
+        Maps the entity types of the source to the types which the entities
+        should have in the target, given as `Entity` classes or type names.
+        As with `xdapy.mapper.Mapper.rebrand`, the parameter lists of both
+        types must be compatible. Existing entities of the target keep their type.
+    batch_size: int, optional
+        The number of source entities which are merged (and committed) at once.
+    data: bool, optional
+        If false, the data of the entities is not merged. (Defaults to ``True``.)
+    state: dict, optional
+        The progress of the merge. It is updated after every committed batch
+        with the current ``stage`` and the ``last_id`` of the source entities
+        in that stage. Passing it to a later call skips everything which
+        has been done. Finally, the stage is ``"done"``.
+    closure_table: bool, optional
+        If true, the closure table of the target is rebuilt afterwards.
+        (See `xdapy.closure`.) The entities are inserted without the
+        session, so the closure table is not kept up to date on the fly.
+        Defaults to whether the session of `target` maintains the closure
+        table, e.g. because of ``Mapper(target, closure_table=True)``.
+
+    Returns
+    -------
+    stats: dict
+        The number of new and existing ``entities``, of merged ``parameters``,
+        ``parents``, ``contexts`` and ``data`` and of copied ``blobs`` and ``bytes``.
+
+    Raises
+    ------
+    ValueError
+        If the `type_map` is invalid.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be a positive integer.")
+    if state is None:
+        state = {}
+
+    stats = dict.fromkeys(["entities", "existing_entities", "parameters", "parents",
+                           "contexts", "data", "blobs", "bytes"], 0)
+
+    source_connection = source.engine.connect()
+    target_connection = target.engine.connect()
+    try:
+        with target_connection.begin():
+            types, new_declared = resolve_type_map(source_connection, target_connection, type_map)
+            _merge_declarations(source_connection, target_connection, new_declared)
+
+        if state.get("stage") == "done":
+            remaining = []
+        elif state.get("stage") in STAGES:
+            remaining = STAGES[STAGES.index(state["stage"]):]
+        else:
+            remaining = STAGES
+
+        for position, stage in enumerate(remaining):
+            after = state.get("last_id") if state.get("stage") == stage else None
+
+            for batch, last_id in _source_batches(source_connection, batch_size, after):
+                with target_connection.begin():
+                    if stage == "entities":
+                        id_map = _merge_entities(source_connection, target_connection, batch, types, stats)
+                        _merge_parameters(source_connection, target_connection, id_map, stats)
+                        if data:
+                            _merge_data(source_connection, target_connection, id_map, stats)
+                    elif stage == "parents":
+                        _merge_parents(source_connection, target_connection, batch, stats)
+                    else:
+                        _merge_contexts(source_connection, target_connection, batch, stats)
+                state.update(stage=stage, last_id=last_id)
+                logger.debug("Merged %s up to source id %d.", stage, last_id)
+
+            following = remaining[position + 1] if position + 1 < len(remaining) else "done"
+            state.update(stage=following, last_id=None)
+
+        if closure_table is None:
+            closure_table = closure.is_maintained(target.session)
+        if closure_table:
+            with target_connection.begin():
+                closure.rebuild(target_connection)
+    finally:
+        source_connection.close()
+        target_connection.close()
+
+    logger.info("Merge finished: %r", stats)
+    return stats
@@ -18,40 +18,48 @@ __authors__ = ['"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
 
 from sqlalchemy import and_
 
+def _operator(test):
+    """ Marks `test` as an operator which gives the same result for a
+    value and, as an SQL expression, for a column. Only such functions
+    are translated into SQL by `xdapy.find`.
+    """
+    test.is_operator = True
+    return test
+
 def ge(v):
     """ Greater or even than.
 
     ``ge(v)(t) == t >= v``
     """
-    return lambda type: type >= v
+    return _operator(lambda type: type >= v)
 
 def gt(v):
     """ Greater than.
 
     ``gt(v)(t) == t > v``
     """
-    return lambda type: type > v
+    return _operator(lambda type: type > v)
 
 def le(v):
     """ Lesser or equal than.
 
     ``le(v)(t) == t <= v``
     """
-    return lambda type: type <= v
+    return _operator(lambda type: type <= v)
 
 def lt(v):
     """ Lesser than.
 
     ``lt(v)(t) == t < v``
     """
-    return lambda type: type < v
+    return _operator(lambda type: type < v)
 
 def between(v1, v2):
     """ Between.
 
     ``between(v1, v2)(t) == t >= v1 and t <= v2``
     """
-    return lambda type: and_(ge(v1)(type), le(v2)(type))
+    return _operator(lambda type: and_(ge(v1)(type), le(v2)(type)))
 
 
 def eq(v):
@@ -60,7 +68,7 @@ def eq(v):
     ``eq(v)(t) == (v == t)``
     """
 
-    return lambda type: type == v
+    return _operator(lambda type: type == v)
 
 def like(v):
     """ Like.
@@ -68,7 +76,7 @@ def like(v):
     ``like(v)(t) == t.like(v)``
     """
 
-    return lambda type: type.like(v) # TODO or the other way round?
+    return _operator(lambda type: type.like(v)) # TODO or the other way round?
 
 
 
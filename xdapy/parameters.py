@@ -13,7 +13,7 @@ from datetime import date, time, datetime
 from sqlalchemy import Sequence, Column, ForeignKey, \
      String, Integer, Float, Date, Time, DateTime, Boolean
 from sqlalchemy.orm import validates
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.schema import UniqueConstraint, Index
 
 from xdapy import Base
 from xdapy.errors import StringConversionError
@@ -30,15 +30,19 @@ class Parameter(Base):
     entity_id = Column(Integer, ForeignKey("entities.id"), nullable=False,
             doc="Foreign key reference to the entity.id.")
 
-    name = Column('name', String(40), index=True,
+    name = Column('name', String(40),
             doc="The name of the parameter.")
     type = Column('type', String(20), nullable=False,
             doc="The type of the parameter.")
 
     __tablename__ = 'parameters'
-    __table_args__ = (UniqueConstraint(entity_id, name), {})
+    # The composite index on (name, entity_id) serves the parameter joins
+    # in `Mapper.filter_query` and also covers look-ups by name alone.
+    __table_args__ = (UniqueConstraint(entity_id, name),
+                      Index('ix_parameters_name_entity_id', name, entity_id), {})
     #: Type is the polymorphic parameter.
-    __mapper_args__ = {'polymorphic_on':type, 'polymorphic_identity':'parameter'}
+    __mapper_args__ = {'polymorphic_on':type, 'polymorphic_identity':'parameter',
+                       'with_polymorphic': '*'}
 
     @validates('name')
     def validate_name(self, key, parameter):
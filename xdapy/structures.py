@@ -14,10 +14,12 @@ __authors__ = ['"Hannah Dold" <hannah.dold@mailbox.tu-berlin.de>',
 
 import collections
 import itertools
+import threading
 
 from sqlalchemy import Column, ForeignKey, String, Integer, event
-from sqlalchemy.schema import UniqueConstraint
-from sqlalchemy.orm import relationship, backref, validates
+from sqlalchemy.schema import UniqueConstraint, Index
+from sqlalchemy.sql import select, and_, literal_column
+from sqlalchemy.orm import relationship, backref, validates, joinedload, configure_mappers
 from sqlalchemy.orm.session import Session
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm.collections import column_mapped_collection, MappedCollection
@@ -29,24 +31,63 @@ from xdapy.data import Data, _DataAssoc
 from xdapy.errors import EntityDefinitionError, InsertionError, MissingSessionError, DataInconsistencyError
 from xdapy.utils.algorithms import gen_uuid, hash_dict
 
+#: The maximum number of generations which `Entity.ancestors` and
+#: `Entity.siblings` traverse, if no depth is given. This guards the
+#: recursive queries against cycles in the parent–child relation.
+MAX_HIERARCHY_DEPTH = 1000
+
+
+# caches the polymorphic names by class name and declared parameters
+_polymorphic_names = {}
 
 def calculate_polymorphic_name(name, declared_params):
+    """ Returns the name of the entity type with the hash of its declared
+    parameters, e.g. ``"Observer_e1c05e3bba82a039dd8d410aaf50f815"``.
+
+    The result is cached for each name and set of declared parameters.
+
+    Raises
+    ------
+    EntityDefinitionError
+        If the name contains more than one underscore or if the hash after
+        the underscore does not match the declared parameters.
+    """
+    # str and unicode names are equal but give names of their own type
+    key = (type(name), name, frozenset(declared_params.iteritems()))
+    try:
+        return _polymorphic_names[key]
+    except KeyError:
+        pass
+
     split_name = name.split('_')
     if len(split_name) > 2:
         raise EntityDefinitionError("Entity class must not contain more than one underscore.")
     elif len(split_name) == 2:
         # Try, whether the second part is a correct hash.
         the_hash = hash_dict(declared_params)
-        if split_name[1] == the_hash:
-            return name
-        else:
+        if split_name[1] != the_hash:
             raise EntityDefinitionError("Entity name has incorrect hash after underscore.")
+        polymorphic_name = name
+    else:
+        # No underscore. Good!
+        # Create hash from sorted declared_params
+        the_hash = hash_dict(declared_params)
+        polymorphic_name = name + "_" + the_hash
+
+    _polymorphic_names[key] = polymorphic_name
+    return polymorphic_name
 
-    # No underscore. Good!
-    # Create hash from sorted declared_params
-    the_hash = hash_dict(declared_params)
 
-    return name + "_" + the_hash
+class _PolymorphicMap(dict):
+    """ The polymorphic map of `BaseEntity`. When an entity of a deferred
+    type (see `defer_entity`) is loaded, its class is created on the fly.
+    """
+    def __missing__(self, polymorphic_name):
+        if polymorphic_name not in _deferred_types:
+            raise KeyError(polymorphic_name)
+        deferred_entity_class(polymorphic_name)
+        configure_mappers()
+        return dict.__getitem__(self, polymorphic_name)
 
 
 class BaseEntity(Base):
@@ -80,7 +121,7 @@ class BaseEntity(Base):
     __tablename__ = 'entities' #: The db table name.
 
     #: Subclasses of `BaseEntity` should differ in their `_type` column.
-    __mapper_args__ = {'polymorphic_on': _type}
+    __mapper_args__ = {'polymorphic_on': _type, '_polymorphic_map': _PolymorphicMap()}
 
     @property
     def type(self):
@@ -362,7 +403,7 @@ class Entity(BaseEntity):
         {}
         >>> obj.data["data_key"].put("random string")
         >>> obj.data["data_key"]
-        DataProxy(mimetype=None, chunks=1, size=13)
+        DataProxy(mimetype=None, chunks=1, size=13, stored_size=13)
         >>> obj.data["data_key"].get_string()
         "random string"
         >>> obj.data.keys()
@@ -426,26 +467,101 @@ class Entity(BaseEntity):
             if v is not None:
                 self.params[n] = v
 
-    def ancestors(self):
+    def _hierarchy(self, upwards, depth=None):
+        """ Returns the ancestors (if `upwards` is true) or the descendants
+        of this entity, ordered by their distance.
+
+        If the entity has been saved, all of them are fetched together with
+        their parameters in a single recursive query (``WITH RECURSIVE``).
+        Otherwise the in-memory relations are traversed.
+
+        Parameters
+        ----------
+        upwards: bool
+            Whether to follow the `parent` or the `children` relation.
+        depth: int, optional
+            The maximum distance from this entity. (Defaults to
+            `MAX_HIERARCHY_DEPTH`.)
+        """
+        if depth is None:
+            depth = MAX_HIERARCHY_DEPTH
+
+        session = Session.object_session(self)
+        if session is None or self.id is None:
+            return self._hierarchy_in_memory(upwards, depth)
+
+        entities = BaseEntity.__table__
+        node = entities.alias()
+
+        # The values are inlined because SQLAlchemy does not keep the order
+        # of positional bind parameters inside of a CTE.
+        start = literal_column(str(int(self.id)))
+        max_depth = literal_column(str(int(depth)))
+
+        hierarchy = (select([entities.c.id, entities.c.parent_id, literal_column("0").label("depth")])
+                     .where(entities.c.id == start)
+                     .cte("hierarchy", recursive=True))
+
+        if upwards:
+            step = node.c.id == hierarchy.c.parent_id
+        else:
+            step = node.c.parent_id == hierarchy.c.id
+
+        hierarchy = hierarchy.union_all(
+            select([node.c.id, node.c.parent_id, hierarchy.c.depth + literal_column("1")])
+            .where(and_(step, hierarchy.c.depth < max_depth)))
+
+        # The entity itself (depth 0) is part of the result. Apart from
+        # making the cycle check simple, this ensures that the statement
+        # always yields rows: The sqlite3 module of Python 2 does not
+        # provide a result description for empty results of statements
+        # which begin with WITH.
+        rows = (session.query(Entity, hierarchy.c.depth)
+                .join(hierarchy, Entity.id == hierarchy.c.id)
+                .order_by(hierarchy.c.depth, Entity.id)
+                .options(joinedload(Entity._params))
+                .all())
+
+        # In a consistent hierarchy, every entity is reached exactly once.
+        if len(set(entity for entity, _ in rows)) != len(rows):
+            raise DataInconsistencyError("Circular reference")
+        related = [entity for entity, distance in rows if distance > 0]
+        return related
+
+    def _hierarchy_in_memory(self, upwards, depth):
+        related = []
+        level = [self]
+        while level and depth > 0:
+            if upwards:
+                level = [node.parent for node in level if node.parent]
+            else:
+                level = [child for node in level for child in node.children]
+            for node in level:
+                if node in related or node is self:
+                    raise DataInconsistencyError("Circular reference")
+                related.append(node)
+            depth -= 1
+        return related
+
+    def ancestors(self, depth=None):
         """ Returns a list of all parent and grand-parent entities.
+
+        Parameters
+        ----------
+        depth: int, optional
+            Only return ancestors up to this many generations.
         """
-        node = self
-        parents = []
-        while node.parent:
-            node = node.parent
-            if node in parents:
-                raise DataInconsistencyError("Circular reference")
-            parents.append(node)
-        return parents
-
-    def siblings(self):
-        """ Returns a list of all children and siblings.
+        return self._hierarchy(upwards=True, depth=depth)
+
+    def siblings(self, depth=None):
+        """ Returns a set of all children and siblings.
+
+        Parameters
+        ----------
+        depth: int, optional
+            Only return descendants up to this many generations.
         """
-        children = set()
-        children.update(self.children)
-        for child in self.children:
-            children.update(child.siblings())
-        return children
+        return set(self._hierarchy(upwards=False, depth=depth))
 
     def __repr__(self):
         return "{cls}(id={id!s}, unique_id={unique_id!s})".format(cls=self.type, id=self.id, unique_id=self.unique_id)
@@ -581,6 +697,58 @@ def create_entity(name, declared_params):
         name = str(name)
     return type(name, (Entity,), {'declared_params': declared_params})
 
+
+# the declarations of the deferred types, the callbacks which are called
+# when their classes are created and the classes which have been created
+_deferred_types = {}
+_deferred_callbacks = {}
+_deferred_classes = {}
+_deferred_lock = threading.RLock()
+
+def defer_entity(polymorphic_name, declared_params, callback=None):
+    """ Declares an entity type whose class is only created when it is
+    first needed, either by `deferred_entity_class` or when an entity of
+    this type is loaded from the database.
+
+    Parameters
+    ----------
+    polymorphic_name: str
+        The name of the type including the hash of the declared parameters.
+    declared_params: dict
+        The declared parameters of the type.
+    callback: callable, optional
+        Is called with the class, when it has been created.
+
+    Returns
+    -------
+    klass: subclass of Entity or None
+        The class, if it has been created already. (The callback is not
+        called in this case.)
+    """
+    with _deferred_lock:
+        if polymorphic_name in _deferred_classes:
+            return _deferred_classes[polymorphic_name]
+        _deferred_types.setdefault(polymorphic_name, declared_params)
+        if callback is not None:
+            _deferred_callbacks.setdefault(polymorphic_name, []).append(callback)
+
+def deferred_entity_class(polymorphic_name):
+    """ Returns the class of a deferred type and creates it, if needed.
+
+    Raises
+    ------
+    KeyError
+        If the type has not been deferred.
+    """
+    with _deferred_lock:
+        if polymorphic_name in _deferred_classes:
+            return _deferred_classes[polymorphic_name]
+        klass = create_entity(polymorphic_name, _deferred_types[polymorphic_name])
+        _deferred_classes[polymorphic_name] = klass
+        for callback in _deferred_callbacks.pop(polymorphic_name, []):
+            callback(klass)
+        return klass
+
 class _ContextBySetDict(collections.MutableMapping):
     def __init__(self, parent):
         self.parent = parent
@@ -684,6 +852,36 @@ class Context(Base):
         return "Context({e} has {t} {a})".format(e=self.holder, t=self.connection_type, a=self.attachment)
 
 
+class EntityClosure(Base):
+    """
+    The class `EntityClosure` is mapped on the table 'entity_closure'. It
+    stores the transitive closure of the parent–child relation: For every
+    entity there is one row for each of its ancestors (including the entity
+    itself with depth 0), so that all ancestors or descendants of an entity
+    can be found with a single indexed lookup.
+
+    The table is only filled, if a `xdapy.mapper.Mapper` has been created
+    with ``closure_table=True``. (See `xdapy.closure`.)
+    """
+    # No foreign keys: The rows are derived data which the flush listener
+    # removes only after the entities have been deleted.
+    ancestor_id = Column('ancestor_id', Integer, primary_key=True, autoincrement=False)
+    descendant_id = Column('descendant_id', Integer, primary_key=True, autoincrement=False)
+    depth = Column('depth', Integer, nullable=False)
+
+    __tablename__ = 'entity_closure'
+    __table_args__ = (Index('ix_entity_closure_descendant_id_depth', descendant_id, depth), {})
+
+    def __init__(self, ancestor_id, descendant_id, depth):
+        self.ancestor_id = ancestor_id
+        self.descendant_id = descendant_id
+        self.depth = depth
+
+    def __repr__(self):
+        return "EntityClosure(ancestor_id={a!s}, descendant_id={d!s}, depth={depth!s})".format(
+            a=self.ancestor_id, d=self.descendant_id, depth=self.depth)
+
+
 class ParameterDeclaration(Base):
     """
     The class `ParameterDeclaration` is mapped on the table 'parameter_declarations'. This
@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
 
-from xdapy import Connection
-from xdapy.errors import DatabaseError
+from sqlalchemy.pool import QueuePool
+
+from xdapy import Connection, Mapper, Entity, closure
+from xdapy.connection import _options_from_config
+from xdapy.errors import DatabaseError, ConfigurationError
+from xdapy.structures import EntityClosure
+import os
+import shutil
+import tempfile
 import unittest
 
 class TestConnectionFailsOnNonemptyDatabase(unittest.TestCase):
@@ -65,8 +72,188 @@ class TestConnectionCreatesAndDropsTables(unittest.TestCase):
     def test_connection_creates_all_tables(self):
         self.connection.create_tables()
 
-        # we need exactly 13 tables
-        self.assertEqual(len(self.connection._table_names()), 13)
+        # we need exactly 15 tables
+        self.assertEqual(len(self.connection._table_names()), 15)
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.url = "sqlite:///" + os.path.join(self.tmpdir, "pool.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_pool_options_from_config(self):
+        filename = os.path.join(self.tmpdir, "engine.ini")
+        with open(filename, "w") as f:
+            f.write("[pooled]\n"
+                    "url = %s\n"
+                    "pool_size = 3\n"
+                    "max_overflow = 2\n"
+                    "pool_recycle = 60\n"
+                    "pool_pre_ping = true\n" % self.url)
+
+        options = _options_from_config(filename, "pooled")
+        self.assertEqual(options["engine_opts"], {"pool_size": 3, "max_overflow": 2, "pool_recycle": 60})
+        self.assertTrue(options["pool_pre_ping"])
+
+        connection = Connection.profile("pooled", filename=filename, engine_opts={"poolclass": QueuePool})
+        self.assertTrue(isinstance(connection.engine.pool, QueuePool))
+        self.assertEqual(connection.engine.pool.size(), 3)
+        self.assertEqual(connection.engine.execute("SELECT 1").scalar(), 1)
+
+    def test_pre_ping_replaces_closed_connections(self):
+        connection = Connection(url=self.url, pool_pre_ping=True, engine_opts={"poolclass": QueuePool})
+        conn = connection.engine.connect()
+        raw = conn.connection.connection
+        conn.close()
+        raw.close()
+
+        conn = connection.engine.connect()
+        self.assertTrue(conn.connection.connection is not raw)
+        self.assertEqual(conn.execute("SELECT 1").scalar(), 1)
+        conn.close()
+
+    def test_dispose_after_fork(self):
+        connection = Connection(url=self.url, engine_opts={"poolclass": QueuePool})
+        connection.session.execute("SELECT 1")
+        session = connection.session
+        pool = connection.engine.pool
+        conn = connection.engine.connect()
+        raw = conn.connection.connection
+        conn.close()
+
+        connection.dispose_after_fork()
+        self.assertTrue(connection.session is not session)
+        self.assertTrue(connection.engine.pool is not pool)
+        conn = connection.engine.connect()
+        self.assertTrue(conn.connection.connection is not raw)
+        conn.close()
+        # the connections of the parent have not been closed
+        raw.execute("SELECT 1")
+
+    def test_closure_is_maintained_after_fork(self):
+        connection = Connection(url=self.url)
+        connection.create_tables()
+        m = Mapper(connection, closure_table=True)
+        m.register(Trial)
+        parent = Trial(rt=1)
+        m.save(parent)
+
+        connection.dispose_after_fork()
+        self.assertTrue(closure.is_maintained(m.session))
+        child = Trial(rt=2)
+        child.parent = m.find_first(Trial)
+        m.save(child)
+        self.assertEqual(m.check_closure(), (set(), set()))
+        self.assertEqual(len(m.session.query(EntityClosure).filter(EntityClosure.descendant_id == child.id).all()), 2)
+
+    def test_connections_of_other_processes_are_not_used(self):
+        connection = Connection(url=self.url, engine_opts={"poolclass": QueuePool})
+        conn = connection.engine.connect()
+        raw = conn.connection.connection
+        # pretend that the connection was opened by the parent process
+        conn.connection._connection_record.info["pid"] = -1
+        conn.close()
+
+        conn = connection.engine.connect()
+        self.assertTrue(conn.connection.connection is not raw)
+        conn.close()
+        raw.execute("SELECT 1")
+
+
+class Trial(Entity):
+    declared_params = {
+        'rt': 'integer'
+    }
+
+
+class TestReadReplicas(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        urls = ["sqlite:///" + os.path.join(self.tmpdir, name) for name in ("primary.db", "replica1.db", "replica2.db")]
+        self.primary_url, self.replica_urls = urls[0], urls[1:]
+        for url in urls:
+            Connection(url=url).create_tables()
+
+        self.connection = Connection(url=self.primary_url, replicas=self.replica_urls)
+        self.m = Mapper(self.connection)
+        self.m.register(Trial)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_replicas_from_config(self):
+        filename = os.path.join(self.tmpdir, "engine.ini")
+        with open(filename, "w") as f:
+            f.write("[replicated]\n"
+                    "url = %s\n"
+                    "replicas = %s\n"
+                    "    %s\n"
+                    "replica_selection = least_loaded\n" % (self.primary_url, self.replica_urls[0], self.replica_urls[1]))
+        options = _options_from_config(filename, "replicated")
+        self.assertEqual(options["replicas"], self.replica_urls)
+
+        connection = Connection.profile("replicated", filename=filename)
+        self.assertEqual([str(e.url) for e in connection.replicas.engines], self.replica_urls)
+        self.assertEqual(connection.replicas.selection, "least_loaded")
+
+        self.assertRaises(ConfigurationError, Connection, url=self.primary_url,
+                          replicas=self.replica_urls, replica_selection="random")
+
+    def test_routing(self):
+        self.m.save(Trial(rt=1))
+        # nothing has been replicated
+        self.assertEqual(self.m.find_all(Trial), [])
+
+        with self.m.auto_session:
+            self.m.save(Trial(rt=2))
+            self.assertEqual(sorted(t.params["rt"] for t in self.m.find_all(Trial)), [1, 2])
+
+        with self.m.use_primary:
+            self.assertEqual(len(self.m.find_all(Trial)), 2)
+
+        primary = Connection(url=self.primary_url)
+        self.assertEqual(primary.engine.execute("SELECT count(*) FROM entities").scalar(), 2)
+
+    def test_saved_entities_are_loaded_from_the_primary(self):
+        trial = Trial(rt=1)
+        child = Trial(rt=2)
+        child.parent = trial
+        self.m.save(trial)
+        # the replicas do not know the entities, but the saved (and
+        # expired) instances are refreshed from the primary
+        self.assertEqual(dict(trial.params), {"rt": 1})
+        self.assertEqual(trial.children, [child])
+        self.assertEqual(child.parent, trial)
+        self.assertEqual(child.params["rt"], 2)
+
+        # new queries still go to the replicas
+        self.assertEqual(self.m.find_all(Trial), [])
+
+    def test_data_is_written_to_the_primary(self):
+        trial = Trial(rt=1)
+        self.m.save(trial)
+        trial.data["a"].put("abcde" * 60, chunk_size=50)
+        trial.data["b"].put("abcde" * 60, chunk_size=50)
+        trial.data["c"] = trial.data["a"]
+        with self.m.use_primary:
+            self.assertEqual(trial.data["c"].get_string(), "abcde" * 60)
+            self.assertEqual(self.m.data_stats()["blobs"], 1)
+
+    def test_selection(self):
+        replicas = self.connection.replicas
+        first, second = replicas.engines
+        self.assertEqual([replicas.select() for i in range(4)], [first, second, first, second])
+
+        replicas.selection = "least_loaded"
+        conn = first.connect()
+        self.assertEqual(replicas.in_use(), [1, 0])
+        self.assertEqual([replicas.select() for i in range(2)], [second, second])
+        conn.close()
+        self.assertEqual(replicas.in_use(), [0, 0])
+        self.assertEqual([replicas.select() for i in range(2)], [first, second])
 
 
 if __name__ == '__main__':
@@ -8,7 +8,7 @@ from sqlalchemy.exc import IntegrityError
 __authors__ = ['"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
 
 from xdapy import Connection, Mapper, Entity
-from xdapy.structures import create_entity, BaseEntity
+from xdapy.structures import create_entity, BaseEntity, calculate_polymorphic_name
 from xdapy.errors import EntityDefinitionError
 import unittest
 
@@ -62,6 +62,13 @@ class TestEntity(unittest.TestCase):
         self.assertEqual(self.Experiment.__name__, Experiment.__name__)
         self.assertNotEqual(self.Experiment, Experiment)
 
+    def test_polymorphic_name_is_cached(self):
+        name = calculate_polymorphic_name("Experiment", declared_params)
+        self.assertEqual(name, self.Experiment.__name__)
+        self.assertEqual(calculate_polymorphic_name(name, dict(declared_params)), name)
+        self.assertRaises(EntityDefinitionError, calculate_polymorphic_name, "Experiment_abc", declared_params)
+        self.assertRaises(EntityDefinitionError, calculate_polymorphic_name, "Experiment_abc", declared_params)
+
     def test_entity_without_declared_params(self):
         def no_declared_params():
             class NoParamsEntity(Entity):
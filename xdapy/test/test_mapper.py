@@ -5,12 +5,14 @@
 Created on Jun 17, 2009
 """
 import operator
+from sqlalchemy import event
 from sqlalchemy.exc import CircularDependencyError, InvalidRequestError
 from sqlalchemy.orm.exc import NoResultFound, DetachedInstanceError
 from xdapy import Connection, Mapper, Entity
-from xdapy.structures import Context, create_entity
+from xdapy.structures import Context, EntityClosure, BaseEntity, create_entity, calculate_polymorphic_name
 from xdapy.errors import InsertionError
 from xdapy.operators import gt, lt, eq, between, ge
+from xdapy.find import SearchProxy
 
 import unittest
 import datetime
@@ -126,6 +128,32 @@ class TestMapper(Setup):
         self.m.delete(e)
         self.assertEqual(len(self.m.find_all(Entity)), 1)
 
+    def test_save_bulk(self):
+        e = Experiment(project='BulkProject', experimenter="John Doe")
+        o = Observer(name="Max Mustermann", handedness="right", age=26)
+        trials = []
+        for i in range(25):
+            t = Trial(rt=i, valid=bool(i % 2), response="resp_%d" % i)
+            t.parent = e
+            t.attach("Observer", o)
+            trials.append(t)
+
+        stats = self.m.save_bulk(trials, batch_size=10)
+
+        self.assertEqual(stats["entities"], 25)
+        # 27 entities, 25 * 3 trial parameters, 5 other parameters (each
+        # in two tables) and 25 contexts
+        self.assertEqual(stats["rows"], 27 + 2 * (25 * 3 + 5) + 25)
+        self.assertTrue(stats["rows_per_sec"] > 0)
+
+        self.assertEqual(self.m.find(Trial).count(), 25)
+        self.assertEqual(self.m.find(Context).count(), 25)
+        self.assertEqual(len(self.m.find_all(Trial, {"rt": lt(5)})), 5)
+        self.assertEqual(self.m.find_first(Trial, {"rt": 7}).params["response"], "resp_7")
+        self.assertEqual(len(e.children), 25)
+
+        self.assertRaises(ValueError, self.m.save_bulk, [], batch_size=0)
+
     def test_find_registered_entities(self):
         entity_classes = [Experiment, Observer, Trial, Session]
         entities_in_db = self.m.entities_from_db()
@@ -136,6 +164,48 @@ class TestMapper(Setup):
         ))
 
 
+    def test_register_declares_parameters_in_bulk(self):
+        class Block(Entity):
+            declared_params = {
+                'number': 'integer',
+                'condition': 'string'
+            }
+
+        statements = []
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement.split()[0], executemany))
+        event.listen(self.connection.engine, "before_cursor_execute", count_statement)
+
+        m = Mapper(self.connection)
+        m.register(Observer, Experiment, Trial, Session, Block)
+        # one query for the existing declarations and one insert for Block
+        self.assertEqual(statements, [("SELECT", False), ("INSERT", True)])
+
+        del statements[:]
+        m.register(Observer, Block)
+        self.assertEqual(statements, [])
+
+        declarations = sorted((e, p, t) for e, params in self.m.entities_from_db()
+                              for p, t in params.iteritems() if e == Block.__name__)
+        self.assertEqual(declarations, [(Block.__name__, 'condition', 'string'),
+                                        (Block.__name__, 'number', 'integer')])
+
+    def test_register_parameter(self):
+        self.m._register_parameter("Block", "number", "integer")
+        self.m._register_parameter("Block", "condition", "string")
+        self.m._register_parameter("Block", "number", "float")
+        self.assertEqual(dict(self.m.entities_from_db())["Block"], {"number": "float", "condition": "string"})
+
+    def test_register_after_dropping_tables(self):
+        m = Mapper(self.connection)
+        m.register(Observer, Trial)
+
+        self.connection.drop_tables()
+        self.connection.create_tables()
+        m.register(Observer, Trial)
+        self.assertEqual(sorted(name for name, _ in m.entities_from_db()),
+                         sorted([Observer.__name__, Trial.__name__]))
+
     def test_save_and_delete(self):
         e = Experiment(project='YourProject', experimenter="Johny Dony")
         t1 = Trial(rt=189, valid=True, response='right')
@@ -245,6 +315,24 @@ class TestMapper(Setup):
         self.assertEqual(Observer, self.m.entity_by_name(Observer))
         self.assertEqual(Observer_new, self.m.entity_by_name(Observer_new))
 
+        self.assertEqual(set(self.m.entities_by_type("Observer")), set([Observer, Observer_new]))
+        self.assertEqual(self.m.entities_by_type("Obs"), [])
+        self.assertEqual(self.m.registered_entity_names[Observer_new.__name__], Observer_new)
+
+        # registering an equal class again replaces the old one
+        Observer_again = create_entity("Observer", {})
+        self.m.register(Observer_again)
+        self.assertEqual(Observer_again, self.m.entity_by_name("Observer_99914b932bd37a50b983c5e7c90ae93b"))
+        self.assertEqual(set(self.m.entities_by_type("Observer")), set([Observer, Observer_again]))
+
+
+    def testEntityByNameForRegisteredType(self):
+        params = {'number': 'integer'}
+        Block = self.m.register_type(create_entity("Block", params).__name__, params)
+        self.assertEqual(Block.__name__.split('_')[0], "Block")
+        self.assertEqual(self.m.entity_by_name("Block"), Block)
+        self.assertEqual(self.m.entities_by_type("Block"), [Block])
+        self.assertEqual(len(self.m.find_all("Block")), 0)
 
     def testCreate(self):
         obs = self.m.create("Observer")
@@ -654,6 +742,335 @@ class TestContext(Setup):
         self.assertEqual(set(res), set())
 
 
+class TestHierarchy(Setup):
+    def setUp(self):
+        super(TestHierarchy, self).setUp()
+
+        self.e = Experiment(project="E")
+        self.t1 = Trial(rt=1)
+        self.t2 = Trial(rt=2)
+        self.s1 = Session(count=1)
+        self.s2 = Session(count=2)
+        self.s3 = Session(count=3)
+
+        self.t1.parent = self.e
+        self.t2.parent = self.e
+        self.s1.parent = self.t1
+        self.s2.parent = self.t1
+        self.s3.parent = self.t2
+
+        self.m.save(self.e)
+
+        self.statements = []
+        event.listen(self.connection.engine, "before_cursor_execute", self.count_statement)
+
+    def count_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def test_ancestors(self):
+        self.m.session.expire_all()
+        self.statements = []
+        ancestors = self.s1.ancestors()
+        # one statement to refresh s1 and the recursive query
+        self.assertEqual(len(self.statements), 2)
+
+        self.assertEqual(ancestors, [self.t1, self.e])
+        self.assertEqual([a.params.get("rt") for a in ancestors], [1, None])
+        self.assertEqual(ancestors[1].params["project"], "E")
+        # parameters have been loaded eagerly
+        self.assertEqual(len(self.statements), 2)
+
+        self.assertEqual(self.s1.ancestors(depth=1), [self.t1])
+        self.assertEqual(self.e.ancestors(), [])
+
+    def test_siblings(self):
+        self.m.session.expire_all()
+        self.statements = []
+        siblings = self.e.siblings()
+        self.assertEqual(len(self.statements), 2)
+
+        self.assertEqual(siblings, set([self.t1, self.t2, self.s1, self.s2, self.s3]))
+        self.assertEqual(sum(s.params.get("count", 0) for s in siblings), 6)
+        self.assertEqual(len(self.statements), 2)
+
+        self.assertEqual(self.e.siblings(depth=1), set([self.t1, self.t2]))
+        self.assertEqual(self.t2.siblings(), set([self.s3]))
+        self.assertEqual(self.s3.siblings(), set())
+
+    def test_unsaved_hierarchy(self):
+        e = Experiment()
+        t = Trial()
+        s = Session()
+        t.parent = e
+        s.parent = t
+        self.assertEqual(s.ancestors(), [t, e])
+        self.assertEqual(s.ancestors(depth=1), [t])
+        self.assertEqual(e.siblings(), set([t, s]))
+        self.assertEqual(e.siblings(depth=1), set([t]))
+
+
+class TestEagerLoad(Setup):
+    def setUp(self):
+        super(TestEagerLoad, self).setUp()
+
+        e = Experiment(project="E")
+        o = Observer(name="O")
+        self.m.save(e, o)
+        for i in range(10):
+            t = Trial(rt=i, response="r%d" % i)
+            t.parent = e
+            t.attach("Observer", o)
+            self.m.save(t)
+            t.data["d%d" % i].put("data")
+
+        self.m.session.expunge_all()
+
+        self.statements = []
+        event.listen(self.connection.engine, "before_cursor_execute", self.count_statement)
+
+    def count_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def touch(self, trials):
+        for t in trials:
+            dict(t.params)
+            list(t.data.keys())
+            list(t.attachments("Observer"))
+            t.parent.params["project"]
+
+    def test_lazy(self):
+        self.touch(self.m.find_all(Trial))
+        # at least one query per trial for each relation
+        self.assertTrue(len(self.statements) > 30)
+
+    def test_eager(self):
+        trials = self.m.find_all(Trial, {"rt": lt(8)}, load=["params", "data_keys", "context", "parent"])
+        self.assertEqual(len(trials), 8)
+        # main query, params, data, holds_context (+ attachment), attached_by (+ holder)
+        self.assertEqual(len(self.statements), 6)
+
+        self.touch(trials)
+        # only the parameters of the parent need to be fetched
+        self.assertEqual(len(self.statements), 7)
+
+        self.assertEqual(sorted(t.params["response"] for t in trials), ["r%d" % i for i in range(8)])
+
+    def test_unknown_load(self):
+        self.assertRaises(ValueError, self.m.find, Trial, load=["children"])
+
+    def test_data_summary(self):
+        trials = self.m.find_all(Trial)
+        experiment = self.m.find_first(Experiment)
+        del self.statements[:]
+
+        summary = self.m.data_summary(trials + [experiment])
+        self.assertEqual(len(self.statements), 1)
+
+        self.assertEqual(summary[experiment], {})
+        for t in trials:
+            key = "d%d" % t.params["rt"]
+            self.assertEqual(summary[t], {key: {"mimetype": None, "size": 4, "stored_size": 4, "chunks": 1}})
+
+        self.assertEqual(self.m.data_summary([]), {})
+
+        # size and chunks are read from the data row
+        data = trials[0].data["d%d" % trials[0].params["rt"]]
+        data.get_data()
+        del self.statements[:]
+        self.assertEqual((data.size(), data.size(stored=True), data.chunks()), (4, 4, 1))
+        self.assertEqual(repr(data), "DataProxy(mimetype=None, chunks=1, size=4, stored_size=4)")
+        self.assertEqual(len(self.statements), 0)
+
+
+class TestIterFind(Setup):
+    def setUp(self):
+        super(TestIterFind, self).setUp()
+        self.m.save_bulk(Trial(rt=i) for i in range(25))
+        self.m.session.expunge_all()
+
+    def entities_in_session(self):
+        return len([obj for obj in self.m.session if isinstance(obj, Entity)])
+
+    def test_iter_find(self):
+        rts = []
+        max_in_session = 0
+        for trial in self.m.iter_find(Trial, chunk_size=10):
+            rts.append(trial.params["rt"])
+            max_in_session = max(max_in_session, self.entities_in_session())
+
+        self.assertEqual(rts, range(25))
+        self.assertEqual(max_in_session, 10)
+        self.assertEqual(self.entities_in_session(), 0)
+
+    def test_iter_find_filter(self):
+        trials = self.m.iter_find(Trial, {"rt": ge(7)}, load=["params"], chunk_size=4)
+        self.assertEqual([t.params["rt"] for t in trials], range(7, 25))
+
+        self.assertEqual(list(self.m.iter_find(Session)), [])
+        self.assertRaises(ValueError, list, self.m.iter_find(Trial, chunk_size=0))
+
+    def test_iter_find_saves_changes(self):
+        for trial in self.m.iter_find(Trial, chunk_size=10):
+            trial.params["valid"] = True
+        self.assertEqual(self.m.find(Trial, {"valid": True}).count(), 25)
+
+
+class TestParamFilter(Setup):
+    def setUp(self):
+        Setup.setUp(self)
+        self.o1 = Observer(name="Max Mustermann", handedness="right", age=26)
+        self.o2 = Observer(name="Susi Sorglos", handedness="left", age=38)
+        self.o3 = Observer(name="Max Unbekannt", handedness="left")
+        self.s1 = Session(count=1, category1=2, date=datetime.date(2011, 3, 4))
+        self.s2 = Session(count=2, category1=1, date=datetime.date(2012, 3, 4))
+        self.m.save(self.o1, self.o2, self.o3, self.s1, self.s2)
+
+    def find(self, entity, filter, options=None):
+        return set(self.m.find_all(entity, filter=filter, options=options))
+
+    def test_values(self):
+        self.assertEqual(self.find(Observer, {"age": 26}), set([self.o1]))
+        self.assertEqual(self.find(Observer, {"age": [26, 38]}), set([self.o1, self.o2]))
+        self.assertEqual(self.find(Observer, {"name": "Max%"}), set([self.o1, self.o3]))
+        self.assertEqual(self.find(Observer, {"name": "Max"}, {"strict": False}), set([self.o1, self.o3]))
+        self.assertEqual(self.find(Observer, {"name": "Max"}), set())
+
+    def test_operators(self):
+        self.assertEqual(self.find(Observer, {"age": gt(26)}), set([self.o2]))
+        self.assertEqual(self.find(Observer, {"age": lt(30)}), set([self.o1]))
+        self.assertEqual(self.find(Observer, {"age": between(20, 40)}), set([self.o1, self.o2]))
+        self.assertEqual(self.find(Observer, {"age": [lt(30), ge(38)]}), set([self.o1, self.o2]))
+        self.assertEqual(self.find(Observer, {"_id": self.o1.id}), set([self.o1]))
+
+    def test_convert_string(self):
+        options = {"convert_string": True}
+        self.assertEqual(self.find(Observer, {"age": "26"}, options), set([self.o1]))
+        self.assertEqual(self.find(Session, {"date": "2011-03-04"}, options), set([self.s1]))
+        # incomplete dates match the year (and month)
+        self.assertEqual(self.find(Session, {"date": "2012"}, options), set([self.s2]))
+        self.assertEqual(self.find(Session, {"date": "2011-03"}, options), set([self.s1]))
+
+    def test_several_keys(self):
+        self.assertEqual(self.find(Observer, {"name": "Max%", "handedness": "left"}), set([self.o3]))
+        self.assertEqual(self.find(Observer, {"name": "Max%", "age": 26, "handedness": "right"}), set([self.o1]))
+        self.assertEqual(self.find(Observer, {"name": "Susi%", "age": 26}), set())
+
+    def test_parameter_name(self):
+        # count and category1 are both integers; only the named one matches
+        self.assertEqual(self.find(Session, {"category1": 1}), set([self.s2]))
+        self.assertEqual(self.find(Session, {"count": 1, "category1": 2}), set([self.s1]))
+
+    def test_missing_key(self):
+        # an entity without the parameter is never matched
+        self.assertEqual(self.find(Observer, {"age": lt(100)}), set([self.o1, self.o2]))
+        self.assertRaises(KeyError, self.find, Observer, {"unknown": 1})
+
+    def test_param_filter_agrees(self):
+        filters = [{"age": 26}, {"name": "Max%", "handedness": "left"}, {"category1": 1}, {"count": gt(0)}]
+        for entity in [Observer, Session]:
+            for filter in filters:
+                if not all(key in entity.declared_params for key in filter):
+                    continue
+                exists = set(self.m.session.query(entity).filter(self.m.param_filter(entity, filter)))
+                self.assertEqual(exists, self.find(entity, filter))
+
+    def test_statement(self):
+        statement = str(self.m.find(Observer, filter={"name": "Max%", "age": 26}).statement)
+        # two joins per key and no sub-queries
+        self.assertEqual(statement.count("JOIN parameters"), 4)
+        self.assertEqual(statement.count("JOIN parameters_string"), 1)
+        self.assertEqual(statement.count("JOIN parameters_integer"), 1)
+        self.assertFalse("EXISTS" in statement)
+
+        statements = []
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        self.m.session.expunge_all()
+        event.listen(self.connection.engine, "before_cursor_execute", count_statement)
+        self.assertEqual(len(self.m.find_all(Observer, filter={"name": "Max%", "age": 26})), 1)
+        self.assertEqual(len(statements), 1)
+
+
+class TestClosure(Setup):
+    def setUp(self):
+        super(TestClosure, self).setUp()
+        self.m = Mapper(self.connection, closure_table=True)
+        self.m.register(Observer, Experiment, Trial, Session)
+
+        self.e = Experiment(project="E")
+        self.t1 = Trial(rt=1)
+        self.t2 = Trial(rt=2)
+        self.s1 = Session(count=1)
+        self.s2 = Session(count=2)
+        self.s3 = Session(count=3)
+
+        self.t1.parent = self.e
+        self.t2.parent = self.e
+        self.s1.parent = self.t1
+        self.s2.parent = self.t1
+        self.s3.parent = self.t2
+
+        self.m.save(self.e)
+
+    def assertConsistent(self):
+        self.assertEqual(self.m.check_closure(), (set(), set()))
+
+    def test_descendants_of(self):
+        self.assertConsistent()
+        self.assertEqual(self.m.descendants_of(self.e), [self.t1, self.t2, self.s1, self.s2, self.s3])
+        self.assertEqual(self.m.descendants_of(self.e, Session), [self.s1, self.s2, self.s3])
+        self.assertEqual(self.m.descendants_of(self.e, "Trial"), [self.t1, self.t2])
+        self.assertEqual(self.m.descendants_of(self.t2), [self.s3])
+        self.assertEqual(self.m.descendants_of(self.s3), [])
+
+    def test_ancestors_of(self):
+        self.assertEqual(self.m.ancestors_of(self.s1), [self.t1, self.e])
+        self.assertEqual(self.m.ancestors_of(self.t1), [self.e])
+        self.assertEqual(self.m.ancestors_of(self.e), [])
+
+    def test_move(self):
+        # move a subtree
+        self.t1.parent = self.t2
+        self.m.save(self.t1)
+        self.assertConsistent()
+        self.assertEqual(self.m.ancestors_of(self.s1), [self.t1, self.t2, self.e])
+
+        # several moves in one flush
+        with self.m.auto_session:
+            self.t2.parent = None
+            self.s3.parent = self.s1
+            self.s1.parent = self.e
+        self.assertConsistent()
+        self.assertEqual(self.m.descendants_of(self.t2), [self.t1, self.s2])
+        self.assertEqual(self.m.descendants_of(self.e), [self.s1, self.s3])
+
+        # new entities below new entities
+        s4 = Session(count=4)
+        s5 = Session(count=5)
+        s5.parent = s4
+        s4.parent = self.s3
+        self.m.save(s5)
+        self.assertConsistent()
+        self.assertEqual(self.m.ancestors_of(s5), [s4, self.s3, self.s1, self.e])
+
+    def test_delete(self):
+        self.m.delete(self.t1)
+        self.assertConsistent()
+        self.assertEqual(self.m.descendants_of(self.e), [self.t2, self.s3])
+        self.assertEqual(self.m.ancestors_of(self.s1), [])
+
+    def test_rebuild(self):
+        # lose all rows
+        self.connection.session.execute(EntityClosure.__table__.delete())
+        missing, superfluous = self.m.check_closure()
+        self.assertEqual(len(missing), 6 + 5 + 3)
+        self.assertEqual(superfluous, set())
+
+        self.assertEqual(self.m.rebuild_closure(), 14)
+        self.assertConsistent()
+        self.assertEqual(self.m.descendants_of(self.e, Session), [self.s1, self.s2, self.s3])
+
+
 class TestGetDataMatrix(Setup):
     def setUp(self):
         super(TestGetDataMatrix, self).setUp()
@@ -862,6 +1279,48 @@ class TestComplicatedQuery(Setup):
                                                                                               ("Observer", {"name": "C"})]}})
         self.assertEqual(set(experiments), set([self.e1, self.e2, self.e3]))
 
+    def test_find_complex_in_sql(self):
+        # all trials of experiment E1 with observer A and rt < 2
+        the_filter = {"_parent": ("Experiment", {"project": "E1",
+                                                 ("_context", "Observed by"): ("Observer", {"name": "A"})}),
+                      "rt": lt(2)}
+        entity_proxy = SearchProxy(("Trial", the_filter)).inner
+        clause, exact = entity_proxy.inner.sql_clause(self.m, Trial, [Trial])
+        self.assertTrue(clause is not None)
+        self.assertTrue(exact)
+        self.assertEqual(self.m.find_complex("Trial", the_filter), [self.t1])
+
+        # _with can only be checked in Python
+        with_filter = dict(the_filter, _with=lambda t: t.params["response"] == "resp_0")
+        entity_proxy = SearchProxy(("Trial", with_filter)).inner
+        clause, exact = entity_proxy.inner.sql_clause(self.m, Trial, [Trial])
+        self.assertTrue(clause is not None)
+        self.assertFalse(exact)
+        self.assertEqual(self.m.find_complex("Trial", with_filter), [self.t1])
+
+        with_filter = dict(the_filter, _with=lambda t: t.params["response"] == "resp_1")
+        self.assertEqual(self.m.find_complex("Trial", with_filter), [])
+
+    def test_find_complex_with_functions(self):
+        # an arbitrary function is not translated, even if it gives a clause
+        the_filter = {"rt": lambda v: v == 3 or v == 4}
+        entity_proxy = SearchProxy(("Trial", the_filter)).inner
+        clause, exact = entity_proxy.inner.sql_clause(self.m, Trial, [Trial])
+        self.assertTrue(clause is None)
+        self.assertFalse(exact)
+        self.assertEqual(sorted(t.params["rt"] for t in self.m.find_complex("Trial", the_filter)), [3, 4])
+
+        the_filter = {"rt": lambda v: v > 2}
+        self.assertEqual(sorted(t.params["rt"] for t in self.m.find_complex("Trial", the_filter)), [3, 4])
+
+        # the operators are
+        the_filter = {"rt": ge(3)}
+        entity_proxy = SearchProxy(("Trial", the_filter)).inner
+        clause, exact = entity_proxy.inner.sql_clause(self.m, Trial, [Trial])
+        self.assertTrue(clause is not None)
+        self.assertTrue(exact)
+        self.assertEqual(sorted(t.params["rt"] for t in self.m.find_complex("Trial", the_filter)), [3, 4])
+
     def test_find_with(self):
         # we can also do parent relations with find_with
         sessions = self.m.find_with("Session", {"_parent": ("Trial", {"rt": gt(2)})})
@@ -965,6 +1424,41 @@ class TestTypeMagic(unittest.TestCase):
         e1.params["q"] = 0
         e1.params["q1"] = 0
 
+    def test_load_types_from_db(self):
+        # types which are only declared in the database (no class exists yet)
+        lazy_params = {"name": "string", "count": "integer"}
+        lazy_name = calculate_polymorphic_name("LazyType", lazy_params)
+        other_name = calculate_polymorphic_name("OtherLazyType", {"name": "string"})
+        for name, params in [(lazy_name, lazy_params), (other_name, {"name": "string"})]:
+            for param, paramtype in params.iteritems():
+                self.m._register_parameter(name, param, paramtype)
+        self.connection.engine.execute(BaseEntity.__table__.insert(), type=lazy_name, uniqueid="lazy-1")
+
+        m = Mapper(self.connection)
+        self.assertEqual(sorted(m.load_types_from_db()), sorted([lazy_name, other_name]))
+        self.assertEqual(m.load_types_from_db(), [])
+        self.assertTrue(m.is_registered("LazyType", lazy_params))
+        self.assertEqual(m.registered_entity_names, {})
+
+        # loading an entity creates its class
+        entity = m.find_by_unique_id("lazy-1")
+        self.assertEqual(entity.__class__.__name__, lazy_name)
+        self.assertEqual(entity.declared_params, lazy_params)
+        self.assertEqual(m.registered_entity_names.keys(), [lazy_name])
+        entity.params["count"] = 3
+        m.save(entity)
+
+        # a lookup by name creates the class
+        Other = m.entity_by_name("OtherLazyType")
+        self.assertEqual(Other.__name__, other_name)
+        self.assertEqual(set(m.registered_entities), set([entity.__class__, Other]))
+
+        # other mappers share the classes
+        m2 = Mapper(self.connection)
+        m2.load_types_from_db(lazy=False)
+        self.assertEqual(m2.entity_by_name("LazyType"), entity.__class__)
+        self.assertEqual(m2.find_first("LazyType").params["count"], 3)
+
     def test_multi_step_rebrand(self):
         class MyEntity1(Entity):
             declared_params = {
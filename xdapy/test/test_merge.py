@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""Unittest for merging databases."""
+
+from xdapy import Connection, Mapper, Entity
+from xdapy.data import DataBlob
+from xdapy.merge import merge
+
+import unittest
+
+
+class OldExperiment(Entity):
+    declared_params = {
+        'project': 'string'
+    }
+
+class Experiment(Entity):
+    declared_params = {
+        'project': 'string',
+        'experimenter': 'string'
+    }
+
+class Trial(Entity):
+    declared_params = {
+        'rt': 'integer',
+        'valid': 'boolean'
+    }
+
+class Observer(Entity):
+    declared_params = {
+        'name': 'string'
+    }
+
+
+class TestMerge(unittest.TestCase):
+    def setUp(self):
+        self.source = Connection.memory()
+        self.source.create_tables()
+        self.m_source = Mapper(self.source)
+        self.m_source.register(OldExperiment, Trial, Observer)
+
+        self.target = Connection.memory()
+        self.target.create_tables()
+        self.m_target = Mapper(self.target)
+        self.m_target.register(Experiment, Trial, Observer)
+
+        e = OldExperiment(project="P")
+        self.t1 = Trial(rt=1, valid=True)
+        self.t2 = Trial(rt=2)
+        self.t1.parent = e
+        self.t2.parent = e
+        o = Observer(name="O")
+        self.m_source.save(e, o)
+        self.t1.attach("Observer", o)
+        self.m_source.save(self.t1)
+
+        self.t1.data["recording"].put("abc" * 1000, compression="zlib", chunk_size=300, mimetype="raw")
+        self.t2.data["recording"].put("abc" * 1000, compression="zlib", chunk_size=300)
+
+        # the target knows t2 already
+        existing = Trial(_unique_id=self.t2.unique_id, rt=20, valid=False)
+        self.m_target.save(existing, Observer(name="Other"))
+        existing.data["own"].put("own data")
+        existing.data["recording"].put("old recording")
+
+    def assertMerged(self):
+        m = self.m_target
+        m.session.expire_all()
+
+        self.assertEqual(len(m.find_all(Experiment)), 1)
+        self.assertEqual(len(m.find_all(Trial)), 2)
+        self.assertEqual(len(m.find_all(Observer)), 2)
+
+        e = m.find_first(Experiment)
+        self.assertEqual(e.params["project"], "P")
+        t1 = m.find_by_unique_id(self.t1.unique_id)
+        t2 = m.find_by_unique_id(self.t2.unique_id)
+        self.assertEqual(set(e.children), set([t1, t2]))
+
+        self.assertEqual(dict(t1.params), {"rt": 1, "valid": True})
+        # source parameters replace those in the target
+        self.assertEqual(dict(t2.params), {"rt": 2, "valid": False})
+        self.assertEqual([o.params["name"] for o in t1.attachments("Observer")], ["O"])
+
+        self.assertEqual(t1.data["recording"].get_string(), "abc" * 1000)
+        self.assertEqual(t1.data["recording"].mimetype, "raw")
+        self.assertEqual(t1.data["recording"].compression, "zlib")
+        self.assertTrue(t1.data["recording"].verify())
+        self.assertEqual(t2.data["recording"].get_string(), "abc" * 1000)
+        self.assertEqual(t2.data["own"].get_string(), "own data")
+
+        # "own data" and the ten equal chunks of both recordings
+        refcounts = dict((blob.hash, blob.refcount) for blob in m.session.query(DataBlob) if blob.refcount)
+        self.assertEqual(sorted(refcounts.values()), [1, 20])
+        # garbage collection counts the references again
+        m.collect_data_garbage(grace_period=0)
+        m.session.expire_all()
+        self.assertEqual(dict((blob.hash, blob.refcount) for blob in m.session.query(DataBlob)), refcounts)
+
+    def test_merge(self):
+        stats = merge(self.source, self.target, type_map={OldExperiment: Experiment}, batch_size=2)
+        self.assertEqual(stats["entities"], 3)
+        self.assertEqual(stats["existing_entities"], 1)
+        self.assertEqual(stats["parents"], 2)
+        self.assertEqual(stats["contexts"], 1)
+        self.assertEqual(stats["data"], 2)
+        # the chunks of both data are equal and stored once
+        self.assertEqual(stats["blobs"], 1)
+        self.assertMerged()
+
+        # merging again changes nothing
+        stats = merge(self.source, self.target, type_map={OldExperiment: Experiment})
+        self.assertEqual((stats["entities"], stats["contexts"], stats["data"], stats["blobs"]), (0, 0, 0, 0))
+        self.assertMerged()
+
+    def test_state(self):
+        state = {}
+        merge(self.source, self.target, type_map={"OldExperiment": "Experiment"}, state=state)
+        self.assertEqual(state, {"stage": "done", "last_id": None})
+        self.assertMerged()
+
+        self.m_source.save(Trial(rt=3))
+        stats = merge(self.source, self.target, state=state)
+        self.assertEqual(stats["entities"], 0)
+
+        # continue after the first two entities
+        state = {"stage": "entities", "last_id": 2}
+        stats = merge(self.source, self.target, state=state)
+        self.assertEqual(stats["entities"], 1)
+        self.assertEqual(stats["existing_entities"], 2)
+
+    def test_closure_table(self):
+        target = Connection.memory()
+        target.create_tables()
+        m = Mapper(target, closure_table=True)
+        m.register(Experiment, Trial, Observer)
+
+        merge(self.source, target, type_map={OldExperiment: Experiment})
+        e = m.find_first(Experiment)
+        self.assertEqual(set(t.unique_id for t in m.descendants_of(e)),
+                         set([self.t1.unique_id, self.t2.unique_id]))
+        self.assertEqual(m.check_closure(), (set(), set()))
+
+    def test_incompatible_types(self):
+        class OtherExperiment(Entity):
+            declared_params = {
+                'project': 'integer'
+            }
+        self.assertRaises(ValueError, merge, self.source, self.target, type_map={OldExperiment: OtherExperiment})
+        self.assertRaises(ValueError, merge, self.source, self.target, type_map={"Unknown": Experiment})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,17 +6,24 @@ Created on Jun 17, 2009
 """
 from datetime import date, time, datetime
 import operator
+import os
+import Queue
+import tempfile
+import threading
 import xdapy
-from xdapy.data import DataChunks, Data
+from xdapy.data import DataChunks, DataBlob, Data, chunk_hash, _insert_blobs
 from xdapy.parameters import StringParameter
 
 __authors__ = ['"Hannah Dold" <hannah.dold@mailbox.tu-berlin.de>']
 """TODO: Load image into testSetData"""
 
+from cStringIO import StringIO
+
+from sqlalchemy import event
 from sqlalchemy.orm.session import Session
 
 from xdapy import Connection, Mapper, Entity
-from xdapy.errors import MissingSessionError
+from xdapy.errors import MissingSessionError, DataInconsistencyError
 import unittest
 
 
@@ -242,6 +249,691 @@ class TestObjectDict(unittest.TestCase):
 
         xdapy.data.DATA_CHUNK_SIZE = old_chunk_size
 
+    def test_compressed_data(self):
+        exp = Experiment()
+        self.m.save(exp)
+
+        old_chunk_size = xdapy.data.DATA_CHUNK_SIZE
+        xdapy.data.DATA_CHUNK_SIZE = 1000
+
+        data = "0123456789ABCDEF" * 1000
+
+        for codec in sorted(xdapy.data.CODECS):
+            exp.data[codec].put(data, compression=codec)
+            self.assertEqual(exp.data[codec].compression, codec)
+            self.assertEqual(exp.data[codec].chunks(), 16)
+            self.assertEqual(exp.data[codec].size(), 16000)
+            self.assertEqual(exp.data[codec].get_string(), data)
+            if codec == "none":
+                self.assertEqual(exp.data[codec].size(stored=True), 16000)
+            else:
+                self.assertTrue(exp.data[codec].size(stored=True) < 16000)
+
+        # copying keeps the compression
+        exp.data["copy"] = exp.data["zlib"]
+        self.assertEqual(exp.data["copy"].compression, "zlib")
+        self.assertEqual(exp.data["copy"].get_string(), data)
+
+        # overwriting without compression
+        exp.data["zlib"].put("abc")
+        self.assertEqual(exp.data["zlib"].compression, "none")
+        self.assertEqual(exp.data["zlib"].size(stored=True), 3)
+
+        self.assertRaises(ValueError, exp.data["x"].put, data, compression="zip")
+
+        xdapy.data.DATA_CHUNK_SIZE = old_chunk_size
+
+
+    def test_deduplicated_data(self):
+        exp_1 = Experiment()
+        exp_2 = Experiment()
+        self.m.save(exp_1, exp_2)
+
+        old_chunk_size = xdapy.data.DATA_CHUNK_SIZE
+        xdapy.data.DATA_CHUNK_SIZE = 10
+
+        # 10 chunks, but only 5 distinct ones
+        data = "0123456789ABCDEFGHIJ" * 5
+        exp_1.data["a"].put(data)
+        exp_2.data["a"].put(data)
+        exp_2.data["b"] = exp_1.data["a"]
+
+        self.assertEqual(exp_2.data["b"].get_string(), data)
+        self.assertEqual(exp_2.data["b"].chunk_index(), range(1, 11))
+
+        stats = self.m.data_stats()
+        self.assertEqual(stats["chunks"], 30)
+        self.assertEqual(stats["blobs"], 2)
+        self.assertEqual(stats["referenced_bytes"], 300)
+        self.assertEqual(stats["stored_bytes"], 20)
+        self.assertEqual(stats["dedup_ratio"], 15.0)
+        self.assertEqual(stats["orphaned_blobs"], 0)
+        self.assertEqual(sorted(b.refcount for b in self.m.find_all(DataBlob)), [15, 15])
+
+        exp_1.data["a"].put("x")
+        with self.m.auto_session:
+            del exp_2.data["a"]
+            del exp_2.data["b"]
+
+        self.assertEqual(self.m.data_stats()["orphaned_blobs"], 2)
+        self.assertEqual(exp_1.data["a"].get_string(), "x")
+
+        # the orphans are too young to be collected by default
+        self.assertEqual(self.m.collect_data_garbage(), {"blobs": 0, "bytes": 0})
+        self.assertEqual(self.m.collect_data_garbage(grace_period=0), {"blobs": 2, "bytes": 20})
+        self.assertEqual(self.m.collect_data_garbage(grace_period=0), {"blobs": 0, "bytes": 0})
+        self.assertEqual(self.m.data_stats()["blobs"], 1)
+        self.assertEqual(exp_1.data["a"].get_string(), "x")
+
+        xdapy.data.DATA_CHUNK_SIZE = old_chunk_size
+
+
+    def test_assign_data_to_itself(self):
+        exp = Experiment()
+        self.m.save(exp)
+        exp.data["k"].put("hello world", mimetype="text/plain")
+        exp.data["j"].put("abc")
+
+        exp.data["k"] = exp.data["k"]
+        self.assertEqual(exp.data["k"].get_string(), "hello world")
+        self.assertEqual(exp.data["k"].mimetype, "text/plain")
+
+        exp.data.copy(exp.data)
+        self.assertEqual(exp.data["k"].get_string(), "hello world")
+        self.assertEqual(exp.data["j"].get_string(), "abc")
+        self.assertEqual(sorted(b.refcount for b in self.m.find_all(DataBlob)), [1, 1])
+
+    def test_put_flushes_in_batches(self):
+        exp = Experiment()
+        self.m.save(exp)
+
+        flushes = []
+        event.listen(self.m.session, "after_flush", lambda session, context: flushes.append(1))
+        data = "".join("%04d" % i for i in range(20))
+        exp.data["a"].put(data, chunk_size=4)
+        # one flush for the new data row, one for each batch of ten
+        # chunks and one for the summary
+        self.assertEqual(len(flushes), 4)
+        self.assertEqual(exp.data["a"].get_string(), data)
+        self.assertEqual(exp.data["a"].chunks(), 20)
+
+    def test_garbage_collection_spares_uploads_in_progress(self):
+        exp = Experiment()
+        self.m.save(exp)
+        exp.data["a"].put("abcd")
+
+        # a blob which has been committed by an upload in progress,
+        # and one which has been orphaned long ago
+        _insert_blobs(self.m.session, {chunk_hash("efgh"): "efgh"})
+        self.m.session.execute(DataBlob.__table__.insert(),
+                               {"hash": chunk_hash("ijkl"), "data": "ijkl", "length": 4,
+                                "refcount": 0, "created": 0})
+        # blobs from before the `created` column
+        self.m.session.execute(DataBlob.__table__.insert(),
+                               {"hash": chunk_hash("mnop"), "data": "mnop", "length": 4,
+                                "refcount": 0, "created": None})
+
+        self.assertEqual(self.m.collect_data_garbage(), {"blobs": 2, "bytes": 8})
+        self.assertEqual(sorted(b.hash for b in self.m.find_all(DataBlob)),
+                         sorted([chunk_hash("abcd"), chunk_hash("efgh")]))
+
+        exp.data["b"].put("efgh")
+        self.assertEqual(self.m.collect_data_garbage(grace_period=0), {"blobs": 0, "bytes": 0})
+        self.assertEqual(exp.data["b"].get_string(), "efgh")
+
+    def test_concurrently_inserted_blobs(self):
+        exp = Experiment()
+        self.m.save(exp)
+        exp.data["a"].put("abcd")
+
+        # another writer has inserted one of the blobs in the meantime
+        stored = {chunk_hash("abcd"): "abcd", chunk_hash("efgh"): "efgh"}
+        _insert_blobs(self.m.session, stored)
+        with self.m.auto_session as session:
+            _insert_blobs(session, stored)
+            exp.data["b"].put("efgh")
+        self.assertEqual(sorted(b.hash for b in self.m.find_all(DataBlob)), sorted(stored))
+        self.assertEqual(exp.data["b"].get_string(), "efgh")
+
+    def test_ranged_read(self):
+        exp = Experiment()
+        self.m.save(exp)
+
+        old_chunk_size = xdapy.data.DATA_CHUNK_SIZE
+        xdapy.data.DATA_CHUNK_SIZE = 10
+
+        data = "".join(chr(ord("a") + i % 26) for i in range(1000))
+        exp.data["plain"].put(data)
+        exp.data["zipped"].put(data, compression="zlib")
+
+        for key in ["plain", "zipped"]:
+            self.assertEqual(exp.data[key].read(), data)
+            self.assertEqual(exp.data[key].read(995), data[995:])
+            self.assertEqual(exp.data[key].read(5, 10), data[5:15])
+            self.assertEqual(exp.data[key].read(10, 10), data[10:20])
+            self.assertEqual(exp.data[key].read(123, 456), data[123:579])
+            self.assertEqual(exp.data[key].read(990, 100), data[990:])
+            self.assertEqual(exp.data[key].read(2000, 10), "")
+
+        statements = []
+        def count_statement(*args):
+            statements.append(args)
+        event.listen(self.connection.engine, "before_cursor_execute", count_statement)
+
+        with exp.data["zipped"].open() as f:
+            del statements[:]
+            self.assertEqual(f.size, 1000)
+            self.assertEqual(f.read(3), data[:3])
+            self.assertEqual(f.tell(), 3)
+            self.assertEqual(f.read(3), data[3:6])
+            # the chunk is cached
+            self.assertEqual(len(statements), 1)
+
+            f.seek(-15, os.SEEK_END)
+            self.assertEqual(f.read(), data[-15:])
+            self.assertEqual(f.tell(), 1000)
+            self.assertEqual(f.read(), "")
+            self.assertEqual(len(statements), 2)
+
+            f.seek(-990, os.SEEK_CUR)
+            self.assertEqual(f.read(10), data[10:20])
+            f.seek(995)
+            self.assertEqual(f.read(10), data[995:])
+            self.assertEqual(len(statements), 3)
+
+            self.assertRaises(IOError, f.seek, -1)
+        self.assertRaises(ValueError, f.read)
+
+        xdapy.data.DATA_CHUNK_SIZE = old_chunk_size
+
+    def test_chunk_size(self):
+        exp = Experiment()
+        self.m.save(exp)
+
+        data = "".join(chr(ord("a") + i % 26) for i in range(1000))
+        exp.data["small"].put(data, chunk_size=64)
+        exp.data["auto"].put(data, chunk_size="auto")
+        exp.data["default"].put(data)
+
+        self.assertEqual(exp.data["small"].chunk_size, 64)
+        self.assertEqual(exp.data["small"].chunks(), 16)
+        self.assertEqual(exp.data["auto"].chunk_size, 1000)
+        self.assertEqual(exp.data["auto"].chunks(), 1)
+        self.assertEqual(exp.data["default"].chunk_size, xdapy.data.DATA_CHUNK_SIZE)
+
+        for key in ["small", "auto", "default"]:
+            self.assertEqual(exp.data[key].get_string(), data)
+            self.assertEqual(exp.data[key].read(60, 10), data[60:70])
+
+        # a copy keeps the chunk size
+        exp.data["copy"] = exp.data["small"]
+        self.assertEqual(exp.data["copy"].chunk_size, 64)
+
+        self.assertRaises(ValueError, exp.data["bad"].put, data, chunk_size=0)
+        self.assertRaises(ValueError, exp.data["bad"].put, data, chunk_size="large")
+
+        size = xdapy.data.DATA_CHUNK_SIZE
+        self.assertEqual(xdapy.data.adaptive_chunk_size(0), 1)
+        self.assertEqual(xdapy.data.adaptive_chunk_size(size), size)
+        self.assertEqual(xdapy.data.adaptive_chunk_size(size + 1), size)
+        self.assertEqual(xdapy.data.adaptive_chunk_size(size * 2000), size * 2)
+        self.assertEqual(xdapy.data.adaptive_chunk_size(10 ** 15), xdapy.data.MAX_DATA_CHUNK_SIZE)
+
+
+    def test_resume_and_verify(self):
+        exp = Experiment()
+        self.m.save(exp)
+
+        data = "".join(chr(i % 251) for i in range(3000))
+
+        class FailingFile(object):
+            """ Fails after `reads` reads."""
+            def __init__(self, reads):
+                self.content = StringIO(data)
+                self.reads = reads
+
+            def read(self, size=-1):
+                if not self.reads:
+                    raise IOError("Connection lost")
+                self.reads -= 1
+                return self.content.read(size)
+
+        self.assertRaises(IOError, exp.data["d"].put, FailingFile(17), compression="zlib", chunk_size=100)
+        self.m.session.flush()
+        self.assertEqual(exp.data["d"].chunks(), 0) # the recorded count
+        self.assertRaises(DataInconsistencyError, exp.data["d"].verify)
+
+        # a different file does not fit
+        self.assertRaises(DataInconsistencyError, exp.data["d"].put, StringIO("x" * 3000), resume=True)
+        self.assertRaises(ValueError, exp.data["d"].put, StringIO(data), compression="bz2", resume=True)
+        self.assertRaises(ValueError, exp.data["d"].put, StringIO(data), chunk_size=200, resume=True)
+
+        exp.data["d"].put(StringIO(data), resume=True)
+        self.assertEqual(exp.data["d"].get_string(), data)
+        self.assertEqual(exp.data["d"].chunks(), 30)
+        self.assertEqual(exp.data["d"].compression, "zlib")
+        self.assertTrue(exp.data["d"].verify())
+
+        # resuming complete data changes nothing
+        exp.data["d"].put(StringIO(data), resume=True)
+        self.assertEqual(exp.data["d"].chunk_index(), range(1, 31))
+        # resuming without data is a normal upload
+        exp.data["new"].put(StringIO(data), resume=True)
+        self.assertTrue(exp.data["new"].verify())
+
+        # corrupt a chunk behind the back of the ORM
+        blob_hash = exp.data["new"].get_data()._chunks[0].blob_hash
+        self.m.session.execute(DataBlob.__table__.update()
+                                   .where(DataBlob.__table__.c.hash == blob_hash)
+                                   .values(data="?" * 100))
+        self.assertRaises(DataInconsistencyError, exp.data["new"].verify)
+        self.assertTrue(exp.data["d"].verify())
+
+    @unittest.skipIf(xdapy.data.numpy is None, "NumPy is not installed")
+    def test_array(self):
+        import numpy
+        exp = Experiment()
+        self.m.save(exp)
+
+        old_chunk_size = xdapy.data.DATA_CHUNK_SIZE
+        xdapy.data.DATA_CHUNK_SIZE = 100
+
+        c_array = numpy.arange(600, dtype="<f8").reshape(50, 3, 4)
+        f_array = numpy.asfortranarray(c_array)
+        records = numpy.array([(1, 2.5), (3, 4.5)], dtype=[("a", "<i4"), ("b", "<f4")])
+
+        exp.data["c"].put_array(c_array, compression="zlib")
+        exp.data["f"].put_array(f_array)
+        exp.data["strided"].put_array(c_array[::2])
+        exp.data["records"].put_array(records)
+        exp.data["scalar"].put_array(numpy.float32(3.5))
+        exp.data["empty"].put_array(numpy.zeros((0, 3)))
+
+        self.assertEqual(exp.data["c"].mimetype, xdapy.data.ARRAY_MIMETYPE)
+        self.assertEqual(exp.data["c"].array_info(), (numpy.dtype("<f8"), (50, 3, 4), "C"))
+        self.assertEqual(exp.data["f"].array_info()[2], "F")
+
+        for key, expected in [("c", c_array), ("f", f_array), ("strided", c_array[::2]), ("records", records)]:
+            result = exp.data[key].get_array()
+            self.assertEqual(result.dtype, expected.dtype)
+            self.assertTrue((result == expected).all())
+        self.assertTrue(exp.data["f"].get_array().flags.f_contiguous)
+        self.assertEqual(exp.data["scalar"].get_array(), 3.5)
+        self.assertEqual(exp.data["empty"].get_array().shape, (0, 3))
+
+        # slices only fetch the chunks which hold the rows
+        statements = []
+        def count_statement(*args):
+            statements.append(args)
+        event.listen(self.connection.engine, "before_cursor_execute", count_statement)
+        rows = exp.data["c"].get_array(10, 12)
+        self.assertTrue((rows == c_array[10:12]).all())
+        self.assertTrue(len(statements) <= 6)
+
+        self.assertTrue((exp.data["c"].get_array(start=45) == c_array[45:]).all())
+        self.assertTrue((exp.data["f"].get_array(stop=-40) == f_array[:-40]).all())
+        self.assertEqual(exp.data["c"].get_array(60, 70).shape, (0, 3, 4))
+
+        mapped = exp.data["c"].get_array(mmap=True)
+        self.assertTrue(isinstance(mapped, numpy.memmap))
+        self.assertTrue((mapped == c_array).all())
+
+        # a copy keeps the array information
+        exp.data["copy"] = exp.data["f"]
+        self.assertTrue((exp.data["copy"].get_array() == f_array).all())
+
+        # writing plain data removes it
+        exp.data["c"].put("plain")
+        self.assertRaises(ValueError, exp.data["c"].get_array)
+        self.assertRaises(ValueError, exp.data["scalar"].get_array, 0, 1)
+        self.assertRaises(ValueError, exp.data["f"].get_array, 0, 1, mmap=True)
+        self.assertRaises(ValueError, exp.data["o"].put_array, numpy.array([None, 1]))
+
+        xdapy.data.DATA_CHUNK_SIZE = old_chunk_size
+
+    def test_array_without_numpy(self):
+        exp = Experiment()
+        self.m.save(exp)
+        exp.data["a"].put("".join(chr(i) for i in range(48)), chunk_size=10)
+        data = exp.data["a"].get_data()
+        data.array_dtype, data.array_shape, data.array_order = "<f8", "2,3", "F"
+        exp.data["scalar"].put("x" * 8)
+        data = exp.data["scalar"].get_data()
+        data.array_dtype, data.array_shape, data.array_order = "<f8", "", "C"
+        self.m.session.flush()
+
+        # reading into a buffer does not need NumPy
+        reader = exp.data["a"].open()
+        buf = bytearray(25)
+        reader.seek(5)
+        self.assertEqual(reader.readinto(buf), 25)
+        self.assertEqual(buf, bytearray(range(5, 30)))
+        self.assertEqual(reader.tell(), 30)
+        self.assertEqual(reader.readinto(buf), 18)
+        self.assertEqual(buf[:18], bytearray(range(30, 48)))
+        self.assertEqual(reader.readinto(buf), 0)
+        reader.close()
+
+        class FakeNumpy(object):
+            @staticmethod
+            def dtype(string):
+                return ("dtype", string)
+
+        old_numpy = xdapy.data.numpy
+        try:
+            xdapy.data.numpy = None
+            self.assertRaises(ImportError, exp.data["a"].array_info)
+            self.assertRaises(ImportError, exp.data["a"].get_array)
+            self.assertRaises(ImportError, exp.data["b"].put_array, [1, 2])
+            self.assertFalse(exp.data["b"].has_data())
+
+            # the array information is read from the data row
+            xdapy.data.numpy = FakeNumpy()
+            self.assertEqual(exp.data["a"].array_info(), (("dtype", "<f8"), (2, 3), "F"))
+            self.assertEqual(exp.data["scalar"].array_info(), (("dtype", "<f8"), (), "C"))
+            exp.data["a"].put("plain")
+            self.assertRaises(ValueError, exp.data["a"].array_info)
+        finally:
+            xdapy.data.numpy = old_numpy
+
+
+
+class TestParallelData(unittest.TestCase):
+    """ The parallel transfer needs several connections to the same
+    database. For lack of PostgreSQL, we test it with a sqlite file.
+    """
+    def setUp(self):
+        fd, self.db_file = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.connection = Connection(url="sqlite:///" + self.db_file)
+        self.connection.create_tables()
+        self.m = Mapper(self.connection)
+        self.m.register(Experiment)
+
+        self.old_chunk_size = xdapy.data.DATA_CHUNK_SIZE
+        xdapy.data.DATA_CHUNK_SIZE = 100
+        xdapy.data.PARALLEL_ENGINES.add("sqlite")
+
+    def tearDown(self):
+        xdapy.data.PARALLEL_ENGINES.discard("sqlite")
+        xdapy.data.DATA_CHUNK_SIZE = self.old_chunk_size
+        self.connection.drop_tables()
+        self.connection.engine.dispose()
+        os.remove(self.db_file)
+
+    def test_parallel_put_and_get(self):
+        exp = Experiment()
+        self.m.save(exp)
+
+        data = "".join(chr(i % 251) for i in range(10000)) + "x" * 1000
+        exp.data["a"].put(data, compression="zlib", workers=4)
+        exp.data["b"].put(data, workers=3)
+
+        self.assertEqual(exp.data["a"].chunks(), 110)
+        self.assertEqual(exp.data["a"].chunk_index(), range(1, 111))
+        self.assertEqual(exp.data["a"].size(), 11000)
+        self.assertEqual(exp.data["a"].get_string(), data)
+
+        out = StringIO()
+        exp.data["b"].get(out, workers=4)
+        self.assertEqual(out.getvalue(), data)
+
+        # same content is stored once; the "x" chunks are all identical
+        stats = self.m.data_stats()
+        self.assertEqual(stats["chunks"], 220)
+        self.assertEqual(stats["blobs"], 2 * 101)
+        self.assertEqual(stats["orphaned_blobs"], 0)
+
+        # the serial upload reuses the blobs of the parallel one
+        exp.data["c"].put(data, compression="zlib")
+        self.assertEqual(self.m.data_stats()["blobs"], 2 * 101)
+
+    def test_get_to_path(self):
+        exp = Experiment()
+        self.m.save(exp)
+
+        data = "".join(chr(i % 251) for i in range(10050))
+        exp.data["a"].put(data, compression="zlib")
+        exp.data["empty"].put("")
+
+        path = self.db_file + ".out"
+        try:
+            for workers in [None, 4]:
+                view = exp.data["a"].get_to_path(path, workers=workers)
+                self.assertEqual(len(view), 10050)
+                self.assertEqual(view[:], data)
+                self.assertEqual(view[5000:5010], data[5000:5010])
+                view.close()
+                with open(path, "rb") as f:
+                    self.assertEqual(f.read(), data)
+
+            self.assertEqual(exp.data["empty"].get_to_path(path), "")
+            self.assertEqual(os.path.getsize(path), 0)
+
+            if xdapy.data.numpy is None:
+                self.assertRaises(ImportError, exp.data["a"].get_to_path, path, dtype="uint8")
+            else:
+                array = exp.data["a"].get_to_path(path, dtype="uint8")
+                self.assertEqual(array.shape, (10050,))
+                self.assertEqual(array[300], 300 % 251)
+        finally:
+            os.remove(path)
+
+
+class TestDataCopy(unittest.TestCase):
+    """ Two connections to the same sqlite file."""
+    def setUp(self):
+        fd, self.db_file = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.connection = Connection(url="sqlite:///" + self.db_file)
+        self.connection.create_tables()
+        self.m = Mapper(self.connection)
+        self.m.register(Experiment)
+
+        self.other_connection = Connection(url="sqlite:///" + self.db_file)
+        self.other_m = Mapper(self.other_connection)
+        self.other_m.register(Experiment)
+
+    def tearDown(self):
+        self.other_connection.engine.dispose()
+        self.connection.drop_tables()
+        self.connection.engine.dispose()
+        os.remove(self.db_file)
+
+    def test_copy_in_database(self):
+        data = "".join(chr(i % 251) for i in range(1000))
+        exp = Experiment()
+        self.m.save(exp)
+        exp.data["a"].put(data, compression="zlib", chunk_size=100, mimetype="raw")
+
+        other_exp = Experiment()
+        self.other_m.save(other_exp)
+
+        statements = []
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.other_connection.engine, "before_cursor_execute", count_statement)
+
+        other_exp.data["copy"] = exp.data["a"]
+        self.assertFalse([stmt for stmt in statements if "data_blobs.data" in stmt])
+        self.assertTrue([stmt for stmt in statements if stmt.startswith("INSERT INTO data_chunks")])
+
+        self.assertEqual(other_exp.data["copy"].get_string(), data)
+        self.assertEqual(other_exp.data["copy"].chunks(), 10)
+        self.assertEqual(other_exp.data["copy"].mimetype, "raw")
+        self.assertEqual(other_exp.data["copy"].compression, "zlib")
+        self.assertTrue(other_exp.data["copy"].verify())
+
+        # the blobs are referenced by the copy
+        refcounts = [blob.refcount for blob in self.other_m.session.query(DataBlob)]
+        self.assertEqual(refcounts, [2] * 10)
+        del exp.data["a"]
+        self.m.session.flush()
+        self.assertEqual(self.other_m.collect_data_garbage(grace_period=0)["blobs"], 0)
+        self.assertEqual(other_exp.data["copy"].get_string(), data)
+
+    def test_copy_to_the_same_data(self):
+        exp = Experiment()
+        self.m.save(exp)
+        exp.data["a"].put("hello world", chunk_size=4)
+
+        # the same data row, seen from another session
+        same_exp = self.other_m.find_by_unique_id(exp.unique_id)
+        same_exp.data["a"] = exp.data["a"]
+        self.assertEqual(same_exp.data["a"].get_string(), "hello world")
+        same_exp.data["a"]._link_chunks(exp.data["a"])
+        self.assertEqual(same_exp.data["a"].get_string(), "hello world")
+        self.assertEqual(exp.data["a"].get_string(), "hello world")
+        self.assertEqual([blob.refcount for blob in self.other_m.session.query(DataBlob)], [1] * 3)
+
+
+class TestUpgradeChunks(unittest.TestCase):
+    """ A database in the format from before the deduplication of chunks."""
+    def setUp(self):
+        fd, self.db_file = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.connection = Connection(url="sqlite:///" + self.db_file)
+        old_tables = ("data", "data_chunks", "data_blobs")
+        xdapy.Base.metadata.create_all(self.connection.engine,
+            tables=[t for t in xdapy.Base.metadata.sorted_tables if t.name not in old_tables])
+        self.connection.engine.execute("""CREATE TABLE data (
+            id INTEGER NOT NULL PRIMARY KEY, entity_id INTEGER NOT NULL REFERENCES entities (id),
+            "key" VARCHAR(40), mimetype VARCHAR(40), UNIQUE (entity_id, "key"))""")
+        self.connection.engine.execute("""CREATE TABLE data_chunks (
+            id INTEGER NOT NULL PRIMARY KEY, data_id INTEGER NOT NULL REFERENCES data (id),
+            "index" INTEGER, data BLOB NOT NULL, length INTEGER, UNIQUE (data_id, "index"))""")
+
+        self.m = Mapper(self.connection)
+        self.m.register(Experiment)
+
+    def tearDown(self):
+        self.connection.engine.dispose()
+        os.remove(self.db_file)
+
+    def test_upgrade(self):
+        exp = Experiment()
+        self.m.save(exp)
+        engine = self.connection.engine
+        engine.execute("INSERT INTO data (id, entity_id, key, mimetype) VALUES (1, ?, 'a', 'raw')", exp.id)
+        engine.execute("INSERT INTO data (id, entity_id, key, mimetype) VALUES (2, ?, 'b', NULL)", exp.id)
+        for chunk_id, data_id, index, chunk in [(1, 1, 1, "abc"), (2, 1, 2, "def"), (3, 1, 3, "ab"),
+                                                (4, 2, 1, "abc")]:
+            engine.execute("INSERT INTO data_chunks (id, data_id, \"index\", data, length) VALUES (?, ?, ?, ?, ?)",
+                           chunk_id, data_id, index, buffer(chunk), len(chunk))
+
+        conn = engine.connect()
+        self.assertEqual(xdapy.data.upgrade_chunks(conn, batch_size=3), 4)
+        conn.close()
+        self.assertEqual(self.connection.upgrade_tables(), 0)
+
+        self.m.session.expire_all()
+        self.assertEqual(exp.data["a"].get_string(), "abcdefab")
+        self.assertEqual(exp.data["a"].mimetype, "raw")
+        self.assertEqual(exp.data["a"].size(), 8)
+        self.assertEqual(exp.data["b"].get_string(), "abc")
+        self.assertEqual(sorted((b.blob, b.refcount) for b in self.m.find_all(DataBlob)),
+                         [("ab", 1), ("abc", 2), ("def", 1)])
+
+        # new data can be stored
+        exp.data["c"].put("abc", compression="zlib")
+        self.assertEqual(exp.data["c"].get_string(), "abc")
+        del exp.data["b"]
+        self.assertEqual(self.m.collect_data_garbage(grace_period=0), {"blobs": 0, "bytes": 0})
+
+
+class BlockingFile(object):
+    """ A file whose first read waits for `release`."""
+    def __init__(self, content):
+        self.content = StringIO(content)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def read(self, size=-1):
+        self.started.set()
+        self.release.wait()
+        return self.content.read(size)
+
+
+class TestIngestQueue(unittest.TestCase):
+    def setUp(self):
+        fd, self.db_file = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.connection = Connection(url="sqlite:///" + self.db_file)
+        self.connection.create_tables()
+        self.m = Mapper(self.connection)
+        self.m.register(Experiment)
+
+        self.old_chunk_size = xdapy.data.DATA_CHUNK_SIZE
+        xdapy.data.DATA_CHUNK_SIZE = 100
+
+    def tearDown(self):
+        xdapy.data.DATA_CHUNK_SIZE = self.old_chunk_size
+        if self.m._ingest_queue is not None:
+            self.m._ingest_queue.close()
+        self.connection.drop_tables()
+        self.connection.engine.dispose()
+        os.remove(self.db_file)
+
+    def test_ingest(self):
+        exp = Experiment()
+        data = "".join(chr(i % 251) for i in range(1000))
+
+        fd, path = tempfile.mkstemp()
+        os.write(fd, data)
+        os.close(fd)
+
+        progress = []
+        try:
+            job_a = self.m.ingest(exp, "a", path, mimetype="raw",
+                                  progress=lambda job, done, total: progress.append((done, total)))
+            job_b = self.m.ingest(exp, "b", StringIO(data), compression="zlib")
+            self.m.wait_for_ingestion()
+        finally:
+            os.remove(path)
+
+        self.assertTrue(job_a.done())
+        self.assertEqual(job_a.result(), None)
+        self.assertEqual(job_b.exception(), None)
+        self.assertEqual(progress[-1], (1000, 1000))
+        self.assertEqual(len(progress), 11)
+
+        self.m.session.expire_all()
+        self.assertEqual(exp.data["a"].get_string(), data)
+        self.assertEqual(exp.data["a"].mimetype, "raw")
+        self.assertEqual(exp.data["b"].get_string(), data)
+        self.assertEqual(exp.data["b"].compression, "zlib")
+
+    def test_failure_and_backpressure(self):
+        exp = Experiment()
+        self.m.save(exp)
+        queue = self.m.ingest_queue(max_pending=1)
+
+        failed = queue.submit(exp, "missing", self.db_file + ".missing")
+        self.assertRaises(IOError, failed.result, 5)
+
+        done = []
+        blocking = BlockingFile("x" * 250)
+        job = queue.submit(exp, "blocking", blocking)
+        job.add_done_callback(done.append)
+        # wait until the worker has taken the job
+        blocking.started.wait(5)
+        queue.submit(exp, "waiting", StringIO("y"))
+        self.assertRaises(Queue.Full, queue.submit, exp, "full", StringIO("z"), block=False)
+        self.assertFalse(job.done())
+
+        blocking.release.set()
+        queue.wait()
+        self.assertEqual(done, [job])
+        self.assertEqual(job.bytes_done, 250)
+
+        self.m.session.expire_all()
+        self.assertEqual(exp.data["blocking"].size(), 250)
+        self.assertEqual(exp.data["waiting"].get_string(), "y")
+
+        self.assertRaises(ValueError, queue.submit, Experiment(), "unsaved", StringIO(""))
+        queue.close()
+        self.assertRaises(ValueError, queue.submit, exp, "closed", StringIO(""))
+
 
 class TestStrJsonParams(unittest.TestCase):
     def setUp(self):
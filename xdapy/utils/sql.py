@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+"""SQL constructs which are missing from the supported SQLAlchemy versions.
+
+"""
+__authors__ = ['"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
+
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Executable, ClauseElement
+
+
+class InsertFromSelect(Executable, ClauseElement):
+    """ An ``INSERT INTO table (columns) SELECT ...`` statement.
+
+    Parameters
+    ----------
+    table
+        The table to insert into.
+    columns: list
+        The names of the columns which are filled by `select`.
+    select
+        The select statement which provides the rows.
+    """
+    def __init__(self, table, columns, select):
+        self.table = table
+        self.columns = columns
+        self.select = select
+
+
+@compiles(InsertFromSelect)
+def _visit_insert_from_select(element, compiler, **kw):
+    return "INSERT INTO %s (%s) %s" % (
+        compiler.process(element.table, asfrom=True),
+        ", ".join(compiler.preparer.format_column(element.table.c[name]) for name in element.columns),
+        compiler.process(element.select)
+    )
+